@@ -51,7 +51,8 @@ OneOrMoreStrings = Union[str, Iterable[str], Ref, GetAtt]
 def _as_unique_list(x: OneOrMoreStrings) -> Set[str]:
     if isinstance(x, str) or isinstance(x, Ref) or isinstance(x, GetAtt):
         return {x}
-    return list(set(x))
+    # Keeps the first occurrence of each, so the template is stable.
+    return list(dict.fromkeys(x))
 
 
 def policy(
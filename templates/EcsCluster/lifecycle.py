@@ -19,6 +19,7 @@ from troposphere.pipes import (
     NetworkConfiguration,
     AwsVpcConfiguration,
     PipeSourceParameters,
+    PipeSourceSqsQueueParameters,
     DeadLetterConfig,
 )
 from troposphere.sns import Subscription, SubscriptionResource, Topic
@@ -48,7 +49,7 @@ def log_group():
     )
 
 
-def pipe_role():
+def pipe_role(state_machine):
     return add_resource_once(
         "LifecyclePipeRole",
         lambda name: iam.role(
@@ -59,7 +60,7 @@ def pipe_role():
                     "sqs:DeleteMessage",
                     "sqs:GetQueueAttributes",
                 ): sqs_queue().GetAtt("Arn"),
-                ("states:StartExecution",): termination_state_machine().GetAtt("Arn"),
+                ("states:StartExecution",): state_machine.GetAtt("Arn"),
             },
             allow_assume=[iam.PIPES_SERVICE],
             managed_policy_arns=[
@@ -103,7 +104,7 @@ def state_machine_role():
     )
 
 
-def termination_state_machine():
+def termination_state_machine(drain):
     role = state_machine_role()
     return add_resource_once(
         "LifecycleTerminationStateMachine",
@@ -112,6 +113,7 @@ def termination_state_machine():
             Definition=yaml.safe_load(read_resource("TerminationStateMachine.yml")),
             DefinitionSubstitutions={
                 "cluster_arn": GetAtt("EcsCluster", "Arn"),
+                "poll_backoff_seconds": json.dumps(drain.poll_backoff_seconds),
             },
             RoleArn=GetAtt(role, "Arn"),
             LoggingConfiguration=LoggingConfiguration(
@@ -134,7 +136,8 @@ def sqs_queue():
     return add_resource_once("LifecycleSqsQueue", lambda name: Queue(name))
 
 
-def pipe():
+def pipe(drain):
+    state_machine = termination_state_machine(drain)
     return add_resource_once(
         "LifecyclePipe",
         lambda name: Pipe(
@@ -142,9 +145,15 @@ def pipe():
             Description=Sub(
                 "This pipe is used by the ${AWS::StackName} ECS cluster for managing ASG lifecycle events."
             ),
-            RoleArn=GetAtt(pipe_role(), "Arn"),
+            RoleArn=GetAtt(pipe_role(state_machine), "Arn"),
             Source=sqs_queue().GetAtt("Arn"),
-            Target=Ref(termination_state_machine()),
+            SourceParameters=PipeSourceParameters(
+                SqsQueueParameters=PipeSourceSqsQueueParameters(
+                    BatchSize=drain.batch_size,
+                    MaximumBatchingWindowInSeconds=drain.batching_window_seconds,
+                )
+            ),
+            Target=Ref(state_machine),
             TargetParameters=PipeTargetParameters(
                 StepFunctionStateMachineParameters=PipeTargetStateMachineParameters(
                     InvocationType="FIRE_AND_FORGET"
@@ -189,6 +198,6 @@ def asg_terminate_hook(asg):
     )
 
 
-def init():
+def init(drain):
     """This is the primary entrypoint for this module and is called by main.py"""
-    pipe()
+    pipe(drain)
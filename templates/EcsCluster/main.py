@@ -3,16 +3,32 @@ import hashlib
 from troposphere import Base64, GetAtt, Ref, Sub, Tags
 from troposphere.autoscaling import (
     AutoScalingGroup,
-    LaunchConfiguration,
+    InstanceReusePolicy,
+    InstancesDistribution,
+    LaunchTemplateOverrides,
+    LaunchTemplateSpecification,
     LifecycleHook,
-    MetadataOptions,
+    LifecycleHookSpecification,
     MetricsCollection,
+    MixedInstancesPolicy,
     NotificationConfigurations,
+    WarmPool,
 )
+from troposphere.autoscaling import LaunchTemplate as AsgLaunchTemplate
 from troposphere.autoscaling import Tags as ASTags
 from troposphere.awslambda import Code, Function, Permission
 from troposphere.cloudformation import AWSCustomObject
-from troposphere.ec2 import SecurityGroup, SecurityGroupRule
+from troposphere.ec2 import (
+    EBSBlockDevice,
+    HibernationOptions,
+    IamInstanceProfile,
+    LaunchTemplate,
+    LaunchTemplateBlockDeviceMapping,
+    LaunchTemplateData,
+    MetadataOptions,
+    SecurityGroup,
+    SecurityGroupRule,
+)
 from troposphere.ecs import (
     AutoScalingGroupProvider,
     CapacityProvider,
@@ -27,7 +43,9 @@ from troposphere.policies import AutoScalingRollingUpdate, UpdatePolicy
 from troposphere.s3 import Bucket, PublicAccessBlockConfiguration
 from troposphere.sns import Subscription, SubscriptionResource, Topic
 
+import lifecycle
 import model
+import scaling_dashboard
 from util import (
     TEMPLATE,
     add_export,
@@ -38,6 +56,10 @@ from util import (
     opts_with,
 )
 
+# The launch lifecycle hook is completed by the instances themselves. This name
+# must match the one in resources/WarmPoolUserData.txt.
+LAUNCH_HOOK_NAME = "ecs-node-launch"
+
 
 def md5(s):
     return hashlib.md5(s.encode("utf-8")).hexdigest()
@@ -78,7 +100,17 @@ def service_role():
     )
 
 
-def node_instance_role():
+def node_instance_role(warm_pools):
+    warm_pool_statements = [
+        {
+            "Effect": "Allow",
+            "Action": [
+                "autoscaling:CompleteLifecycleAction",
+                "autoscaling:DescribeAutoScalingInstances",
+            ],
+            "Resource": ["*"],
+        }
+    ]
     return add_resource(
         Role(
             "NodeInstanceRole",
@@ -142,7 +174,8 @@ def node_instance_role():
                                     Sub("${ClusterBucket.Arn}/*"),
                                 ],
                             },
-                        ],
+                        ]
+                        + (warm_pool_statements if warm_pools else []),
                     },
                 )
             ],
@@ -175,15 +208,71 @@ def node_security_group(ingress_cidrs):
     )
 
 
+def launch_hook(warm_pool_model):
+    return LifecycleHookSpecification(
+        LifecycleHookName=LAUNCH_HOOK_NAME,
+        LifecycleTransition="autoscaling:EC2_INSTANCE_LAUNCHING",
+        DefaultResult="ABANDON",
+        HeartbeatTimeout=warm_pool_model.heartbeat_timeout_seconds,
+    )
+
+
+def launch_template_spec(launch_template):
+    return LaunchTemplateSpecification(
+        LaunchTemplateId=Ref(launch_template),
+        Version=GetAtt(launch_template, "LatestVersionNumber"),
+    )
+
+
+def mixed_instances_policy(launch_template, instance_types, distribution):
+    return MixedInstancesPolicy(
+        LaunchTemplate=AsgLaunchTemplate(
+            LaunchTemplateSpecification=launch_template_spec(launch_template),
+            Overrides=[
+                LaunchTemplateOverrides(
+                    InstanceType=t.node_type,
+                    **opts_with(
+                        WeightedCapacity=(t.weighted_capacity, lambda w: str(w))
+                    )
+                )
+                for t in instance_types
+            ],
+        ),
+        InstancesDistribution=InstancesDistribution(
+            OnDemandAllocationStrategy="prioritized",
+            OnDemandBaseCapacity=distribution.on_demand_base_capacity,
+            OnDemandPercentageAboveBaseCapacity=distribution.on_demand_percentage_above_base_capacity,
+            SpotAllocationStrategy=distribution.spot_allocation_strategy,
+        ),
+    )
+
+
+def uses_spot(sg_model):
+    return (
+        sg_model.instance_types is not None
+        and sg_model.instances_distribution.on_demand_percentage_above_base_capacity
+        < 100
+    )
+
+
 def auto_scaling_group(
-    name, subnets, launch_conf, max_size, max_lifetime_days, desired_size, tags
+    name,
+    subnets,
+    launch_template,
+    min_size,
+    max_size,
+    max_lifetime_days,
+    desired_size,
+    tags,
+    warm_pool_model,
+    mixed_policy,
+    spot,
 ):
     return add_resource(
         AutoScalingGroup(
             "Asg" + name,
             VPCZoneIdentifier=subnets,
-            LaunchConfigurationName=Ref(launch_conf),
-            MinSize=0,
+            MinSize=min_size,
             MaxSize=max_size,
             DesiredCapacity=str(desired_size),
             MetricsCollection=[MetricsCollection(Granularity="1Minute")],
@@ -197,28 +286,110 @@ def auto_scaling_group(
                 )
             ),
             **opts_with(
-                MaxInstanceLifetime=(max_lifetime_days, lambda secs: secs * 86400)
+                LaunchTemplate=(
+                    None if mixed_policy else launch_template_spec(launch_template)
+                ),
+                MixedInstancesPolicy=mixed_policy,
+                # Replaces Spot Instances at elevated risk of interruption
+                # before they are interrupted.
+                CapacityRebalance=True if spot else None,
+                MaxInstanceLifetime=(max_lifetime_days, lambda secs: secs * 86400),
+                # The hook is part of the group so that it also applies to the
+                # instances launched when the group is created.
+                LifecycleHookSpecificationList=(
+                    warm_pool_model,
+                    lambda wp: [launch_hook(wp)],
+                ),
+            )
+        )
+    )
+
+
+def warm_pool(asg, warm_pool_model):
+    return add_resource(
+        WarmPool(
+            asg.title + "WarmPool",
+            AutoScalingGroupName=Ref(asg),
+            PoolState=warm_pool_model.pool_state,
+            MinSize=warm_pool_model.min_size,
+            InstanceReusePolicy=InstanceReusePolicy(
+                ReuseOnScaleIn=warm_pool_model.reuse_on_scale_in
+            ),
+            **opts_with(
+                MaxGroupPreparedCapacity=warm_pool_model.max_group_prepared_capacity
             )
         )
     )
 
 
-def launch_config(
-    name, sgs, inst_type, inst_prof, keyName, extra_node_user_data, allow_imds1
+def node_user_data(bootstrap_profile, extra_node_user_data, warm_pool_model, spot):
+    return Base64(
+        Sub(
+            read_resource("UserData.txt"),
+            BootstrapProfile=bootstrap_profile,
+            PackageSetup=read_resource("Bootstrap%s.txt" % bootstrap_profile.title()),
+            LegacyUserData=(
+                read_resource("LegacyUserData.txt")
+                if bootstrap_profile == "full"
+                else ""
+            ),
+            BootstrapReportUserData=read_resource("BootstrapReportUserData.txt"),
+            WarmPoolUserData=(
+                read_resource("WarmPoolUserData.txt") if warm_pool_model else ""
+            ),
+            # Lets ECS drain Spot Instances when they receive an interruption
+            # notice.
+            SpotUserData=(
+                "echo ECS_ENABLE_SPOT_INSTANCE_DRAINING=true >> /etc/ecs/ecs.config"
+                if spot
+                else ""
+            ),
+            ExtraUserData=extra_node_user_data,
+        )
+    )
+
+
+def launch_template(
+    name,
+    sgs,
+    inst_type,
+    inst_prof,
+    keyName,
+    user_data,
+    allow_imds1,
+    warm_pool_model,
 ):
     metadata_options = MetadataOptions(HttpTokens="optional") if allow_imds1 else None
+    hibernate = warm_pool_model and warm_pool_model.pool_state == "Hibernated"
+    # Hibernation saves the instance's memory to its root volume, which must be
+    # encrypted.
+    hibernation_options = HibernationOptions(Configured=True) if hibernate else None
+    block_device_mappings = (
+        [
+            LaunchTemplateBlockDeviceMapping(
+                DeviceName="/dev/xvda",
+                Ebs=EBSBlockDevice(Encrypted=True, VolumeType="gp3"),
+            )
+        ]
+        if hibernate
+        else None
+    )
     return add_resource(
-        LaunchConfiguration(
-            "LaunchConf" + name,
-            ImageId=Ref("AmiId"),
-            SecurityGroups=sgs,
-            InstanceType=inst_type,
-            IamInstanceProfile=Ref(inst_prof),
-            KeyName=keyName,
-            UserData=Base64(
-                Sub(read_resource("UserData.txt"), ExtraUserData=extra_node_user_data)
+        LaunchTemplate(
+            "LaunchTemplate" + name,
+            LaunchTemplateData=LaunchTemplateData(
+                ImageId=Ref("AmiId"),
+                SecurityGroupIds=sgs,
+                InstanceType=inst_type,
+                IamInstanceProfile=IamInstanceProfile(Arn=GetAtt(inst_prof, "Arn")),
+                KeyName=keyName,
+                UserData=user_data,
+                **opts_with(
+                    MetadataOptions=metadata_options,
+                    HibernationOptions=hibernation_options,
+                    BlockDeviceMappings=block_device_mappings,
+                )
             ),
-            **opts_with(MetadataOptions=metadata_options)
         )
     )
 
@@ -266,6 +437,8 @@ def lambda_execution_role():
                                     "ecs:DescribeContainerInstances",
                                     "ecs:UpdateContainerInstancesState",
                                     "ecs:UpdateService",
+                                    "lambda:InvokeFunction",
+                                    "cloudwatch:PutMetricData",
                                     "sns:Publish",
                                 ],
                                 "Resource": "*",
@@ -301,7 +474,7 @@ def lambda_fn_for_cps():
             Role=lambda_execution_role().GetAtt("Arn"),
             Runtime="python3.9",
             MemorySize=128,
-            Timeout=60,
+            Timeout=900,
             Code=Code(ZipFile=Sub(read_resource("ResetCapacityProvidersLambda.py"))),
         )
     )
@@ -309,21 +482,37 @@ def lambda_fn_for_cps():
 
 class CpsReset(AWSCustomObject):
     resource_type = "Custom::CpsReset"
-    props = {"ServiceToken": (str, True), "StrategyHash": (str, True)}
+    props = {
+        "ServiceToken": (str, True),
+        "StrategyHash": (str, True),
+        "WaveSize": (int, False),
+        "Concurrency": (int, False),
+        "WaitForSteadyState": (bool, False),
+        "PauseOnFailure": (bool, False),
+        "SteadyStateTimeoutMinutes": (int, False),
+        "PollSeconds": (int, False),
+    }
 
 
 def cps_reset_resource(user_data):
+    rollout = user_data.cps_reset
     return add_resource(
         CpsReset(
             "CpsReset",
             ServiceToken=GetAtt("LambdaFunctionForCpsReset", "Arn"),
             StrategyHash=md5(str(user_data.scaling_groups)),
+            WaveSize=rollout.wave_size,
+            Concurrency=rollout.concurrency,
+            WaitForSteadyState=rollout.wait_for_steady_state,
+            PauseOnFailure=rollout.pause_on_failure,
+            SteadyStateTimeoutMinutes=rollout.steady_state_timeout_minutes,
+            PollSeconds=rollout.poll_seconds,
             DependsOn="CapacityProviderAssoc",
         )
     )
 
 
-def capacity_provider(asg):
+def capacity_provider(asg, sg_model):
     return add_resource(
         CapacityProvider(
             asg.title + "CapacityProvider",
@@ -331,14 +520,22 @@ def capacity_provider(asg):
                 AutoScalingGroupArn=Ref(asg),
                 ManagedDraining="ENABLED",
                 ManagedTerminationProtection="DISABLED",
-                ManagedScaling=ManagedScaling(Status="ENABLED", TargetCapacity=100),
+                ManagedScaling=ManagedScaling(
+                    Status="ENABLED",
+                    TargetCapacity=sg_model.target_capacity_percent,
+                    **opts_with(
+                        InstanceWarmupPeriod=sg_model.instance_warmup_seconds,
+                        MinimumScalingStepSize=sg_model.minimum_scaling_step_size,
+                        MaximumScalingStepSize=sg_model.maximum_scaling_step_size,
+                    )
+                ),
             ),
         )
     )
 
 
 def capacity_provider_assoc(asgs_with_models):
-    cps_with_models = [(capacity_provider(a), m) for a, m in asgs_with_models]
+    cps_with_models = [(capacity_provider(a, m), m) for a, m in asgs_with_models]
     return add_resource(
         ClusterCapacityProviderAssociations(
             "CapacityProviderAssoc",
@@ -357,27 +554,53 @@ def capacity_provider_assoc(asgs_with_models):
 
 
 def scaling_group_with_resources(
-    security_groups, node_profile, subnets, tags, sg_model
+    security_groups,
+    node_profile,
+    subnets,
+    tags,
+    bootstrap_profile,
+    termination_drain,
+    sg_model,
 ):
-    lc = launch_config(
+    spot = uses_spot(sg_model)
+    lt = launch_template(
         sg_model.name,
         security_groups,
-        sg_model.node_type,
+        sg_model.node_type or sg_model.instance_types[0].node_type,
         node_profile,
         sg_model.key_name,
-        sg_model.extra_node_user_data,
+        node_user_data(
+            bootstrap_profile,
+            sg_model.extra_node_user_data,
+            sg_model.warm_pool,
+            spot,
+        ),
         sg_model.allow_imds1,
+        sg_model.warm_pool,
     )
     asg = auto_scaling_group(
         sg_model.name,
         subnets,
-        lc,
+        lt,
+        sg_model.min_size,
         sg_model.max_size,
         sg_model.max_instance_lifetime_days,
         sg_model.desired_size,
         tags,
+        sg_model.warm_pool,
+        (
+            mixed_instances_policy(
+                lt, sg_model.instance_types, sg_model.instances_distribution
+            )
+            if sg_model.instance_types
+            else None
+        ),
+        spot,
     )
-    # lifecycle.asg_terminate_hook(asg)
+    if sg_model.warm_pool:
+        warm_pool(asg, sg_model.warm_pool)
+    if termination_drain:
+        lifecycle.asg_terminate_hook(asg)
     return asg
 
 
@@ -416,12 +639,14 @@ def sceptre_handler(sceptre_user_data):
 
     if len(user_data.scaling_groups) > 0:
         node_sg = node_security_group(user_data.ingress_cidrs)
-        node_role = node_instance_role()
+        node_role = node_instance_role(
+            any(g.warm_pool for g in user_data.scaling_groups)
+        )
         node_profile = node_instance_profile(node_role)
         all_security_groups = [Ref(node_sg)] + user_data.node_security_groups
 
-        # Lifecycle
-        # lifecycle.init()
+        if user_data.termination_drain:
+            lifecycle.init(user_data.termination_drain)
 
         asgs_with_models = [
             (
@@ -430,6 +655,8 @@ def sceptre_handler(sceptre_user_data):
                     node_profile,
                     user_data.subnet_ids,
                     {**user_data.tags, **user_data.asg_tags, **g.tags},
+                    user_data.bootstrap_profile,
+                    user_data.termination_drain,
                     g,
                 ),
                 g,
@@ -443,6 +670,11 @@ def sceptre_handler(sceptre_user_data):
                 lambda_fn_for_cps()
                 cps_reset_resource(user_data)
 
+        if user_data.scaling_dashboard:
+            scaling_dashboard.add_scaling_dashboard(
+                user_data, lambda_execution_role(), asgs_with_models
+            )
+
         add_export(
             "NodeSecurityGroupOutput", Sub("${EnvName}-EcsEnv-NodeSg"), Ref(node_sg)
         )
@@ -1,8 +1,8 @@
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Literal, Optional, Union
 
-from pydantic import Field, validator
+from pydantic import Field, root_validator, validator
 
-from util import BaseModel
+from util import BaseModel, model_exclusive
 
 #
 # IMPORTANT: The following classes are DATA CLASSES using pydantic.
@@ -11,6 +11,85 @@ from util import BaseModel
 #
 
 
+class WarmPoolModel(BaseModel):
+    """Keeps a pool of initialized instances next to the scaling group. When
+    the capacity provider scales out, instances are taken from the pool
+    instead of being launched and bootstrapped from scratch."""
+
+    pool_state: Literal["Stopped", "Hibernated", "Running"] = Field(
+        "Stopped",
+        description="The state of the instances while they wait in the pool.",
+        notes=[
+            """Stopped instances only incur EBS charges. `Hibernated` also
+               keeps the instance's memory, so the ECS agent is already running
+               when it resumes. Hibernation requires an instance family which
+               supports it, and the instance's memory must fit on the root
+               volume, which is encrypted when this state is used.""",
+        ],
+    )
+    min_size = Field(
+        0, description="The minimum number of instances to keep in the pool."
+    )
+    max_group_prepared_capacity: Optional[int] = Field(
+        description="""The maximum number of instances allowed in the pool and
+                       the scaling group combined.""",
+        default_description="The scaling group's `max_size`",
+    )
+    reuse_on_scale_in = Field(
+        True,
+        description="""When true, instances are returned to the pool on scale
+                       in instead of being terminated.""",
+    )
+    heartbeat_timeout_seconds = Field(
+        600,
+        description="""The number of seconds an instance has to finish
+                       initializing before the launch lifecycle hook gives up
+                       on it.""",
+        notes=[
+            """A launch lifecycle hook holds each new instance until its user
+               data has run, so instances only enter the pool fully
+               initialized. When an instance leaves the pool, the hook is held
+               until the ECS agent has registered with the cluster."""
+        ],
+    )
+
+
+class InstanceTypeModel(BaseModel):
+    node_type: str = Field(description="An EC2 instance type.")
+    weighted_capacity: Optional[int] = Field(
+        description="""The number of capacity units an instance of this type
+                       counts for in the scaling group's sizes.""",
+        default_description="Each instance counts as one unit.",
+        notes=[
+            """ECS managed scaling doesn't support instance weighting, so this
+               can only be used when `auto_scaling_enabled` is false."""
+        ],
+    )
+
+
+class InstancesDistributionModel(BaseModel):
+    on_demand_base_capacity = Field(
+        0,
+        description="""The number of instances which will always be launched as
+                       On-Demand Instances.""",
+    )
+    on_demand_percentage_above_base_capacity = Field(
+        100,
+        description="""The percentage of instances above the base which will be
+                       On-Demand Instances. The remainder are Spot
+                       Instances.""",
+    )
+    spot_allocation_strategy: Literal[
+        "capacity-optimized",
+        "capacity-optimized-prioritized",
+        "lowest-price",
+        "price-capacity-optimized",
+    ] = Field(
+        "price-capacity-optimized",
+        description="How Spot Instances are allocated across the instance types.",
+    )
+
+
 class ScalingGroupModel(BaseModel):
     allow_imds1: Optional[bool] = Field(
         description="""Allow IMDSv1 metadata service for backward-compatibility."""
@@ -19,8 +98,28 @@ class ScalingGroupModel(BaseModel):
     key_name: str = Field(
         description="The name of the SSH key to assign when creating container instances."
     )
-    node_type: str = Field(
-        description="The EC2 instance type of the container instances in this scaling group."
+    node_type: Optional[str] = Field(
+        description="The EC2 instance type of the container instances in this scaling group.",
+        notes=["Either `node_type` or `instance_types` must be specified."],
+    )
+    instance_types: Optional[List[InstanceTypeModel]] = Field(
+        description="""A list of EC2 instance types which the scaling group may
+                       launch. The group uses a mixed instances policy, so
+                       capacity can be found in another type when one is
+                       constrained, and Spot Instances may be used.""",
+        notes=[
+            """On-Demand Instances are launched in the order of this list.""",
+            """When Spot Instances are used, ECS drains container instances
+               which receive an interruption notice.""",
+            "**Warning:** A scaling group with `instance_types` can't have a `warm_pool`.",
+        ],
+    )
+    instances_distribution = Field(
+        InstancesDistributionModel(),
+        description="""The split between On-Demand and Spot Instances. This
+                       setting only applies when `instance_types` is
+                       specified.""",
+        default_description="All instances are On-Demand Instances.",
     )
     max_size: int = Field(
         description="The maximum number of container instances allowed in this scaling group."
@@ -49,6 +148,39 @@ class ScalingGroupModel(BaseModel):
             "**See also:** [AWS::ECS::Service CapacityProviderStrategyItem](https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-properties-ecs-service-capacityproviderstrategyitem.html#cfn-ecs-service-capacityproviderstrategyitem-weight)"
         ],
     )
+    min_size = Field(
+        0,
+        description="""The minimum number of container instances in this
+                       scaling group.""",
+        notes=[
+            """Raising this keeps idle capacity in the cluster so that new
+               tasks don't wait for an instance to launch."""
+        ],
+    )
+    target_capacity_percent = Field(
+        100,
+        description="""The target utilization of the scaling group's capacity
+                       provider. Values below 100 keep spare instances running
+                       so that tasks can be placed without waiting for a
+                       scale-out.""",
+        notes=[
+            "This option has no effect if `auto_scaling_enabled` is false.",
+            "**See also:** [Managed scaling](https://docs.aws.amazon.com/AmazonECS/latest/developerguide/managed-scaling-behavior.html)",
+        ],
+    )
+    instance_warmup_seconds: Optional[int] = Field(
+        description="""The number of seconds after launch before a new instance
+                       counts towards the capacity provider's metrics.""",
+        default_description="ECS uses 300 seconds.",
+    )
+    minimum_scaling_step_size: Optional[int] = Field(
+        description="The minimum number of instances added or removed at once.",
+        default_description="ECS uses 1.",
+    )
+    maximum_scaling_step_size: Optional[int] = Field(
+        description="The maximum number of instances added or removed at once.",
+        default_description="ECS uses 10000.",
+    )
     max_instance_lifetime_days: Optional[int] = Field(
         description="""The maximum amount of time, in seconds, that an instance
           can be in service. The default is null. If specified, the value must
@@ -58,6 +190,12 @@ class ScalingGroupModel(BaseModel):
     tags: Dict[str, str] = Field(
         {}, description="Tags to apply to this ASG's EC2 instances."
     )
+    warm_pool: Optional[WarmPoolModel] = Field(
+        description="Configures a warm pool of pre-initialized instances.",
+        notes=[
+            "**See Also:** [Warm pools for Amazon EC2 Auto Scaling](https://docs.aws.amazon.com/autoscaling/ec2/userguide/ec2-auto-scaling-warm-pools.html)"
+        ],
+    )
     extra_node_user_data = Field(
         "",
         description="""String to be appended to the user data of the scaling
@@ -68,6 +206,98 @@ class ScalingGroupModel(BaseModel):
         ],
     )
 
+    @root_validator
+    def node_type_or_instance_types(cls, values):
+        model_exclusive(values, "node_type", "instance_types", required=True)
+        if values.get("instance_types") == []:
+            raise ValueError("instance_types can't be empty")
+        if values.get("instance_types") and values.get("warm_pool"):
+            raise ValueError("warm_pool can't be used with instance_types")
+        if values.get("min_size", 0) > values.get("desired_size", 0):
+            raise ValueError("min_size can't be greater than desired_size")
+        return values
+
+
+class CpsResetModel(BaseModel):
+    """Controls how services are redeployed when `force_default_cps` is true
+    and the default capacity provider strategy changes."""
+
+    wave_size = Field(
+        5,
+        description="""The number of services which will be redeployed together
+                       in a single wave.""",
+    )
+    concurrency = Field(
+        5,
+        description="""The number of `UpdateService` calls which will be made in
+                       parallel when starting a wave.""",
+    )
+    wait_for_steady_state = Field(
+        True,
+        description="""When true, each wave's deployments must complete before
+                       the next wave is started.""",
+        notes=[
+            """Setting this to false starts all waves back-to-back, which is
+               faster but may overload node capacity on large clusters."""
+        ],
+    )
+    pause_on_failure = Field(
+        True,
+        description="""When true, no further waves will be started once a
+                       service fails to update or deploy. The `CpsReset`
+                       resource will then report a failure listing the affected
+                       services.""",
+    )
+    steady_state_timeout_minutes = Field(
+        20,
+        description="""The number of minutes to wait for a wave's deployments to
+                       complete before the wave's remaining services are
+                       considered failed.""",
+    )
+    poll_seconds = Field(
+        15,
+        description="The number of seconds between checks of a wave's deployments.",
+    )
+
+
+class TerminationDrainModel(BaseModel):
+    """Controls how container instances are drained before the scaling groups
+    terminate them when `auto_scaling_enabled` is false."""
+
+    batch_size = Field(
+        10,
+        description="""The maximum number of termination events which are
+                       drained together by a single state machine execution.""",
+    )
+    batching_window_seconds = Field(
+        20,
+        description="""The number of seconds to wait for more termination
+                       events before a batch is drained.""",
+        notes=["This must be at least 1 when `batch_size` is greater than 10."],
+    )
+    poll_backoff_seconds: List[int] = Field(
+        [10, 20, 40, 60],
+        description="""The number of seconds to wait between checks for running
+                       tasks on the draining instances. Each check waits for
+                       the next value in the list, and the last value is
+                       repeated.""",
+    )
+
+    @root_validator
+    def batch_limits(cls, values):
+        if not 1 <= values.get("batch_size", 1) <= 100:
+            raise ValueError("batch_size must be between 1 and 100")
+        if (
+            values.get("batch_size", 1) > 10
+            and values.get("batching_window_seconds", 0) < 1
+        ):
+            raise ValueError(
+                "batching_window_seconds must be at least 1 when batch_size is greater than 10"
+            )
+        if not values.get("poll_backoff_seconds"):
+            raise ValueError("poll_backoff_seconds can't be empty")
+        return values
+
 
 class IngressCidrModel(BaseModel):
     cidr: str = Field(description="CIDR to allow")
@@ -108,6 +338,27 @@ class UserDataModel(BaseModel):
                and note the pricing example for Container Insights."""
         ],
     )
+    bootstrap_profile: Literal["full", "deferred", "fast"] = Field(
+        "full",
+        description="Controls how much work container instances do at boot.",
+        notes=[
+            """`full` applies security upgrades and installs packages before
+               the ECS agent is configured. It also sets up the legacy
+               CloudWatch Logs agent configuration.""",
+            """`deferred` trusts the ECS-optimized AMI so the agent can
+               register immediately, then applies security upgrades in the
+               background.""",
+            """`fast` trusts the ECS-optimized AMI and doesn't upgrade
+               packages. Keep the `AmiId` parameter on the recommended AMI so
+               that nodes pick up patched images when they are replaced.""",
+            """Each node reports the seconds from boot to `UserDataStarted`,
+               `PackagesReady`, `AgentRegistered` and, for `deferred`,
+               `DeferredUpgradeFinished` as metrics in the
+               `EcsCluster/Bootstrap` namespace, with `ClusterName` and
+               `BootstrapProfile` dimensions.""",
+            "**Warning:** Changing this value will trigger the replacement of all nodes.",
+        ],
+    )
     force_default_cps = Field(
         False,
         description="""When true, changes to the `scaling_groups` will trigger
@@ -120,6 +371,50 @@ class UserDataModel(BaseModel):
                managing the capacity provider strategies for each service."""
         ],
     )
+    scaling_dashboard = Field(
+        False,
+        description="""When true, a CloudWatch dashboard of the cluster's
+                       scale-out behaviour is created.""",
+        notes=[
+            """The dashboard shows the capacity provider reservation, the
+               scaling groups' instance counts, pending tasks, the time
+               between a task being created and being placed on an instance,
+               and the time from boot to ECS agent registration for new
+               nodes.""",
+            """Time to placement is measured by a Lambda function subscribed
+               to the cluster's task state changes. It is reported as the
+               `TimeToPlacement` metric in the `EcsCluster/Scaling`
+               namespace.""",
+            "Pending tasks are only reported when `container_insights_enabled` is true.",
+        ],
+    )
+    cps_reset = Field(
+        CpsResetModel(),
+        description="""Settings for the rollout of a new default capacity
+                       provider strategy to existing services. This setting has
+                       no effect if `force_default_cps == false`.""",
+        default_description="""By default services are redeployed five at a
+                               time and each wave must reach a steady state
+                               before the next one starts.""",
+        notes=[
+            """The rollout is checkpointed. If it runs longer than the Lambda
+               timeout it continues in a new invocation. Services which
+               already use the new strategy are skipped, so a retried rollout
+               resumes where the previous one stopped."""
+        ],
+    )
+    termination_drain: Optional[TerminationDrainModel] = Field(
+        description="""Drains container instances of their tasks before the
+                       scaling groups terminate them.""",
+        notes=[
+            """Termination lifecycle events are queued and drained in batches
+               by a Step Functions state machine. All instances in a batch are
+               set to `DRAINING` together, 10 per call, and each one is released
+               for termination as soon as its tasks have stopped.""",
+            """When `auto_scaling_enabled` is true, ECS managed draining
+               already does this, so this option can't be used.""",
+        ],
+    )
     subnet_ids: List[str] = Field(
         [],
         description="""IDs of the subnets where container instances will be
@@ -141,6 +436,21 @@ class UserDataModel(BaseModel):
         {}, description="Tags to apply to all ASG EC2 instances."
     )
 
+    @root_validator
+    def managed_scaling_without_weights(cls, values):
+        if values.get("auto_scaling_enabled"):
+            for g in values.get("scaling_groups", []):
+                for t in g.instance_types or []:
+                    if t.weighted_capacity is not None:
+                        raise ValueError(
+                            "weighted_capacity can't be used with auto_scaling_enabled"
+                        )
+        if values.get("auto_scaling_enabled") and values.get("termination_drain"):
+            raise ValueError(
+                "termination_drain can't be used with auto_scaling_enabled"
+            )
+        return values
+
     @validator("ingress_cidrs", each_item=True)
     def cidrs_str_to_model(cls, v):
         if type(v) is str:
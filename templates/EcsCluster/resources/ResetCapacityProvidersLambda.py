@@ -1,6 +1,9 @@
 import boto3
 import cfnresponse
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import traceback
 
@@ -17,6 +20,15 @@ else:
 
 
 ECS = boto3.client("ecs", region_name=REGION)
+LAMBDA = boto3.client("lambda", region_name=REGION)
+
+# When less than this much time remains in the invocation, the rollout is
+# checkpointed and handed off to a fresh invocation of this function.
+HANDOFF_MARGIN_MS = 90 * 1000
+
+
+class OutOfTime(Exception):
+    pass
 
 
 def chunks(it, chunk_size):
@@ -24,6 +36,22 @@ def chunks(it, chunk_size):
     return [lst[i : i + chunk_size] for i in range(0, len(lst), chunk_size)]
 
 
+def prop_bool(v):
+    return str(v).lower() in ["true", "yes", "1"]
+
+
+def rollout_settings(event):
+    props = event.get("ResourceProperties", {})
+    return {
+        "wave_size": max(1, int(props.get("WaveSize", 5))),
+        "concurrency": max(1, int(props.get("Concurrency", 5))),
+        "wait": prop_bool(props.get("WaitForSteadyState", True)),
+        "pause_on_failure": prop_bool(props.get("PauseOnFailure", True)),
+        "timeout_secs": int(props.get("SteadyStateTimeoutMinutes", 20)) * 60,
+        "poll_secs": int(props.get("PollSeconds", 15)),
+    }
+
+
 def get_default_cps():
     return ECS.describe_clusters(clusters=[CLUSTER])["clusters"][0][
         "defaultCapacityProviderStrategy"
@@ -37,13 +65,17 @@ def get_service_arns():
             yield arn
 
 
-def get_services():
-    for chunk in chunks(get_service_arns(), 10):
+def describe_services(arns):
+    for chunk in chunks(arns, 10):
         res = ECS.describe_services(cluster=CLUSTER, services=chunk)
         for svc in res["services"]:
             yield svc
 
 
+def get_services():
+    return describe_services(get_service_arns())
+
+
 def set_cps(service_arn, cps):
     try:
         ECS.update_service(
@@ -52,21 +84,26 @@ def set_cps(service_arn, cps):
             capacityProviderStrategy=cps,
             forceNewDeployment=True,
         )
-    except:
+        return None
+    except Exception as err:
         print("Error updating CPS for service", service_arn)
         print("-----------------------------------------------------------")
         traceback.print_exc()
         print("-----------------------------------------------------------")
+        return str(err)
 
 
-def update_all_services():
-    new_cps = get_default_cps()
-    print("Updating all services to new capacityProviderStrategy:", new_cps)
+def services_to_update(new_cps, skip):
+    # Services which already have the new strategy are skipped. This makes the
+    # rollout idempotent, so a retried or resumed run picks up where the last
+    # one stopped.
     for service in get_services():
         service_name = service["serviceName"]
         old_cps = service.get("capacityProviderStrategy", [])
         sched_strat = service["schedulingStrategy"]
-        if old_cps == new_cps:
+        if service["serviceArn"] in skip:
+            print(service_name, "previously failed, skipping")
+        elif old_cps == new_cps:
             print(service_name, "already has the correct capacityProviderStrategy")
         elif sched_strat != "REPLICA":
             print(service_name, "scheduling strategy is", sched_strat, "not REPLICA")
@@ -74,7 +111,90 @@ def update_all_services():
             print(
                 f"Switching {service_name} capacityProviderStrategy from {old_cps} to {new_cps}"
             )
-            set_cps(service["serviceArn"], new_cps)
+            yield service["serviceArn"]
+
+
+def start_wave(arns, new_cps, settings):
+    with ThreadPoolExecutor(max_workers=settings["concurrency"]) as pool:
+        errors = list(pool.map(lambda arn: set_cps(arn, new_cps), arns))
+    return [arn for arn, err in zip(arns, errors) if err is not None]
+
+
+def deployment_state(service):
+    primary = [d for d in service["deployments"] if d["status"] == "PRIMARY"]
+    if len(primary) < 1:
+        return "IN_PROGRESS"
+    rollout = primary[0].get("rolloutState")
+    if rollout in ["COMPLETED", "FAILED"]:
+        return rollout
+    if len(service["deployments"]) == 1 and (
+        primary[0]["runningCount"] == primary[0]["desiredCount"]
+    ):
+        return "COMPLETED"
+    return "IN_PROGRESS"
+
+
+def wait_for_wave(arns, settings, started, time_left):
+    failed = []
+    pending = list(arns)
+    while len(pending) > 0:
+        states = {
+            s["serviceArn"]: deployment_state(s) for s in describe_services(pending)
+        }
+        failed += [a for a in pending if states.get(a) == "FAILED"]
+        pending = [a for a in pending if states.get(a, "IN_PROGRESS") == "IN_PROGRESS"]
+        if len(pending) < 1:
+            break
+        if time.time() - started > settings["timeout_secs"]:
+            print("Timed out waiting for steady state:", pending)
+            return failed + pending
+        if time_left() < HANDOFF_MARGIN_MS:
+            raise OutOfTime()
+        print(len(pending), "services still deploying")
+        time.sleep(settings["poll_secs"])
+    return failed
+
+
+def rollout(checkpoint, settings, time_left):
+    """Migrates services to the cluster's default capacity provider strategy in
+    waves. The checkpoint dict is updated in place so that it can be handed off
+    to another invocation if this one runs out of time. Returns the list of
+    services which failed to migrate."""
+    new_cps = get_default_cps()
+    print("Updating all services to new capacityProviderStrategy:", new_cps)
+    print("Rollout settings:", settings)
+
+    while True:
+        if len(checkpoint["wave"]) < 1:
+            if len(checkpoint["failed"]) > 0 and settings["pause_on_failure"]:
+                print("Pausing rollout due to failed services")
+                return checkpoint["failed"]
+            wave = list(services_to_update(new_cps, checkpoint["failed"]))
+            wave = wave[: settings["wave_size"]]
+            if len(wave) < 1:
+                return checkpoint["failed"]
+            if time_left() < HANDOFF_MARGIN_MS:
+                raise OutOfTime()
+            print("Starting wave:", wave)
+            errors = start_wave(wave, new_cps, settings)
+            checkpoint["failed"] += errors
+            checkpoint["wave"] = [a for a in wave if a not in errors]
+            checkpoint["wave_started"] = time.time()
+
+        if settings["wait"]:
+            checkpoint["failed"] += wait_for_wave(
+                checkpoint["wave"], settings, checkpoint["wave_started"], time_left
+            )
+        checkpoint["wave"] = []
+
+
+def hand_off(event, context, checkpoint):
+    print("Handing off rollout to a new invocation with checkpoint:", checkpoint)
+    LAMBDA.invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps({**event, "Checkpoint": checkpoint}),
+    )
 
 
 def print_response(
@@ -97,13 +217,25 @@ def lambda_handler(event, context):
     if context is None:
         # We're in a test environment
         res_fn = print_response
+        time_left = lambda: HANDOFF_MARGIN_MS * 10
     else:
         res_fn = partial(cfnresponse.send, event, context)
+        time_left = context.get_remaining_time_in_millis
 
+    checkpoint = event.get("Checkpoint", {"wave": [], "failed": []})
     try:
         if rt in ["Create", "Update"]:
-            update_all_services()
+            failed = rollout(checkpoint, rollout_settings(event), time_left)
+            if len(failed) > 0:
+                res_fn(
+                    cfnresponse.FAILED,
+                    {},
+                    reason=f"Failed to migrate services: {', '.join(failed)}",
+                )
+                return
         res_fn(cfnresponse.SUCCESS, {})
+    except OutOfTime:
+        hand_off(event, context, checkpoint)
     except Exception as err:
         traceback.print_exc()
         res_fn(cfnresponse.FAILED, {}, reason=str(err))
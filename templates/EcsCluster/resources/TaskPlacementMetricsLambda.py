@@ -0,0 +1,53 @@
+import boto3
+import os
+from datetime import datetime
+
+CLUSTER = "${EnvName}"
+REGION = "${AWS::Region}"
+
+# Check if we're in a test environment, and if so set the region from the
+# environment or use a default.
+if "AWS::Region" in REGION:
+    REGION = os.environ.get("AWS_DEFAULT_REGION", "us-east-1")
+    print("Test environment detected, setting REGION to", REGION)
+
+CLOUDWATCH = boto3.client("cloudwatch", region_name=REGION)
+
+NAMESPACE = "EcsCluster/Scaling"
+
+
+def parse_time(ts):
+    fmt = "%Y-%m-%dT%H:%M:%S.%f%z" if "." in ts else "%Y-%m-%dT%H:%M:%S%z"
+    return datetime.strptime(ts, fmt)
+
+
+def time_to_placement(detail):
+    """Returns the number of seconds between a task being created and it being
+    placed on a container instance. Image pulls only start once a task has been
+    placed, so pullStartedAt is used when present."""
+    created = detail.get("createdAt")
+    placed = detail.get("pullStartedAt") or detail.get("startedAt")
+    if not created or not placed:
+        return None
+    return (parse_time(placed) - parse_time(created)).total_seconds()
+
+
+def lambda_handler(event, context):
+    detail = event["detail"]
+    secs = time_to_placement(detail)
+    if secs is None:
+        print("Task has not been placed:", detail.get("taskArn"))
+        return
+
+    print("Task", detail.get("taskArn"), "was placed after", secs, "seconds")
+    CLOUDWATCH.put_metric_data(
+        Namespace=NAMESPACE,
+        MetricData=[
+            {
+                "MetricName": "TimeToPlacement",
+                "Dimensions": [{"Name": "ClusterName", "Value": CLUSTER}],
+                "Value": secs,
+                "Unit": "Seconds",
+            }
+        ],
+    )
@@ -0,0 +1,175 @@
+import json
+
+from troposphere import GetAtt, Ref, Sub
+from troposphere.awslambda import Code, Function, Permission
+from troposphere.cloudwatch import Dashboard
+from troposphere.ecs import CapacityProvider
+from troposphere.events import Rule, Target
+
+from util import TEMPLATE, add_resource, read_resource
+
+PERIOD = 60
+
+
+def placement_metrics_fn(role):
+    return add_resource(
+        Function(
+            "LambdaFunctionForPlacementMetrics",
+            Description="Reports the time it takes to place tasks in the cluster",
+            Handler="index.lambda_handler",
+            Role=GetAtt(role, "Arn"),
+            Runtime="python3.9",
+            MemorySize=128,
+            Timeout=30,
+            Code=Code(ZipFile=Sub(read_resource("TaskPlacementMetricsLambda.py"))),
+        )
+    )
+
+
+def task_running_rule(fn):
+    rule = add_resource(
+        Rule(
+            "TaskRunningRule",
+            Description="Triggers when a task in the cluster starts running",
+            EventPattern={
+                "source": ["aws.ecs"],
+                "detail-type": ["ECS Task State Change"],
+                "detail": {
+                    "clusterArn": [GetAtt("EcsCluster", "Arn")],
+                    "lastStatus": ["RUNNING"],
+                    "desiredStatus": ["RUNNING"],
+                },
+            },
+            Targets=[Target(Arn=GetAtt(fn, "Arn"), Id="PlacementMetrics")],
+        )
+    )
+    add_resource(
+        Permission(
+            "TaskRunningRulePermission",
+            Action="lambda:InvokeFunction",
+            FunctionName=Ref(fn),
+            Principal="events.amazonaws.com",
+            SourceArn=GetAtt(rule, "Arn"),
+        )
+    )
+    return rule
+
+
+def metric_widget(title, metrics, y, stat="Average", annotations=None):
+    properties = {
+        "title": title,
+        "view": "timeSeries",
+        "region": "${AWS::Region}",
+        "period": PERIOD,
+        "stat": stat,
+        "metrics": metrics,
+    }
+    if annotations:
+        properties["annotations"] = {"horizontal": annotations}
+    return {
+        "type": "metric",
+        "x": 0,
+        "y": y,
+        "width": 24,
+        "height": 6,
+        "properties": properties,
+    }
+
+
+def dashboard_body(user_data, asgs_with_models):
+    """Returns the dashboard body along with the variables it needs substituted.
+    Capacity providers and scaling groups are referenced as ${CpN} and ${AsgN}
+    since their names are only known once they're created."""
+    cps = [o for o in TEMPLATE.resources.values() if type(o) is CapacityProvider]
+    variables = {}
+    for i, cp in enumerate(cps):
+        variables[f"Cp{i}"] = Ref(cp)
+    for i, (asg, _) in enumerate(asgs_with_models):
+        variables[f"Asg{i}"] = Ref(asg)
+
+    targets = sorted({m.target_capacity_percent for _, m in asgs_with_models})
+    widgets = [
+        metric_widget(
+            "Capacity provider reservation",
+            [
+                [
+                    "AWS/ECS/ManagedScaling",
+                    "CapacityProviderReservation",
+                    "ClusterName",
+                    "${EnvName}",
+                    "CapacityProviderName",
+                    "${Cp%d}" % i,
+                ]
+                for i in range(len(cps))
+            ],
+            0,
+            annotations=[{"label": "Target", "value": t} for t in targets],
+        ),
+        metric_widget(
+            "Container instances",
+            [
+                ["AWS/AutoScaling", metric, "AutoScalingGroupName", "${Asg%d}" % i]
+                for i in range(len(asgs_with_models))
+                for metric in [
+                    "GroupDesiredCapacity",
+                    "GroupInServiceInstances",
+                    "GroupPendingInstances",
+                ]
+            ],
+            6,
+        ),
+        metric_widget(
+            "Pending tasks",
+            [
+                [
+                    "ECS/ContainerInsights",
+                    "PendingTaskCount",
+                    "ClusterName",
+                    "${EnvName}",
+                ]
+            ],
+            12,
+            stat="Maximum",
+        ),
+        metric_widget(
+            "Time to placement (seconds)",
+            [
+                [
+                    "EcsCluster/Scaling",
+                    "TimeToPlacement",
+                    "ClusterName",
+                    "${EnvName}",
+                    {"stat": stat, "label": stat},
+                ]
+                for stat in ["p50", "p90", "Maximum"]
+            ]
+            + [
+                [
+                    "EcsCluster/Bootstrap",
+                    "AgentRegistered",
+                    "ClusterName",
+                    "${EnvName}",
+                    "BootstrapProfile",
+                    user_data.bootstrap_profile,
+                    {"stat": "Average", "label": "Node boot to agent registered"},
+                ]
+            ],
+            18,
+        ),
+    ]
+    # Capacity providers only exist when auto-scaling is enabled, and a widget
+    # without metrics is rejected.
+    widgets = [w for w in widgets if len(w["properties"]["metrics"]) > 0]
+    return json.dumps({"widgets": widgets}), variables
+
+
+def add_scaling_dashboard(user_data, role, asgs_with_models):
+    task_running_rule(placement_metrics_fn(role))
+    body, variables = dashboard_body(user_data, asgs_with_models)
+    return add_resource(
+        Dashboard(
+            "ScalingDashboard",
+            DashboardName=Sub("${EnvName}-ecs-scaling"),
+            DashboardBody=Sub(body, **variables),
+        )
+    )
@@ -1,13 +1,16 @@
 import json
 
 import troposphere
-from troposphere import GetAtt, Parameter, Ref, Sub, Tags
+import yaml
+from troposphere import GetAtt, ImportValue, Parameter, Ref, Sub, Tags
 from troposphere.awslambda import Code, Function, Permission
 from troposphere.cloudformation import AWSCustomObject
 from troposphere.ecs import (
+    AuthorizationConfig,
     AwsvpcConfiguration,
     ContainerDefinition,
     ContainerDependency,
+    DeploymentCircuitBreaker,
     DeploymentConfiguration,
     EFSVolumeConfiguration,
     Environment,
@@ -41,6 +44,14 @@ from troposphere.elasticloadbalancingv2 import (
 from troposphere.events import Rule as EventRule
 from troposphere.events import Target as EventTarget
 from troposphere.iam import Policy, Role
+from troposphere.logs import LogGroup
+from troposphere.scheduler import FlexibleTimeWindow
+from troposphere.scheduler import Schedule as SchedulerSchedule
+from troposphere.scheduler import Target as SchedulerTarget
+from troposphere.stepfunctions import CloudWatchLogsLogGroup as SmLogGroup
+from troposphere.stepfunctions import LogDestination as SmLogDest
+from troposphere.stepfunctions import LoggingConfiguration as SmLoggingConf
+from troposphere.stepfunctions import StateMachine
 
 import elb
 
@@ -49,6 +60,7 @@ if int(troposphere.__version__.split(".")[0]) > 3:
 else:
     from troposphere.elasticloadbalancingv2 import Action as ListenerRuleAction
 
+import autoscaling
 import autostop
 import model
 from security_group import security_group
@@ -160,7 +172,21 @@ def execution_role_secret_statement(secret_arn):
         }
 
 
-def execution_role(secret_arns):
+def execution_role_efs_statement(fs_ids):
+    return {
+        "Action": ["elasticfilesystem:ClientMount", "elasticfilesystem:ClientWrite"],
+        "Resource": [
+            Sub(
+                "arn:aws:elasticfilesystem:${AWS::Region}:${AWS::AccountId}:file-system/%s"
+                % fs_id
+            )
+            for fs_id in fs_ids
+        ],
+        "Effect": "Allow",
+    }
+
+
+def execution_role(secret_arns, efs_iam_fs_ids=None):
     policies = [
         Policy(
             PolicyName="root",
@@ -193,6 +219,18 @@ def execution_role(secret_arns):
                 },
             )
         )
+    if efs_iam_fs_ids:
+        # Volumes mounted with IAM authorization use the task role, which is
+        # this role when the template creates it.
+        policies.append(
+            Policy(
+                PolicyName="efs",
+                PolicyDocument={
+                    "Version": "2012-10-17",
+                    "Statement": [execution_role_efs_statement(efs_iam_fs_ids)],
+                },
+            )
+        )
     return add_resource(
         Role(
             "TaskExecutionRole",
@@ -251,6 +289,103 @@ def lambda_fn_for_codebuild():
     )
 
 
+def image_build_state_machine_role():
+    return add_resource_once(
+        "ImageBuildStateMachineRole",
+        lambda name: Role(
+            name,
+            Policies=[
+                Policy(
+                    PolicyName="states-inline",
+                    PolicyDocument={
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": [
+                                    "codebuild:StartBuild",
+                                    "codebuild:StopBuild",
+                                    "codebuild:BatchGetBuilds",
+                                    "logs:CreateLogDelivery",
+                                    "logs:GetLogDelivery",
+                                    "logs:UpdateLogDelivery",
+                                    "logs:DeleteLogDelivery",
+                                    "logs:ListLogDeliveries",
+                                    "logs:PutResourcePolicy",
+                                    "logs:DescribeResourcePolicies",
+                                    "logs:DescribeLogGroups",
+                                ],
+                                "Resource": "*",
+                            },
+                            {
+                                "Effect": "Allow",
+                                "Action": [
+                                    "events:PutTargets",
+                                    "events:PutRule",
+                                    "events:DescribeRule",
+                                ],
+                                "Resource": Sub(
+                                    "arn:${AWS::Partition}:events:${AWS::Region}:${AWS::AccountId}:rule/StepFunctionsGetEventForCodeBuildStartBuildRule"
+                                ),
+                            },
+                            {
+                                "Effect": "Allow",
+                                "Action": ["lambda:InvokeFunction"],
+                                "Resource": GetAtt("LambdaFunctionForCodeBuild", "Arn"),
+                            },
+                        ],
+                    },
+                )
+            ],
+            AssumeRolePolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [
+                    {
+                        "Effect": "Allow",
+                        "Principal": {"Service": ["states.amazonaws.com"]},
+                        "Action": ["sts:AssumeRole"],
+                    }
+                ],
+            },
+            ManagedPolicyArns=[],
+            Path="/",
+        ),
+    )
+
+
+def image_build_log_group():
+    return add_resource_once(
+        "ImageBuildStateMachineLogGroup", lambda name: LogGroup(name, RetentionInDays=7)
+    )
+
+
+def image_build_state_machine():
+    # The CodeBuild Lambda looks this resource up by its logical ID, so the name
+    # must match STATE_MACHINE_LOGICAL_ID in CodeBuildResourceLambda.py.
+    return add_resource_once(
+        "ImageBuildStateMachine",
+        lambda name: StateMachine(
+            name,
+            Definition=yaml.safe_load(read_resource("ImageBuildStateMachine.yaml")),
+            DefinitionSubstitutions={
+                "lambda_arn": GetAtt("LambdaFunctionForCodeBuild", "Arn")
+            },
+            RoleArn=GetAtt(image_build_state_machine_role(), "Arn"),
+            LoggingConfiguration=SmLoggingConf(
+                Level="ERROR",
+                IncludeExecutionData=False,
+                Destinations=[
+                    SmLogDest(
+                        CloudWatchLogsLogGroup=SmLogGroup(
+                            LogGroupArn=GetAtt(image_build_log_group(), "Arn")
+                        )
+                    )
+                ],
+            ),
+        ),
+    )
+
+
 class ImageBuild(AWSCustomObject):
     resource_type = "Custom::ImageBuild"
     props = {
@@ -258,18 +393,30 @@ class ImageBuild(AWSCustomObject):
         "ProjectName": (str, True),
         "EnvironmentVariablesOverride": (list, False),
         "RepositoryName": (str, False),
+        "ImageTagVariable": (str, False),
+        "ImageTag": (str, False),
+        "BuildCache": (bool, False),
+        "ForceRebuild": (bool, False),
     }
 
 
 def image_build(container_name, build):
     lambda_fn_for_codebuild()
+    state_machine = image_build_state_machine()
     return add_resource(
         ImageBuild(
             "ImageBuildFor{}".format(container_name),
+            DependsOn=[state_machine.title],
             ServiceToken=GetAtt("LambdaFunctionForCodeBuild", "Arn"),
             ProjectName=build.codebuild_project_name,
             EnvironmentVariablesOverride=[v.dict() for v in build.env_vars],
             RepositoryName=build.ecr_repo_name,
+            **opts_with(
+                ImageTagVariable=build.image_tag_variable,
+                ImageTag=build.image_tag,
+                BuildCache=build.build_cache or None,
+                ForceRebuild=build.force_rebuild or None,
+            ),
         )
     )
 
@@ -349,15 +496,35 @@ def container_def(hostname, container):
     )
 
 
+def efs_authorization_config(v):
+    access_point_id = v.access_point_id
+    if v.access_point_export_name:
+        access_point_id = ImportValue(v.access_point_export_name)
+    opts = opts_with(
+        AccessPointId=access_point_id,
+        IAM="ENABLED" if v.iam_authorization else None,
+    )
+    return AuthorizationConfig(**opts) if opts else None
+
+
 def efs_volume(v):
     return Volume(
         Name=v.name,
         EFSVolumeConfiguration=EFSVolumeConfiguration(
-            FilesystemId=v.fs_id, **opts_with(RootDirectory=v.root_directory)
+            FilesystemId=v.fs_id,
+            **opts_with(
+                RootDirectory=v.root_directory,
+                TransitEncryption="ENABLED" if v.transit_encryption else None,
+                AuthorizationConfig=efs_authorization_config(v),
+            ),
         ),
     )
 
 
+def efs_iam_fs_ids(user_data):
+    return sorted({v.fs_id for v in user_data.efs_volumes if v.iam_authorization})
+
+
 def host_volume(v):
     return Volume(Name=v.name, Host=HostVolumeConfiguration(SourcePath=v.source_path))
 
@@ -375,7 +542,7 @@ def task_def(user_data, container_defs, exec_role):
     ]
 
     task_role_arn = user_data.execution_role_arn
-    if user_data.enable_execute_command:
+    if user_data.enable_execute_command or efs_iam_fs_ids(user_data):
         task_role_arn = task_role_arn or Ref(exec_role)
 
     return add_resource(
@@ -400,6 +567,22 @@ def task_def(user_data, container_defs, exec_role):
     )
 
 
+def profile_health_check(health_check, profile):
+    """Fills in the health check settings which weren't set explicitly from the
+    deployment profile."""
+    if not profile:
+        return health_check
+    values = {
+        "interval_seconds": profile.health_check_interval_seconds,
+        "timeout_seconds": profile.health_check_timeout_seconds,
+        "healthy_threshold_count": profile.healthy_threshold_count,
+        "unhealthy_threshold_count": profile.unhealthy_threshold_count,
+    }
+    return health_check.copy(
+        update={k: v for k, v in values.items() if k not in health_check.__fields_set__}
+    )
+
+
 def target_group(
     target_type,
     protocol,
@@ -408,6 +591,7 @@ def target_group(
     default_health_check_path,
     port=None,
     rule_path=None,
+    profile=None,
 ):
     if not health_check:
         health_check = model.HealthCheckModel()
@@ -415,12 +599,19 @@ def target_group(
         health_check.path = default_health_check_path
     if not rule_path:
         rule_path = health_check.path
+    health_check = profile_health_check(health_check, profile)
     attrs = target_group_props.attributes
 
     if "stickiness.enabled" not in attrs:
         attrs["stickiness.enabled"] = "true"
     if "stickiness.type" not in attrs:
         attrs["stickiness.type"] = "lb_cookie"
+    if profile:
+        attrs.setdefault(
+            "deregistration_delay.timeout_seconds",
+            str(profile.deregistration_delay_seconds),
+        )
+        attrs.setdefault("slow_start.duration_seconds", str(profile.slow_start_seconds))
 
     title = clean_title(
         f"TargetGroupPORT{port}HC{rule_path}" if port else f"TargetGroupFOR{rule_path}"
@@ -508,7 +699,7 @@ def service_network_configuration(user_data):
     )
 
 
-def service(user_data, listener_rules, lb_mappings):
+def service(user_data, listener_rules, lb_mappings, profile):
     return add_resource(
         Service(
             "Service",
@@ -521,6 +712,12 @@ def service(user_data, listener_rules, lb_mappings):
             DeploymentConfiguration=DeploymentConfiguration(
                 MaximumPercent=Ref("MaximumPercent"),
                 MinimumHealthyPercent=Ref("MinimumHealthyPercent"),
+                **opts_with(
+                    DeploymentCircuitBreaker=(
+                        profile,
+                        lambda _: DeploymentCircuitBreaker(Enable=True, Rollback=True),
+                    )
+                ),
             ),
             LoadBalancers=lb_mappings,
             **opts_with(
@@ -561,8 +758,16 @@ def lambda_execution_role():
                                     "ecr:DescribeImages",
                                     "ecr:DescribeRepositories",
                                     "ecr:ListImages",
+                                    "ecr:BatchGetImage",
+                                    "ecr:PutImage",
                                     "codebuild:StartBuild",
                                     "codebuild:BatchGetBuilds",
+                                    "codebuild:ListBuildsForProject",
+                                    "codebuild:BatchGetProjects",
+                                    "codecommit:GetBranch",
+                                    "codecommit:GetRepository",
+                                    "cloudformation:DescribeStackResource",
+                                    "states:StartExecution",
                                     "ecs:UpdateService",
                                 ],
                                 "Resource": "*",
@@ -635,6 +840,75 @@ def scheduling_rule(rule_props):
     )
 
 
+def scheduler_role():
+    return add_resource_once(
+        "SchedulerRole",
+        lambda name: Role(
+            name,
+            Policies=[
+                Policy(
+                    PolicyName="scheduler-inline",
+                    PolicyDocument={
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {
+                                "Effect": "Allow",
+                                "Action": ["ecs:UpdateService"],
+                                "Resource": Ref("Service"),
+                            }
+                        ],
+                    },
+                )
+            ],
+            AssumeRolePolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [
+                    {
+                        "Effect": "Allow",
+                        "Principal": {"Service": ["scheduler.amazonaws.com"]},
+                        "Action": ["sts:AssumeRole"],
+                        "Condition": {
+                            "StringEquals": {"aws:SourceAccount": Ref("AWS::AccountId")}
+                        },
+                    }
+                ],
+            },
+            ManagedPolicyArns=[],
+            Path="/",
+        ),
+    )
+
+
+def scheduler_schedule(schedule_props):
+    # Uses the EventBridge Scheduler universal target to call ecs:UpdateService
+    # without a Lambda function in between.
+    cron_expr = schedule_props.cron
+    schedule_hash = md5(cron_expr)[:7]
+
+    return add_resource(
+        SchedulerSchedule(
+            "Schedule" + schedule_hash,
+            ScheduleExpression="cron(%s)" % cron_expr,
+            Description=schedule_props.description,
+            FlexibleTimeWindow=FlexibleTimeWindow(Mode="OFF"),
+            Target=SchedulerTarget(
+                Arn="arn:aws:scheduler:::aws-sdk:ecs:updateService",
+                RoleArn=GetAtt(scheduler_role(), "Arn"),
+                Input=Sub(
+                    json.dumps(
+                        {
+                            "Cluster": "${ClusterArn}",
+                            "Service": "${Service}",
+                            "DesiredCount": schedule_props.desired_count,
+                        }
+                    )
+                ),
+            ),
+            **opts_with(ScheduleExpressionTimezone=schedule_props.timezone),
+        )
+    )
+
+
 def sceptre_handler(sceptre_user_data):
     add_params(TEMPLATE)
 
@@ -644,10 +918,20 @@ def sceptre_handler(sceptre_user_data):
 
     user_data = model.UserDataModel(**sceptre_user_data)
 
+    profile = None
+    if user_data.deployment_profile:
+        profile = model.DEPLOYMENT_PROFILES[user_data.deployment_profile]
+        # Parameters given in the stack config still take precedence.
+        TEMPLATE.parameters["MaximumPercent"].Default = str(profile.maximum_percent)
+        TEMPLATE.parameters["MinimumHealthyPercent"].Default = str(
+            profile.minimum_healthy_percent
+        )
+
     # If we're using secrets, we need to define an execution role
     secret_arns = [v for c in user_data.containers for k, v in c.secrets.items()]
-    if len(secret_arns) > 0 or user_data.launch_type == "FARGATE":
-        exec_role = execution_role(secret_arns)
+    iam_fs_ids = efs_iam_fs_ids(user_data)
+    if len(secret_arns) > 0 or user_data.launch_type == "FARGATE" or iam_fs_ids:
+        exec_role = execution_role(secret_arns, iam_fs_ids)
     else:
         exec_role = None
 
@@ -683,6 +967,7 @@ def sceptre_handler(sceptre_user_data):
                                 f"{rule.path}/",
                                 port=rule.container_port or default_port,
                                 rule_path=rule.path,
+                                profile=profile,
                             )
                         )
                     lb_mappings.append(
@@ -705,6 +990,7 @@ def sceptre_handler(sceptre_user_data):
                             c.target_group,
                             "%s/" % c.rules[0].path,
                             rule_path=rule.path,
+                            profile=profile,
                         )
                         target_group_arn = Ref(default_tg)
                     tg_arn = Ref(default_tg)
@@ -731,11 +1017,18 @@ def sceptre_handler(sceptre_user_data):
         user_data,
         listener_rules,
         lb_mappings,
+        profile,
     )
     add_output("EcsServiceArn", Ref(svc))
 
     schedule = user_data.schedule
-    if len(schedule) > 0:
+    if user_data.auto_scaling:
+        # Scheduled changes become scheduled actions on the scalable target.
+        autoscaling.add_auto_scaling(user_data, TEMPLATE)
+    elif len(schedule) > 0 and user_data.eventbridge_scheduler:
+        for p in schedule:
+            scheduler_schedule(p)
+    elif len(schedule) > 0:
         lambda_execution_role()
         scheduling_lambda()
         for p in schedule:
@@ -0,0 +1,174 @@
+from troposphere import GetAtt, Join, Ref, Select, Split
+from troposphere.applicationautoscaling import (
+    PredefinedMetricSpecification,
+    ScalableTarget,
+    ScalableTargetAction,
+    ScalingPolicy,
+    ScheduledAction,
+    StepAdjustment,
+    StepScalingPolicyConfiguration,
+    TargetTrackingScalingPolicyConfiguration,
+)
+from troposphere.cloudwatch import Alarm, MetricDimension
+from troposphere.elasticloadbalancingv2 import ListenerRule, TargetGroup
+
+from util import add_resource, md5, opts_with
+
+SERVICE_NAMESPACE = "ecs"
+SCALABLE_DIMENSION = "ecs:service:DesiredCount"
+
+
+def service_resource_id():
+    # The service's ARN ends in "service/<cluster>/<service>", which is the
+    # resource ID Application Auto Scaling expects. The ClusterArn parameter
+    # may be a name, so the cluster is always taken from the service ARN.
+    return Select(5, Split(":", Ref("Service")))
+
+
+def cluster_name():
+    return Select(1, Split("/", Ref("Service")))
+
+
+def alb_resource_label(template):
+    """Returns the ResourceLabel for ALBRequestCountPerTarget, which has the form
+    app/<lb-name>/<lb-id>/targetgroup/<tg-name>/<tg-id>. The load balancer part
+    is taken from the ARN of the listener of the first rule which forwards to a
+    target group created by this template."""
+    tg_names = [n for n, o in template.resources.items() if type(o) is TargetGroup]
+    for rule in [o for o in template.resources.values() if type(o) is ListenerRule]:
+        tg_arn = rule.Actions[0].properties.get("TargetGroupArn")
+        if isinstance(tg_arn, Ref) and tg_arn.data["Ref"] in tg_names:
+            listener_parts = Split("/", rule.ListenerArn)
+            return Join(
+                "/",
+                [
+                    Select(1, listener_parts),
+                    Select(2, listener_parts),
+                    Select(3, listener_parts),
+                    GetAtt(tg_arn.data["Ref"], "TargetGroupFullName"),
+                ],
+            )
+    raise ValueError(
+        "ALBRequestCountPerTarget requires a target group created by this template."
+    )
+
+
+def scheduled_action(schedule_props, max_capacity):
+    desired = schedule_props.desired_count
+    min_cap = schedule_props.min_capacity
+    max_cap = schedule_props.max_capacity
+    if min_cap is None:
+        min_cap = desired
+    if max_cap is None:
+        # Scheduling zero tasks should stop the service, otherwise the schedule
+        # raises the floor and leaves the ceiling where auto scaling wants it.
+        max_cap = max(desired, max_capacity) if desired > 0 else 0
+
+    return ScheduledAction(
+        ScheduledActionName="Schedule" + md5(schedule_props.cron)[:7],
+        Schedule=f"cron({schedule_props.cron})",
+        ScalableTargetAction=ScalableTargetAction(
+            MinCapacity=min_cap, MaxCapacity=max_cap
+        ),
+        **opts_with(Timezone=schedule_props.timezone),
+    )
+
+
+def scalable_target(auto_scaling, schedule):
+    return add_resource(
+        ScalableTarget(
+            "ScalableTarget",
+            MinCapacity=auto_scaling.min_capacity,
+            MaxCapacity=auto_scaling.max_capacity,
+            ResourceId=service_resource_id(),
+            ScalableDimension=SCALABLE_DIMENSION,
+            ServiceNamespace=SERVICE_NAMESPACE,
+            **opts_with(
+                ScheduledActions=[
+                    scheduled_action(s, auto_scaling.max_capacity) for s in schedule
+                ]
+            ),
+        )
+    )
+
+
+def target_tracking_policy(target, policy, resource_label):
+    metric_hash = md5(policy.metric, str(policy.target_value))[:7]
+    return add_resource(
+        ScalingPolicy(
+            "TargetTrackingPolicy" + metric_hash,
+            PolicyName=f"{policy.metric}-{policy.target_value}",
+            PolicyType="TargetTrackingScaling",
+            ScalingTargetId=Ref(target),
+            TargetTrackingScalingPolicyConfiguration=TargetTrackingScalingPolicyConfiguration(
+                PredefinedMetricSpecification=PredefinedMetricSpecification(
+                    PredefinedMetricType=policy.metric,
+                    **opts_with(ResourceLabel=resource_label),
+                ),
+                TargetValue=policy.target_value,
+                ScaleInCooldown=policy.scale_in_cooldown_seconds,
+                ScaleOutCooldown=policy.scale_out_cooldown_seconds,
+                DisableScaleIn=policy.disable_scale_in,
+            ),
+        )
+    )
+
+
+def step_scaling_policy(target, policy):
+    policy_hash = md5(policy.metric, policy.comparison, str(policy.threshold))[:7]
+    scaling_policy = add_resource(
+        ScalingPolicy(
+            "StepScalingPolicy" + policy_hash,
+            PolicyName=f"{policy.metric}-{policy.comparison}-{policy.threshold}",
+            PolicyType="StepScaling",
+            ScalingTargetId=Ref(target),
+            StepScalingPolicyConfiguration=StepScalingPolicyConfiguration(
+                AdjustmentType="ChangeInCapacity",
+                Cooldown=policy.cooldown_seconds,
+                MetricAggregationType="Average",
+                StepAdjustments=[
+                    StepAdjustment(
+                        ScalingAdjustment=s.adjustment,
+                        **opts_with(
+                            MetricIntervalLowerBound=s.lower_bound,
+                            MetricIntervalUpperBound=s.upper_bound,
+                        ),
+                    )
+                    for s in policy.steps
+                ],
+            ),
+        )
+    )
+    add_resource(
+        Alarm(
+            "StepScalingAlarm" + policy_hash,
+            AlarmDescription=f"Scales the service when {policy.metric} is {policy.comparison} {policy.threshold}",
+            Namespace="AWS/ECS",
+            MetricName=policy.metric,
+            Dimensions=[
+                MetricDimension(Name="ClusterName", Value=cluster_name()),
+                MetricDimension(Name="ServiceName", Value=GetAtt("Service", "Name")),
+            ],
+            Statistic="Average",
+            Period=policy.period_seconds,
+            EvaluationPeriods=policy.evaluation_periods,
+            Threshold=policy.threshold,
+            ComparisonOperator=policy.comparison,
+            AlarmActions=[Ref(scaling_policy)],
+        )
+    )
+    return scaling_policy
+
+
+def add_auto_scaling(user_data, template):
+    auto_scaling = user_data.auto_scaling
+    target = scalable_target(auto_scaling, user_data.schedule)
+
+    for policy in auto_scaling.target_tracking:
+        resource_label = None
+        if policy.metric == "ALBRequestCountPerTarget":
+            resource_label = alb_resource_label(template)
+        target_tracking_policy(target, policy, resource_label)
+
+    for policy in auto_scaling.step_scaling:
+        step_scaling_policy(target, policy)
@@ -8,6 +8,7 @@ from troposphere.awslambda import (
     Function,
     Permission,
 )
+from troposphere.ecs import TaskDefinition
 from troposphere.elasticloadbalancingv2 import (
     Condition,
     ListenerRule,
@@ -127,6 +128,7 @@ def starter_execution_policy(rule_names):
                             "elasticloadbalancing:DescribeRules",
                             "elasticloadbalancing:DescribeTargetHealth",
                             "cloudwatch:GetMetricStatistics",
+                            "cloudwatch:PutMetricData",
                         ],
                         "Resource": "*",
                     },
@@ -163,11 +165,17 @@ def add_starter_log_group():
     )
 
 
-def add_starter_state_machine(rules):
+def add_starter_state_machine(rules, waiter_rules):
     d = yaml.safe_load(read_resource("StartStateMachine.yaml"))
+    # Each waiter rule is restored once the target group of the rule it
+    # stands in for has a healthy target.
     d["States"]["RuleData"]["Result"]["rules"] = [
-        {"arn": Ref(r), "conditions": r.to_dict()["Properties"]["Conditions"]}
-        for r in rules
+        {
+            "arn": Ref(w),
+            "conditions": w.to_dict()["Properties"]["Conditions"],
+            "target_group_arn": r.Actions[0].TargetGroupArn,
+        }
+        for r, w in zip(rules, waiter_rules)
     ]
     return add_resource_once(
         "StarterStateMachine",
@@ -378,7 +386,18 @@ def add_stopper_invoke_permission(fn):
     )
 
 
-def add_stopper_scheduling_rule(as_conf, tg_names, rule_names):
+def add_idle_task_def(as_conf, template):
+    """Creates a copy of the service's task definition with the smaller
+    task-level size used while the service is idle."""
+    props = {
+        **template.resources["TaskDef"].properties,
+        "Family": Sub("${AWS::StackName}-idle"),
+    }
+    props.update(opts_with(Cpu=as_conf.idle_cpu, Memory=as_conf.idle_memory))
+    return add_resource(TaskDefinition("IdleTaskDef", **props))
+
+
+def add_stopper_scheduling_rule(as_conf, tg_names, rule_names, idle_task_def):
     return add_resource(
         EventRule(
             "AutoStopScheduleRule",
@@ -394,7 +413,11 @@ def add_stopper_scheduling_rule(as_conf, tg_names, rule_names):
                             "target_group_names": ["${tg_names}"],
                             "rule_arns": ["${rule_arns}"],
                             "waiter_tg_arn": "${waiter_tg_arn}",
-                            "rule_skipper_key": "${rule_skipper_key}"
+                            "rule_skipper_key": "${rule_skipper_key}",
+                            "desired_count": ${DesiredCount},
+                            "task_definition": "${TaskDef}",
+                            "idle_desired_count": ${idle_desired_count},
+                            "idle_task_definition": "${idle_task_definition}"
                         }""",
                         idle_minutes=as_conf.idle_minutes,
                         tg_names=Join(
@@ -403,6 +426,10 @@ def add_stopper_scheduling_rule(as_conf, tg_names, rule_names):
                         rule_arns=Join('","', [Ref(n) for n in rule_names]),
                         waiter_tg_arn=Ref("AutoStopWaiterTg"),
                         rule_skipper_key=as_conf.waiter_rule.query_string_key,
+                        idle_desired_count=as_conf.idle_desired_count,
+                        idle_task_definition=(
+                            Ref(idle_task_def) if idle_task_def else ""
+                        ),
                     ),
                 )
             ],
@@ -468,15 +495,19 @@ def add_autostop(user_data, template):
 
     starter_execution_role()
     starter_execution_policy(rule_names)
-    starter = add_starter_state_machine(waiter_rules)
+    starter = add_starter_state_machine(rules, waiter_rules)
     add_output("StarterStateMachineArn", Ref(starter))
 
+    idle_task_def = None
+    if user_data.auto_stop.idle_cpu or user_data.auto_stop.idle_memory:
+        idle_task_def = add_idle_task_def(user_data.auto_stop, template)
+
     add_stopper_execution_role()
     stopper_fn = add_stopper_lambda(user_data.auto_stop)
     add_stopper_invoke_permission(stopper_fn)
 
     schedule_rule = add_stopper_scheduling_rule(
-        user_data.auto_stop, tg_names, waiter_rule_names
+        user_data.auto_stop, tg_names, waiter_rule_names, idle_task_def
     )
     add_output("StopperScheduleRuleName", Ref(schedule_rule))
 
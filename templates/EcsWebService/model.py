@@ -1,10 +1,11 @@
+import math
 from typing import Dict, List, Union, Optional, Literal
 from functools import reduce
 
 from pydantic import Field, validator, root_validator
 
 from security_group import SecurityGroupModel
-from util import BaseModel
+from util import BaseModel, model_exclusive
 
 
 class PlacementStrategyModel(BaseModel):
@@ -25,6 +26,52 @@ class EfsVolumeModel(BaseModel):
         description="The directory within the EFS volume which will mounted by containers",
         default_description="By default the root directory of the volume will be used.",
     )
+    access_point_id: Optional[str] = Field(
+        description="The ID of the EFS access point to mount the volume through.",
+        notes=[
+            """An access point sets the directory and POSIX identity the
+               containers see, so `root_directory` can't be used with it."""
+        ],
+    )
+    access_point_export_name: Optional[str] = Field(
+        description="""The name of the export holding the ID of the access point
+                       to mount the volume through, such as
+                       `<Efs stack name>-accessPoint-<name>`.""",
+        notes=["You may specify `access_point_id` or this, but not both."],
+    )
+    transit_encryption: Optional[bool] = Field(
+        description="When `true`, traffic to the EFS volume is encrypted with TLS.",
+        default_description="""`true` when using an access point or IAM
+                               authorization, which require it, otherwise
+                               `false`.""",
+    )
+    iam_authorization: bool = Field(
+        False,
+        description="""When `true`, the volume is mounted with the task role's
+                       IAM identity, so the file system's policy can control
+                       access.""",
+        notes=[
+            """When the template creates the task role it's allowed to mount
+               and write to the volume. A role given by `execution_role_arn`
+               must allow this itself."""
+        ],
+    )
+
+    @root_validator
+    def access_point_settings(cls, values):
+        model_exclusive(values, "access_point_id", "access_point_export_name")
+        access_point = values.get("access_point_id") or values.get(
+            "access_point_export_name"
+        )
+        if access_point and values.get("root_directory") not in [None, "/"]:
+            raise ValueError("root_directory can't be used with an access point")
+        if access_point or values.get("iam_authorization"):
+            if values.get("transit_encryption") is False:
+                raise ValueError(
+                    "transit_encryption is required with an access point or IAM authorization"
+                )
+            values["transit_encryption"] = True
+        return values
 
 
 class HostVolumeModel(BaseModel):
@@ -57,20 +104,42 @@ class ScheduleModel(BaseModel):
                        should be specified like `0 0 * * ? *` instead of `cron(0
                        12 * * ? *)`.""",
         notes=[
-            """AWS requires that all cron expressions be in UTC. It is not possible at this
-               time to specify a local timezone. You will therefore need to
-               adjust your cron expressions appropriately.""",
+            """Unless `eventbridge_scheduler` is enabled, AWS requires that all
+               cron expressions be in UTC. You will therefore need to adjust
+               your cron expressions appropriately.""",
             "**See Also:** [Schedule Expressions for Rules](https://docs.aws.amazon.com/AmazonCloudWatch/latest/events/ScheduledEvents.html#CronExpressions)",
         ],
     )
-    desired_count: int = Field(
-        description="Desired number of tasks to set for the service at the specified time."
+    desired_count: Optional[int] = Field(
+        description="Desired number of tasks to set for the service at the specified time.",
+        notes=[
+            """When `auto_scaling` is defined, this sets the minimum capacity
+               instead. The maximum capacity is set to the larger of this value
+               and `auto_scaling.max_capacity`, or to zero when this value is
+               zero."""
+        ],
+    )
+    min_capacity: Optional[int] = Field(
+        description="""The minimum number of tasks to set at the specified time.
+                       Overrides the minimum derived from `desired_count`.""",
+        notes=["This setting requires `auto_scaling`."],
+    )
+    max_capacity: Optional[int] = Field(
+        description="""The maximum number of tasks to set at the specified time.
+                       Overrides the maximum derived from `desired_count`.""",
+        notes=["This setting requires `auto_scaling`."],
     )
     description = Field(
         "ECS service scheduling rule",
         description="Description of the schedule",
         omit_default=True,
     )
+    timezone: Optional[str] = Field(
+        description="""The time zone in which `cron` is evaluated, for example
+                       `America/New_York`.""",
+        default_description="UTC",
+        notes=["This setting requires `eventbridge_scheduler` or `auto_scaling`."],
+    )
 
 
 class HealthCheckModel(BaseModel):
@@ -104,6 +173,83 @@ class HealthCheckModel(BaseModel):
     )
 
 
+class DeploymentProfileModel(BaseModel):
+    health_check_interval_seconds: int
+    health_check_timeout_seconds: int
+    healthy_threshold_count: int
+    unhealthy_threshold_count: int
+    deregistration_delay_seconds: int
+    slow_start_seconds: int
+    maximum_percent: int
+    minimum_healthy_percent: int
+
+
+DEPLOYMENT_PROFILES = {
+    "fast": DeploymentProfileModel(
+        health_check_interval_seconds=10,
+        health_check_timeout_seconds=5,
+        healthy_threshold_count=2,
+        unhealthy_threshold_count=2,
+        deregistration_delay_seconds=15,
+        slow_start_seconds=0,
+        maximum_percent=200,
+        minimum_healthy_percent=50,
+    ),
+    "balanced": DeploymentProfileModel(
+        health_check_interval_seconds=15,
+        health_check_timeout_seconds=5,
+        healthy_threshold_count=3,
+        unhealthy_threshold_count=3,
+        deregistration_delay_seconds=60,
+        slow_start_seconds=30,
+        maximum_percent=200,
+        minimum_healthy_percent=100,
+    ),
+    "conservative": DeploymentProfileModel(
+        health_check_interval_seconds=30,
+        health_check_timeout_seconds=10,
+        healthy_threshold_count=5,
+        unhealthy_threshold_count=3,
+        deregistration_delay_seconds=300,
+        slow_start_seconds=120,
+        maximum_percent=150,
+        minimum_healthy_percent=100,
+    ),
+}
+
+
+def worst_case_deploy_seconds(profile):
+    """Estimates the longest a successful deployment takes, not counting image
+    pulls and container start-up. Each wave of new tasks has to pass the
+    healthy threshold, having just missed a check, and the tasks they replace
+    have to be deregistered. A wave replaces the share of tasks which fits
+    between the minimum healthy and maximum percentages."""
+    waves = math.ceil(
+        100 / min(100, profile.maximum_percent - profile.minimum_healthy_percent)
+    )
+    per_wave = (
+        profile.healthy_threshold_count + 1
+    ) * profile.health_check_interval_seconds + profile.deregistration_delay_seconds
+    return waves * per_wave
+
+
+def deployment_profile_note(name):
+    p = DEPLOYMENT_PROFILES[name]
+    slow_start = (
+        f"{p.slow_start_seconds}s slow start"
+        if p.slow_start_seconds
+        else "no slow start"
+    )
+    return (
+        f"`{name}`: health checks every {p.health_check_interval_seconds}s "
+        f"({p.healthy_threshold_count} to pass, {p.unhealthy_threshold_count} to fail), "
+        f"{p.deregistration_delay_seconds}s deregistration delay, {slow_start}, "
+        f"{p.minimum_healthy_percent}-{p.maximum_percent}% of `DesiredCount` "
+        f"during deployments. Worst-case deployment: about "
+        f"{worst_case_deploy_seconds(p)}s plus container start-up."
+    )
+
+
 class RuleModel(BaseModel):
     path: Optional[str] = Field(
         description="""The context path for the listener rule. The path should
@@ -204,6 +350,48 @@ class ImageBuildModel(BaseModel):
     env_vars: List[EnvironmentVariableModel] = Field(
         [], description="Environment variable overrides for the build."
     )
+    image_tag_variable: Optional[str] = Field(
+        description="""Name of a variable exported by the buildspec which holds
+                       the tag of the pushed image.""",
+        default_description="`IMAGE_TAG`",
+        notes=[
+            """The buildspec reports the variable by listing it under
+               `env.exported-variables`. A buildspec may instead export
+               `IMAGE_URI` with the full URI of the image.""",
+        ],
+    )
+    image_tag: Optional[str] = Field(
+        description="""Template for the tag the build applies to the image. It
+                       is used when the build does not export its tag.
+                       `{build_number}` is replaced with the CodeBuild build
+                       number and `{NAME}` with the value of the build
+                       environment variable `NAME`.""",
+        notes=[
+            "Example: `{APP_NAME}-{APP_VER}-{build_number}`",
+            """If neither an exported tag nor `image_tag` is available, every
+               tag in the ECR repository is listed to find the image. This
+               becomes slow on large repositories.""",
+        ],
+    )
+    build_cache = Field(
+        False,
+        description="""When true, a build is skipped if the ECR repository
+                       already holds an image built from the same project,
+                       `env_vars` and source commit. The URI of that image is
+                       returned instead.""",
+        notes=[
+            """Images are tagged with a `build-` hash of these inputs after
+               each build. The source commit can only be resolved for
+               CodeCommit projects and projects pinned to a commit ID. Other
+               projects are always built.""",
+        ],
+    )
+    force_rebuild = Field(
+        False,
+        description="""When true, the build cache lookup is skipped and the image
+                       is always rebuilt. The new image still receives the
+                       cache tag.""",
+    )
 
 
 class ContainerModel(BaseModel):
@@ -216,7 +404,13 @@ class ContainerModel(BaseModel):
     )
     image_build: Optional[ImageBuildModel] = Field(
         description="Settings for building the container image.",
-        notes=["**Requirement:** One of `image` or `image_build` must be defined"],
+        notes=[
+            "**Requirement:** One of `image` or `image_build` must be defined",
+            """Builds are run by a Step Functions state machine rather than a
+               waiting Lambda, so they may run longer than 15 minutes. They
+               are still bound by CloudFormation's one-hour limit on custom
+               resources.""",
+        ],
     )
     command: List[str] = Field(
         [],
@@ -395,6 +589,14 @@ class AutoStopModel(BaseModel):
     enabled = Field(
         False,
         description="When `True` the service will be stopped after a period of innactivity.",
+        notes=[
+            """When a stopped service is requested, each listener rule is
+               restored as soon as its own target group has a healthy target.
+               The seconds from the request to all rules being restored are
+               reported as the `WakeUpDuration` metric in the
+               `EcsWebService/AutoStop` namespace, with a `StackName`
+               dimension."""
+        ],
     )
     alert_topic_arn: Optional[str] = Field(
         description="ARN of an SNS topic to which error alerts will be sent."
@@ -431,6 +633,42 @@ class AutoStopModel(BaseModel):
     waiter_rule = Field(
         AutoStopWaiterRuleModel(), description="Configuration for the waiter's rule."
     )
+    idle_desired_count = Field(
+        0,
+        description="The number of tasks left running while the service is idle.",
+        notes=[
+            """When this is greater than zero, an idle service is scaled down
+               instead of being stopped. Requests keep going to the remaining
+               tasks, so users don't see the 'please wait' page, and the next
+               idle check which finds requests scales the service back up to
+               `DesiredCount`. A more frequent `idle_check_schedule` scales it
+               back up sooner.""",
+            """If the service has no healthy targets when it becomes idle, it
+               is stopped as usual.""",
+        ],
+    )
+    idle_cpu: Optional[str] = Field(
+        description="The task-level cpu of the tasks left running while idle.",
+        default_description="The tasks keep their normal size.",
+        notes=["This setting requires `idle_desired_count`."],
+    )
+    idle_memory: Optional[str] = Field(
+        description="""The task-level memory (in MiB) of the tasks left running
+                       while idle.""",
+        default_description="The tasks keep their normal size.",
+        notes=[
+            """This setting requires `idle_desired_count`. The total
+               `container_memory` of the containers must fit within it."""
+        ],
+    )
+
+    @root_validator
+    def idle_size_requires_count(cls, values):
+        if values.get("idle_desired_count", 0) < 1 and (
+            values.get("idle_cpu") or values.get("idle_memory")
+        ):
+            raise ValueError("idle_cpu and idle_memory require idle_desired_count")
+        return values
 
 
 class PlacementConstraintModel(BaseModel):
@@ -446,6 +684,98 @@ class PlacementConstraintModel(BaseModel):
     )
 
 
+class TargetTrackingPolicyModel(BaseModel):
+    metric: Literal[
+        "ALBRequestCountPerTarget",
+        "ECSServiceAverageCPUUtilization",
+        "ECSServiceAverageMemoryUtilization",
+    ] = Field(
+        description="The predefined metric to track.",
+        notes=[
+            """`ALBRequestCountPerTarget` uses the service's first target group
+               created by this template."""
+        ],
+    )
+    target_value: float = Field(
+        description="""The value of the metric the policy tries to maintain. For
+                       CPU and memory this is a percentage. For
+                       `ALBRequestCountPerTarget` it is requests per target per
+                       minute."""
+    )
+    scale_in_cooldown_seconds = Field(
+        300,
+        description="The minimum number of seconds between scale-in activities.",
+    )
+    scale_out_cooldown_seconds = Field(
+        60,
+        description="The minimum number of seconds between scale-out activities.",
+    )
+    disable_scale_in = Field(
+        False,
+        description="When true, this policy will only scale the service out.",
+    )
+
+
+class StepAdjustmentModel(BaseModel):
+    lower_bound: Optional[float] = Field(
+        description="""The lower bound of the step, relative to the alarm
+                       threshold.""",
+        default_description="Negative infinity",
+    )
+    upper_bound: Optional[float] = Field(
+        description="""The upper bound of the step, relative to the alarm
+                       threshold.""",
+        default_description="Positive infinity",
+    )
+    adjustment: int = Field(
+        description="The number of tasks to add (or remove when negative)."
+    )
+
+
+class StepScalingPolicyModel(BaseModel):
+    metric: Literal["CPUUtilization", "MemoryUtilization"] = Field(
+        description="The `AWS/ECS` service metric which triggers the policy."
+    )
+    threshold: float = Field(description="The alarm threshold, as a percentage.")
+    comparison = Field(
+        "GreaterThanOrEqualToThreshold",
+        description="The comparison operator of the alarm.",
+        notes=[
+            "**See Also:** [AWS::CloudWatch::Alarm](https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-resource-cloudwatch-alarm.html#cfn-cloudwatch-alarm-comparisonoperator)"
+        ],
+    )
+    period_seconds = Field(60, description="The period of the alarm's metric.")
+    evaluation_periods = Field(
+        1, description="The number of periods over which the metric is compared."
+    )
+    cooldown_seconds = Field(
+        60, description="The minimum number of seconds between scaling activities."
+    )
+    steps: List[StepAdjustmentModel] = Field(
+        description="The step adjustments applied when the alarm fires."
+    )
+
+
+class AutoScalingModel(BaseModel):
+    """Creates an Application Auto Scaling target for the service's desired
+    count along with the specified scaling policies."""
+
+    min_capacity: int = Field(description="The minimum number of tasks.")
+    max_capacity: int = Field(description="The maximum number of tasks.")
+    target_tracking: List[TargetTrackingPolicyModel] = Field(
+        [], description="Target tracking scaling policies."
+    )
+    step_scaling: List[StepScalingPolicyModel] = Field(
+        [], description="Step scaling policies."
+    )
+
+    @root_validator
+    def min_not_above_max(cls, values):
+        if values.get("min_capacity", 0) > values.get("max_capacity", 0):
+            raise ValueError("min_capacity must not exceed max_capacity")
+        return values
+
+
 class UserDataModel(BaseModel):
     launch_type: Optional[Literal["EC2", "EXTERNAL", "FARGATE"]]
     cpu: Optional[str] = Field(
@@ -536,6 +866,46 @@ class UserDataModel(BaseModel):
         [],
         description="Specifies a schedule for modifying the DesiredCount of the service.",
     )
+    auto_scaling: Optional[AutoScalingModel] = Field(
+        description="Scales the number of tasks in response to load.",
+        notes=[
+            """When `auto_scaling` is defined, `schedule` entries become
+               scheduled actions which set the minimum and maximum capacity
+               rather than the desired count."""
+        ],
+    )
+    eventbridge_scheduler = Field(
+        False,
+        description="""When true, `schedule` entries are created as EventBridge
+                       Scheduler schedules which call `ecs:UpdateService`
+                       directly. When false, an EventBridge rule invokes a
+                       Lambda function which updates the service.""",
+        notes=[
+            """The scheduler does not need a Lambda function and supports
+               time zones through `timezone`.""",
+            "**See Also:** [Universal targets](https://docs.aws.amazon.com/scheduler/latest/UserGuide/managing-targets-universal.html)",
+        ],
+    )
+    deployment_profile: Optional[Literal["fast", "balanced", "conservative"]] = Field(
+        description="""Tunes the target groups' health checks and deregistration
+                       delay, and the service's deployment percentages, for
+                       how quickly deployments should roll out.""",
+        default_description="""Health checks every 60s (5 to pass, 5 to
+                               fail), a 300s deregistration delay and the
+                               deployment circuit breaker disabled. A
+                               deployment takes about 660s plus container
+                               start-up.""",
+        notes=[deployment_profile_note(n) for n in DEPLOYMENT_PROFILES]
+        + [
+            """Every profile enables the deployment circuit breaker, which
+               rolls a deployment back when its tasks fail to become
+               healthy.""",
+            """Settings made explicitly in `health_check` and
+               `target_group.attributes` take precedence over the profile.
+               The percentages become the defaults of the `MaximumPercent` and
+               `MinimumHealthyPercent` parameters.""",
+        ],
+    )
     auto_stop = Field(
         AutoStopModel(),
         description="Configuration for automatically stopping the service after a period of innactivity.",
@@ -562,6 +932,50 @@ class UserDataModel(BaseModel):
                 ]
         return values
 
+    @root_validator
+    def schedule_options(cls, values):
+        auto_scaling = values.get("auto_scaling")
+        for s in values.get("schedule", []):
+            if s.timezone and not (values.get("eventbridge_scheduler") or auto_scaling):
+                raise ValueError(
+                    "schedule timezone requires eventbridge_scheduler or auto_scaling"
+                )
+            if auto_scaling:
+                if s.desired_count is None and (
+                    s.min_capacity is None or s.max_capacity is None
+                ):
+                    raise ValueError(
+                        "schedule requires desired_count or both min_capacity and max_capacity"
+                    )
+            else:
+                if s.desired_count is None:
+                    raise ValueError("schedule requires desired_count")
+                if s.min_capacity is not None or s.max_capacity is not None:
+                    raise ValueError(
+                        "schedule min_capacity and max_capacity require auto_scaling"
+                    )
+        return values
+
+    @root_validator
+    def auto_scaling_conflicts(cls, values):
+        auto_stop = values.get("auto_stop")
+        if values.get("auto_scaling") and auto_stop and auto_stop.enabled:
+            raise ValueError("auto_scaling cannot be used with auto_stop")
+        return values
+
+    @root_validator
+    def idle_memory_fits_containers(cls, values):
+        auto_stop = values.get("auto_stop")
+        if auto_stop and auto_stop.idle_memory:
+            # The task's containers share its memory.
+            total = sum(c.container_memory for c in values.get("containers", []))
+            if total > int(auto_stop.idle_memory):
+                raise ValueError(
+                    f"the containers' container_memory total of {total} exceeds "
+                    "auto_stop.idle_memory"
+                )
+        return values
+
     @root_validator
     def awsvpc_requires_subnet(cls, values):
         if values.get("network_mode") == "awsvpc":
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import hashlib
+import json
 import os
 import time
 import traceback
@@ -21,7 +23,22 @@ else:
 
 
 CB = boto3.client('codebuild', region_name=REGION)
+CC = boto3.client('codecommit', region_name=REGION)
+CFN = boto3.client('cloudformation', region_name=REGION)
 ECR = boto3.client('ecr', region_name=REGION)
+SFN = boto3.client('stepfunctions', region_name=REGION)
+
+# Logical ID of the state machine which waits for builds to finish.
+STATE_MACHINE_LOGICAL_ID = 'ImageBuildStateMachine'
+
+# Name of the variable a buildspec can export to report the tag it pushed.
+DEFAULT_IMAGE_TAG_VARIABLE = 'IMAGE_TAG'
+
+# Number of recent builds used to estimate how long a build will take.
+HISTORY_BUILDS = 10
+
+MIN_POLL_SECS = 10
+MAX_POLL_SECS = 60
 
 
 def longest(it):
@@ -41,36 +58,117 @@ def describe_images(repo_name, tags):
             yield d
 
 
-def get_build_status(build_id):
+def get_build(build_id):
     print('Fetching build status')
-    return CB.batch_get_builds(ids=[build_id])['builds'][0]['buildStatus']
+    return CB.batch_get_builds(ids=[build_id])['builds'][0]
 
 
-def do_build(props, res_fn):
+def median(lst):
+    lst = sorted(lst)
+    if len(lst) < 1:
+        return None
+    return lst[len(lst) // 2]
+
+
+def expected_build_secs(project_name):
+    """Returns the median duration of the project's recent successful builds, or
+    None if there is no history. This costs two API calls regardless of how many
+    builds the project has."""
+    ids = CB.list_builds_for_project(projectName=project_name, sortOrder='DESCENDING')['ids']
+    ids = ids[:HISTORY_BUILDS]
+    if len(ids) < 1:
+        return None
+    builds = CB.batch_get_builds(ids=ids)['builds']
+    return median([(b['endTime'] - b['startTime']).total_seconds() for b in builds
+                   if b['buildStatus'] == 'SUCCEEDED' and 'endTime' in b])
+
+
+def poll_intervals(expected_secs):
+    """Yields the number of seconds to wait before each status check. When the
+    project has a build history, the first wait covers most of the expected
+    build time. After that the interval grows from MIN_POLL_SECS to
+    MAX_POLL_SECS."""
+    if expected_secs is not None:
+        first = int(expected_secs * 0.8)
+        if first > MIN_POLL_SECS:
+            yield first
+    interval = MIN_POLL_SECS
+    while True:
+        yield interval
+        interval = min(MAX_POLL_SECS, int(interval * 1.5))
+
+
+def do_build(props, res_fn, source_version=None):
+    expected = expected_build_secs(props['ProjectName'])
+    print('Expected build duration (seconds):', expected)
+
+    opts = {'sourceVersion': source_version} if source_version else {}
     res = CB.start_build(projectName=props['ProjectName'],
-                         environmentVariablesOverride=props['EnvironmentVariablesOverride'])
+                         environmentVariablesOverride=props['EnvironmentVariablesOverride'],
+                         **opts)
     build_props = res['build']
     build_num = build_props['buildNumber']
     build_id = build_props['id']
 
     print("Build: {} ({})".format(build_id, build_num))
 
-    while True:
-        print('Waiting 30 seconds')
-        time.sleep(30)
-        status = get_build_status(build_id)
+    for secs in poll_intervals(expected):
+        print('Waiting {} seconds'.format(secs))
+        time.sleep(secs)
+        build = get_build(build_id)
+        status = build['buildStatus']
         print('Build status:', status)
         if status == 'SUCCEEDED':
             print("Build succeeded.")
-            return build_num, build_id
+            return build
         elif status == 'IN_PROGRESS':
             continue
         else:
             res_fn(cfnresponse.FAILED, {}, reason="Build finished with status '{}'".format(status))
-            return None, None
+            return None
+
+
+def exported_vars(build):
+    return {v['name']: v['value'] for v in build.get('exportedEnvironmentVariables', [])}
+
+
+def image_uri(image, tag):
+    return '{}.dkr.ecr.{}.amazonaws.com/{}:{}'.format(image['registryId'], REGION, image['repositoryName'], tag)
 
 
-def find_image(repo, build_time, build_num):
+def find_tagged_image(repo, tags):
+    """Looks up images by tag with a single targeted describe_images call so that
+    the cost does not depend on the size of the repository."""
+    image_ids = [{'imageTag': t} for t in tags]
+    try:
+        res = ECR.describe_images(repositoryName=repo, imageIds=image_ids)
+    except ECR.exceptions.ImageNotFoundException:
+        return None
+    for image in res['imageDetails']:
+        tag = [t for t in tags if t in image.get('imageTags', [])][0]
+        image['imageUri'] = image_uri(image, tag)
+        print('Found image:', image)
+        return image
+    return None
+
+
+def candidate_tags(props, build):
+    """Returns the tags the build may have applied to its image. A tag exported by
+    the buildspec takes precedence over the ImageTag template."""
+    env = {v['name']: v['value'] for v in props.get('EnvironmentVariablesOverride', [])}
+    env.update(exported_vars(build))
+    tag_var = props.get('ImageTagVariable', DEFAULT_IMAGE_TAG_VARIABLE)
+    if tag_var in env:
+        return [env[tag_var]]
+    if 'ImageTag' in props:
+        return [props['ImageTag'].format(build_number=build['buildNumber'], **env)]
+    return []
+
+
+def scan_for_image(repo, build_time, build_num):
+    # Legacy lookup for buildspecs which don't export their image tag. This lists
+    # every tagged image in the repository so its cost grows with the repository.
+    print('WARNING: Build did not report its image tag, scanning repository', repo)
     image_tags = [t for t in get_image_tags(repo) if t == build_num or t.endswith('-' + build_num)]
     images = [d for d in describe_images(repo, image_tags) if d['imagePushedAt'].replace(tzinfo=None) > build_time]
     if len(images) == 1:
@@ -81,33 +179,189 @@ def find_image(repo, build_time, build_num):
         image['imageUri'] = '{}:{}'.format(
             ECR.describe_repositories(repositoryNames=[repo])['repositories'][0]['repositoryUri'], image_tag)
         print('ImageURI:', image['imageUri'])
+        return image, 1
+    return None, len(images)
+
+
+def find_image(props, build, build_time, res_fn):
+    repo = props['RepositoryName']
+    exported = exported_vars(build)
+    if 'IMAGE_URI' in exported:
+        print('Build exported IMAGE_URI:', exported['IMAGE_URI'])
+        return {'imageUri': exported['IMAGE_URI']}
+
+    tags = candidate_tags(props, build)
+    if len(tags) > 0:
+        image = find_tagged_image(repo, tags)
+        if image is None:
+            res_fn(cfnresponse.FAILED, {},
+                   reason='Build succeeded but no image tagged {} was found in ECR repository'.format(tags))
         return image
-    else:
-        res_fn(cfnresponse.FAILED, {}, reason='Build succeeded but found {} matching images in ECR repository'.format(len(images)))
+
+    image, count = scan_for_image(repo, build_time, str(build['buildNumber']))
+    if image is None:
+        res_fn(cfnresponse.FAILED, {}, reason='Build succeeded but found {} matching images in ECR repository'.format(count))
+    return image
+
+
+def opts_from(d, **kwargs):
+    return {k: d[v] for k, v in kwargs.items() if v in d}
+
+
+def prop_bool(props, key):
+    return str(props.get(key, 'false')).lower() == 'true'
+
+
+def is_commit_id(s):
+    return len(s) == 40 and all(c in '0123456789abcdef' for c in s.lower())
+
+
+def resolve_source_version(project_name):
+    """Returns the commit ID the project would build, or None if it can't be
+    determined. Only CodeCommit sources and projects pinned to a commit can be
+    resolved."""
+    project = CB.batch_get_projects(names=[project_name])['projects'][0]
+    version = project.get('sourceVersion', '')
+    if is_commit_id(version):
+        return version
+    source = project['source']
+    if source['type'] != 'CODECOMMIT':
+        print('Cannot resolve source version for source type', source['type'])
+        return None
+    if version.startswith('refs/') and not version.startswith('refs/heads/'):
+        print('Cannot resolve source version', version)
+        return None
+    repo = source['location'].rstrip('/').split('/')[-1]
+    branch = version.replace('refs/heads/', '')
+    try:
+        if not branch:
+            branch = CC.get_repository(repositoryName=repo)['repositoryMetadata']['defaultBranch']
+        return CC.get_branch(repositoryName=repo, branchName=branch)['branch']['commitId']
+    except CC.exceptions.ClientError as err:
+        # A tag or missing branch just means the build can't be cached.
+        print('Cannot resolve source version {} of {}: {}'.format(version, repo, err))
         return None
 
 
-def do_create_update(event, res_fn):
-    props = event['ResourceProperties']
+def cache_tag(props, source_version):
+    """Returns the ECR tag identifying an image built from these inputs."""
+    inputs = {
+        'ProjectName': props['ProjectName'],
+        'RepositoryName': props['RepositoryName'],
+        'EnvironmentVariablesOverride': sorted(
+            [(v['name'], v['value'], v.get('type', 'PLAINTEXT')) for v in props['EnvironmentVariablesOverride']]),
+        'SourceVersion': source_version,
+    }
+    return 'build-' + hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()[:40]
 
-    build_time = datetime.utcnow()
-    build_num, build_id = do_build(props, res_fn)
 
-    if build_num is None:
+def image_id_from_uri(uri):
+    if '@' in uri:
+        return {'imageDigest': uri.split('@')[-1]}
+    return {'imageTag': uri.split(':')[-1]}
+
+
+def tag_image(repo, image, tag):
+    image_id = {'imageDigest': image['imageDigest']} if 'imageDigest' in image else image_id_from_uri(
+        image['imageUri'])
+    found = ECR.batch_get_image(repositoryName=repo, imageIds=[image_id])['images']
+    if len(found) < 1:
+        print('WARNING: Unable to fetch manifest for', image_id, 'image will not be cached')
         return
+    print('Tagging image with cache tag:', tag)
+    try:
+        ECR.put_image(repositoryName=repo, imageManifest=found[0]['imageManifest'], imageTag=tag,
+                      **opts_from(found[0], imageManifestMediaType='imageManifestMediaType'))
+    except ECR.exceptions.ImageAlreadyExistsException:
+        pass
 
-    build_num = str(build_num)
-    res_data = {'BuildId': build_id, 'BuildNum': build_num}
+
+def finish_build(props, build, build_time, tag, res_fn):
+    res_data = {'BuildId': build['id'], 'BuildNum': str(build['buildNumber']), 'CacheHit': 'false'}
 
     if 'RepositoryName' in props:
-        image = find_image(props['RepositoryName'], build_time, build_num)
+        image = find_image(props, build, build_time, res_fn)
         if image is None:
             return
         res_data['ImageURI'] = image['imageUri']
+        if tag is not None:
+            tag_image(props['RepositoryName'], image, tag)
 
     res_fn(cfnresponse.SUCCESS, res_data)
 
 
+def state_machine_arn(event):
+    return CFN.describe_stack_resource(StackName=event['StackId'], LogicalResourceId=STATE_MACHINE_LOGICAL_ID)[
+        'StackResourceDetail']['PhysicalResourceId']
+
+
+def start_orchestration(event, props, build_time, source_version, tag):
+    """Hands the build off to the image build state machine. The state machine
+    runs the build, waits for it to finish, then invokes this function again to
+    resolve the image and respond to CloudFormation."""
+    start_build = {
+        'ProjectName': props['ProjectName'],
+        'EnvironmentVariablesOverride': [
+            {'Name': v['name'], 'Value': v['value'], 'Type': v.get('type', 'PLAINTEXT')}
+            for v in props.get('EnvironmentVariablesOverride', [])],
+    }
+    if source_version:
+        start_build['SourceVersion'] = source_version
+    execution_input = {'Event': event, 'StartBuild': start_build, 'BuildTime': build_time.isoformat()}
+    if tag is not None:
+        execution_input['CacheTag'] = tag
+    res = SFN.start_execution(stateMachineArn=state_machine_arn(event), input=json.dumps(execution_input))
+    print('Started execution:', res['executionArn'])
+
+
+def do_create_update(event, context, res_fn):
+    props = event['ResourceProperties']
+
+    tag = None
+    source_version = None
+    if prop_bool(props, 'BuildCache') and 'RepositoryName' in props:
+        source_version = resolve_source_version(props['ProjectName'])
+        print('Resolved source version:', source_version)
+        if source_version is not None:
+            tag = cache_tag(props, source_version)
+            print('Build cache tag:', tag)
+            if prop_bool(props, 'ForceRebuild'):
+                print('Rebuild forced, skipping cache lookup')
+            else:
+                image = find_tagged_image(props['RepositoryName'], [tag])
+                if image is not None:
+                    print('Build cache hit')
+                    res_fn(cfnresponse.SUCCESS, {'BuildId': '', 'BuildNum': '', 'CacheHit': 'true',
+                                                 'ImageURI': image['imageUri']})
+                    return
+                print('Build cache miss')
+
+    build_time = datetime.utcnow()
+    if context is not None:
+        return start_orchestration(event, props, build_time, source_version, tag)
+
+    # In a test environment there is no state machine so we wait for the build
+    # here.
+    build = do_build(props, res_fn, source_version)
+    if build is None:
+        return
+    finish_build(props, build, build_time, tag, res_fn)
+
+
+def do_state_machine_action(event, res_fn):
+    execution = event['Execution']
+    if event['Action'] == 'resolve':
+        build = get_build(execution['Build']['Id'])
+        print('Build status:', build['buildStatus'])
+        build_time = datetime.fromisoformat(execution['BuildTime'])
+        props = execution['Event']['ResourceProperties']
+        finish_build(props, build, build_time, execution.get('CacheTag'), res_fn)
+    else:
+        error = execution.get('Error', {})
+        reason = 'Build failed: {} {}'.format(error.get('Error', ''), error.get('Cause', ''))
+        res_fn(cfnresponse.FAILED, {}, reason=reason[:1000])
+
+
 def print_response(responseStatus, responseData, physicalResourceId=None, noEcho=False, reason=None):
     print('-----------------------------------------------------------')
     print("responseStatus:", responseStatus, "\nresponseData:", responseData, "\nphysicalResourceId:", physicalResourceId,
@@ -117,6 +371,17 @@ def print_response(responseStatus, responseData, physicalResourceId=None, noEcho
 
 def lambda_handler(event, context):
     print('event:', event)
+
+    if 'Action' in event:
+        # We've been invoked by the image build state machine.
+        res_fn = partial(cfnresponse.send, event['Execution']['Event'], context)
+        try:
+            return do_state_machine_action(event, res_fn)
+        except Exception as err:
+            traceback.print_exc()
+            res_fn(cfnresponse.FAILED, {}, reason=str(err))
+            return
+
     req_type = event['RequestType']
 
     if context is None:
@@ -127,7 +392,7 @@ def lambda_handler(event, context):
 
     try:
         if req_type in ['Create', 'Update']:
-            return do_create_update(event, res_fn)
+            return do_create_update(event, context, res_fn)
         elif req_type == 'Delete':
             res_fn(cfnresponse.SUCCESS, {})
         else:
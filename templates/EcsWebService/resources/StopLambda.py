@@ -95,9 +95,12 @@ def get_tg_metrics(start_time, end_time, tg_full_name):
     return res["Datapoints"]
 
 
+def describe_service():
+    return ECS.describe_services(cluster=CLUSTER, services=[SERVICE])["services"][0]
+
+
 def get_service_date():
-    res = ECS.describe_services(cluster=CLUSTER, services=[SERVICE])
-    return res["services"][0]["createdAt"]
+    return describe_service()["createdAt"]
 
 
 def is_active(event):
@@ -125,6 +128,55 @@ def set_desired_count(c):
     ECS.update_service(cluster=CLUSTER, service=SERVICE, desiredCount=c)
 
 
+def get_idle_desired_count(event):
+    return event.get("idle_desired_count", 0)
+
+
+def is_idle_scaled(event, service):
+    """Returns True if the service has already been scaled down for idleness."""
+    if event["idle_task_definition"]:
+        return service["taskDefinition"] == event["idle_task_definition"]
+    return service["desiredCount"] <= get_idle_desired_count(event)
+
+
+def has_healthy_target(service):
+    for lb in service["loadBalancers"]:
+        res = ELB.describe_target_health(TargetGroupArn=lb["targetGroupArn"])
+        for h in res["TargetHealthDescriptions"]:
+            if h["TargetHealth"]["State"] == "healthy":
+                return True
+    return False
+
+
+def scale_service(count, task_definition):
+    print(
+        "Setting desiredCount of service %s to %d with %s"
+        % (SERVICE, count, task_definition)
+    )
+    ECS.update_service(
+        cluster=CLUSTER,
+        service=SERVICE,
+        desiredCount=count,
+        taskDefinition=task_definition,
+    )
+
+
+def scale_to_idle(event):
+    scale_service(
+        get_idle_desired_count(event),
+        event["idle_task_definition"] or event["task_definition"],
+    )
+
+
+def restore_service(event, service):
+    if (
+        service["desiredCount"] == event["desired_count"]
+        and service["taskDefinition"] == event["task_definition"]
+    ):
+        return
+    scale_service(event["desired_count"], event["task_definition"])
+
+
 def get_task_ids():
     return ECS.list_tasks(cluster=CLUSTER, serviceName=SERVICE)["taskArns"]
 
@@ -187,11 +239,28 @@ def lambda_handler(event, context):
         print("Stack is not in a COMPLETE state. Will not shut down.")
         return
 
+    keep_warm = get_idle_desired_count(event) > 0
     if is_active(event):
         print("Service is active. Will not shut down.")
+        service = describe_service()
+        if keep_warm and is_idle_scaled(event, service):
+            print("Restoring service from its idle size.")
+            restore_service(event, service)
         return
 
     print("Service is inactive.")
+    if keep_warm:
+        service = describe_service()
+        if is_idle_scaled(event, service):
+            print("Service is already at its idle size.")
+            return
+        # Requests keep going to the remaining tasks, so the waiter is only
+        # needed when there's nothing healthy to serve them.
+        if has_healthy_target(service):
+            scale_to_idle(event)
+            return
+        print("Service has no healthy targets. Stopping it instead.")
+
     rule_arns = event["rule_arns"]
     schedule_rule_name = get_schedule_rule_name()
     skipper_key = get_rule_skipper_key(event)
@@ -0,0 +1,80 @@
+from troposphere import Ref
+from troposphere.cloudwatch import Alarm, MetricDimension
+
+from model import baseline_throughput_mibps, filesystem_setting
+from util import add_resource
+
+MIB = 1024 * 1024
+GIB = 1024 * MIB
+
+
+def alarm(title, alarms, fs, description, **kwargs):
+    return add_resource(
+        Alarm(
+            title,
+            AlarmDescription=description,
+            Namespace="AWS/EFS",
+            Dimensions=[MetricDimension(Name="FileSystemId", Value=Ref(fs))],
+            Period=alarms.period_seconds,
+            EvaluationPeriods=alarms.evaluation_periods,
+            AlarmActions=alarms.alarm_actions,
+            **kwargs,
+        )
+    )
+
+
+def throughput_mode(user_data):
+    return filesystem_setting(dict(user_data), "throughput_mode", "bursting")
+
+
+def min_permitted_throughput_mibps(user_data):
+    if user_data.alarms.min_permitted_throughput_mibps is not None:
+        return user_data.alarms.min_permitted_throughput_mibps
+    if throughput_mode(user_data) == "bursting" and user_data.expected_size_gib:
+        return baseline_throughput_mibps(user_data.expected_size_gib)
+    return None
+
+
+def add_alarms(user_data, fs):
+    alarms = user_data.alarms
+
+    if throughput_mode(user_data) == "bursting":
+        alarm(
+            "BurstCreditBalanceAlarm",
+            alarms,
+            fs,
+            f"Burst credits are below {alarms.min_burst_credit_balance_gib} GiB",
+            MetricName="BurstCreditBalance",
+            Statistic="Minimum",
+            Threshold=alarms.min_burst_credit_balance_gib * GIB,
+            ComparisonOperator="LessThanThreshold",
+        )
+
+    # PercentIOLimit is only reported in General Purpose mode.
+    performance_mode = filesystem_setting(
+        dict(user_data), "performance_mode", "generalPurpose"
+    )
+    if performance_mode == "generalPurpose":
+        alarm(
+            "PercentIOLimitAlarm",
+            alarms,
+            fs,
+            f"I/O is above {alarms.max_percent_io_limit}% of the file system's limit",
+            MetricName="PercentIOLimit",
+            Statistic="Maximum",
+            Threshold=alarms.max_percent_io_limit,
+            ComparisonOperator="GreaterThanThreshold",
+        )
+
+    mibps = min_permitted_throughput_mibps(user_data)
+    if mibps is not None:
+        alarm(
+            "PermittedThroughputAlarm",
+            alarms,
+            fs,
+            f"Permitted throughput is at or below {mibps:.2f} MiB/s",
+            MetricName="PermittedThroughput",
+            Statistic="Minimum",
+            Threshold=round(mibps * MIB),
+            ComparisonOperator="LessThanOrEqualToThreshold",
+        )
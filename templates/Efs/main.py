@@ -1,12 +1,23 @@
 from troposphere import Ref, Sub, Join, Tags
-from troposphere.efs import FileSystem, MountTarget, BackupPolicy
+from troposphere.efs import (
+    AccessPoint,
+    BackupPolicy,
+    CreationInfo,
+    FileSystem,
+    LifecyclePolicy,
+    MountTarget,
+    PosixUser,
+    RootDirectory,
+)
 from troposphere.ec2 import SecurityGroup, SecurityGroupRule
 
-from model import UserDataModel
+import alarms
+from model import UserDataModel, baseline_throughput_mibps, filesystem_setting
 from util import (
     add_resource,
     add_param,
     add_output,
+    debug,
     opts_from,
     opts_with,
     clean_title,
@@ -16,6 +27,18 @@ from util import (
 EFS_PORT = 2049
 
 
+def lifecycle_policies(lifecycle):
+    # Each policy may only have one transition.
+    return [
+        LifecyclePolicy(**{k: v})
+        for k, v in opts_with(
+            TransitionToIA=lifecycle.transition_to_ia,
+            TransitionToArchive=lifecycle.transition_to_archive,
+            TransitionToPrimaryStorageClass=lifecycle.transition_to_primary_storage_class,
+        ).items()
+    ]
+
+
 def r_filesystem(user_data, name):
     return add_resource(
         FileSystem(
@@ -24,11 +47,31 @@ def r_filesystem(user_data, name):
                 Status="ENABLED" if user_data.auto_backups_enabled else "DISABLED"
             ),
             FileSystemTags=Tags(Name=name, **user_data.filesystem_tags),
+            **opts_with(
+                PerformanceMode=user_data.performance_mode,
+                ThroughputMode=user_data.throughput_mode,
+                ProvisionedThroughputInMibps=user_data.provisioned_throughput_mibps,
+                LifecyclePolicies=(user_data.lifecycle, lifecycle_policies),
+            ),
             **user_data.filesystem_extra_opts,
         )
     )
 
 
+def report_throughput(user_data):
+    if user_data.expected_size_gib is None:
+        return
+    mode = filesystem_setting(dict(user_data), "throughput_mode", "bursting")
+    provisioned = filesystem_setting(dict(user_data), "provisioned_throughput_mibps")
+    mibps = baseline_throughput_mibps(user_data.expected_size_gib)
+    debug(
+        f"Baseline throughput of {user_data.expected_size_gib:g} GiB in bursting mode: "
+        f"{mibps:.2f} MiB/s"
+    )
+    if mode == "provisioned" and float(provisioned) < mibps:
+        debug("  Provisioned throughput is below this, bursting mode would be faster")
+
+
 def allow_ingress(allow):
     return SecurityGroupRule(
         FromPort=EFS_PORT,
@@ -101,6 +144,53 @@ def r_mount_target(filesystem, mt_model):
     )
 
 
+def posix_user(pu_model):
+    return PosixUser(
+        Uid=str(pu_model.uid),
+        Gid=str(pu_model.gid),
+        **opts_with(SecondaryGids=[str(g) for g in pu_model.secondary_gids] or None),
+    )
+
+
+def creation_info(ap_model):
+    ci = ap_model.creation_info
+    if ci:
+        return CreationInfo(
+            OwnerUid=str(ci.owner_uid),
+            OwnerGid=str(ci.owner_gid),
+            Permissions=ci.permissions,
+        )
+    if ap_model.posix_user:
+        return CreationInfo(
+            OwnerUid=str(ap_model.posix_user.uid),
+            OwnerGid=str(ap_model.posix_user.gid),
+            Permissions="0755",
+        )
+    return None
+
+
+def r_access_point(filesystem, ap_model):
+    ap = add_resource(
+        AccessPoint(
+            clean_title(f"AccessPoint{ap_model.name}"),
+            FileSystemId=Ref(filesystem),
+            AccessPointTags=Tags(Name=ap_model.name, **ap_model.tags),
+            RootDirectory=RootDirectory(
+                Path=ap_model.path,
+                **opts_with(CreationInfo=creation_info(ap_model)),
+            ),
+            **opts_with(PosixUser=(ap_model.posix_user, posix_user)),
+        )
+    )
+    add_output(
+        f"{ap.title}Id",
+        Ref(ap),
+        Sub("${AWS::StackName}-accessPoint-" + ap_model.name),
+        Description=f"ID of the {ap_model.name} access point",
+    )
+    return ap
+
+
 def sceptre_handler(sceptre_user_data):
     add_param(
         "VpcId",
@@ -122,6 +212,9 @@ def sceptre_handler(sceptre_user_data):
 
     fs = r_filesystem(user_data, name)
     add_output("FileSystemId", Ref(fs))
+    report_throughput(user_data)
+    if user_data.alarms:
+        alarms.add_alarms(user_data, fs)
 
     add_output(
         "SourceSecurityGroup",
@@ -133,4 +226,7 @@ def sceptre_handler(sceptre_user_data):
     for t in user_data.mount_targets:
         r_mount_target(fs, t)
 
+    for ap in user_data.access_points:
+        r_access_point(fs, ap)
+
     return TEMPLATE.to_json()
@@ -1,8 +1,51 @@
-from typing import List, Optional
+from typing import List, Literal, Optional
 
-from pydantic import Field
+from pydantic import Field, root_validator, validator
+
+from util import BaseModel, clean_title
+
+# A file system in bursting mode earns a baseline throughput of 50 MiB/s per
+# TiB stored in the Standard storage class, and at least 1 MiB/s.
+# https://docs.aws.amazon.com/efs/latest/ug/performance.html
+BURSTING_MIBPS_PER_GIB = 50 / 1024
+BURSTING_MINIMUM_MIBPS = 1.0
+
+# Options set by the typed fields. They may also come from filesystem_extra_opts,
+# as long as the typed field isn't set too.
+TYPED_FILESYSTEM_OPTS = {
+    "PerformanceMode": "performance_mode",
+    "ThroughputMode": "throughput_mode",
+    "ProvisionedThroughputInMibps": "provisioned_throughput_mibps",
+    "LifecyclePolicies": "lifecycle",
+}
+
+TransitionDays = Literal[
+    "AFTER_1_DAY",
+    "AFTER_7_DAYS",
+    "AFTER_14_DAYS",
+    "AFTER_30_DAYS",
+    "AFTER_60_DAYS",
+    "AFTER_90_DAYS",
+    "AFTER_180_DAYS",
+    "AFTER_270_DAYS",
+    "AFTER_365_DAYS",
+]
+
+
+def filesystem_setting(values, field, default=None):
+    """Returns the typed field's value, or when it isn't set, the value of the
+    matching filesystem_extra_opts option."""
+    if values.get(field) is not None:
+        return values[field]
+    opt = next(o for o, f in TYPED_FILESYSTEM_OPTS.items() if f == field)
+    return (values.get("filesystem_extra_opts") or {}).get(opt, default)
+
+
+def baseline_throughput_mibps(size_gib):
+    """Returns the baseline throughput, in MiB/s, of a file system in bursting
+    mode which stores size_gib of data in the Standard storage class."""
+    return max(BURSTING_MINIMUM_MIBPS, size_gib * BURSTING_MIBPS_PER_GIB)
 
-from util import BaseModel
 
 #
 # IMPORTANT: The following classes are DATA CLASSES using pydantic.
@@ -34,6 +77,96 @@ class MountTargetModel(BaseModel):
     )
 
 
+class PosixUserModel(BaseModel):
+    uid: int = Field(description="The POSIX user ID for all file system operations.")
+    gid: int = Field(description="The POSIX group ID for all file system operations.")
+    secondary_gids: List[int] = Field(
+        [], description="Secondary POSIX group IDs for all file system operations."
+    )
+
+
+class CreationInfoModel(BaseModel):
+    owner_uid: int = Field(description="The POSIX user ID to own the root directory.")
+    owner_gid: int = Field(description="The POSIX group ID to own the root directory.")
+    permissions = Field(
+        "0755", description="The octal POSIX permissions of the root directory."
+    )
+
+
+class AccessPointModel(BaseModel):
+    name: str = Field(
+        description="""Name of the access point, used in its logical ID and the
+                       name of the export of its ID."""
+    )
+    path: str = Field(
+        description="""The directory of the file system which clients of the
+                       access point see as its root."""
+    )
+    posix_user: Optional[PosixUserModel] = Field(
+        description="""The POSIX identity used for all file system operations
+                       through the access point, whatever the client's own
+                       identity is.""",
+        default_description="The client's own identity is used",
+    )
+    creation_info: Optional[CreationInfoModel] = Field(
+        description="""The owner and permissions of `path`, used to create it when
+                       it doesn't exist.""",
+        default_description="""When `posix_user` is set, it owns `path` with
+                               permissions `0755`. Otherwise `path` must
+                               already exist.""",
+    )
+    tags = Field({}, description="Tags to apply to this access point.")
+
+
+class LifecycleModel(BaseModel):
+    transition_to_ia: Optional[TransitionDays] = Field(
+        description="""When files which haven't been accessed move to the
+                       Infrequent Access storage class."""
+    )
+    transition_to_archive: Optional[TransitionDays] = Field(
+        description="""When files which haven't been accessed move to the
+                       Archive storage class.""",
+        notes=["Requires `throughput_mode: elastic`."],
+    )
+    transition_to_primary_storage_class: Optional[Literal["AFTER_1_ACCESS"]] = Field(
+        description="""When set, files move back to the Standard storage class
+                       the first time they're accessed."""
+    )
+
+
+class AlarmsModel(BaseModel):
+    """Creates CloudWatch alarms on the file system's throughput metrics."""
+
+    alarm_actions: List[str] = Field(
+        [],
+        description="ARNs of the SNS topics or other actions to notify when an alarm fires.",
+    )
+    min_burst_credit_balance_gib = Field(
+        100,
+        description="""Alarm when the `BurstCreditBalance` falls below this many
+                       GiB.""",
+        notes=["Only created when the throughput mode is `bursting`."],
+    )
+    max_percent_io_limit = Field(
+        95,
+        description="Alarm when the `PercentIOLimit` rises above this.",
+        notes=["Only created when the performance mode is `generalPurpose`."],
+    )
+    min_permitted_throughput_mibps: Optional[float] = Field(
+        description="""Alarm when the `PermittedThroughput` falls to this many
+                       MiB/s or below.""",
+        default_description="""The baseline throughput estimated from
+                                `expected_size_gib`, which is what a file system
+                                in bursting mode falls to when it runs out of
+                                burst credits. The alarm is only created when
+                                this can be worked out.""",
+    )
+    period_seconds = Field(60, description="The period of the alarms' metrics.")
+    evaluation_periods = Field(
+        5, description="The number of periods over which the metrics are compared."
+    )
+
+
 class UserDataModel(BaseModel):
     filesystem_name: Optional[str] = Field(
         description="Name of the EFS volume to create."
@@ -49,7 +182,85 @@ class UserDataModel(BaseModel):
             "**See:** [AWS::EFS::FileSystem](https://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/aws-resource-efs-filesystem.html)"
         ],
     )
+    performance_mode: Optional[Literal["generalPurpose", "maxIO"]] = Field(
+        description="The performance mode of the file system.",
+        default_description="`generalPurpose`",
+    )
+    throughput_mode: Optional[Literal["bursting", "elastic", "provisioned"]] = Field(
+        description="The throughput mode of the file system.",
+        default_description="`bursting`",
+        notes=[
+            """In `bursting` mode the baseline throughput grows with the data
+               stored, so a small file system serving a busy workload runs out
+               of burst credits. Set `expected_size_gib` to see its baseline
+               throughput."""
+        ],
+    )
+    provisioned_throughput_mibps: Optional[float] = Field(
+        ge=1,
+        description="The throughput, in MiB/s, to provision for the file system.",
+        notes=["Required when `throughput_mode` is `provisioned`, and only then."],
+    )
+    lifecycle: Optional[LifecycleModel] = Field(
+        description="When files move between storage classes."
+    )
+    expected_size_gib: Optional[float] = Field(
+        gt=0,
+        description="""The amount of data, in GiB, expected to be stored in the
+                       Standard storage class. It's used to estimate the
+                       baseline throughput of a file system in bursting mode.""",
+    )
+    alarms: Optional[AlarmsModel] = Field(
+        description="CloudWatch alarms on the file system's throughput."
+    )
+    access_points: List[AccessPointModel] = Field(
+        [],
+        description="Access points to create.",
+        notes=[
+            """The ID of each access point is exported as
+               `<stack name>-accessPoint-<name>`, so services can each mount
+               their own directory of one file system."""
+        ],
+    )
     allow: List[AllowModel] = Field([], description="Rules to allow inbound traffic.")
     mount_targets: List[MountTargetModel] = Field(
         [], description="Mount targets to create."
     )
+
+    @root_validator
+    def performance_settings(cls, values):
+        extra_opts = values.get("filesystem_extra_opts") or {}
+        for opt, field in TYPED_FILESYSTEM_OPTS.items():
+            if values.get(field) is not None and opt in extra_opts:
+                raise ValueError(
+                    f"{field} and filesystem_extra_opts.{opt} can't both be set"
+                )
+        mode = filesystem_setting(values, "throughput_mode", "bursting")
+        provisioned = filesystem_setting(values, "provisioned_throughput_mibps")
+        if mode == "provisioned" and provisioned is None:
+            raise ValueError(
+                "provisioned_throughput_mibps is required when throughput_mode is provisioned"
+            )
+        if mode != "provisioned" and provisioned is not None:
+            raise ValueError(
+                "provisioned_throughput_mibps requires throughput_mode: provisioned"
+            )
+        performance = filesystem_setting(values, "performance_mode")
+        if mode == "elastic" and performance == "maxIO":
+            raise ValueError(
+                "throughput_mode elastic requires performance_mode generalPurpose"
+            )
+        lifecycle = values.get("lifecycle")
+        if lifecycle and lifecycle.transition_to_archive and mode != "elastic":
+            raise ValueError(
+                "lifecycle.transition_to_archive requires throughput_mode: elastic"
+            )
+        return values
+
+    @validator("access_points")
+    def unique_access_point_names(cls, v):
+        # Names become logical IDs, so they must still differ once cleaned.
+        titles = [clean_title(ap.name) for ap in v]
+        if len(titles) != len(set(titles)):
+            raise ValueError("access point names must be unique")
+        return v
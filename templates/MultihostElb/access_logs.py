@@ -0,0 +1,349 @@
+import yaml
+from troposphere import GetAtt, Join, Ref, Split, Sub
+from troposphere.athena import (
+    NamedQuery,
+    ResultConfiguration,
+    WorkGroup,
+    WorkGroupConfiguration,
+)
+from troposphere.events import Rule, Target
+from troposphere.glue import (
+    Column,
+    Database,
+    DatabaseInput,
+    SerdeInfo,
+    StorageDescriptor,
+    Table,
+    TableInput,
+)
+from troposphere.stepfunctions import StateMachine
+
+import iam
+from util import add_output, add_resource, read_resource
+
+# Application Load Balancer access log fields, in order.
+# https://docs.aws.amazon.com/elasticloadbalancing/latest/application/load-balancer-access-logs.html
+COLUMNS = [
+    ("type", "string"),
+    ("time", "string"),
+    ("elb", "string"),
+    ("client_ip", "string"),
+    ("client_port", "int"),
+    ("target_ip", "string"),
+    ("target_port", "int"),
+    ("request_processing_time", "double"),
+    ("target_processing_time", "double"),
+    ("response_processing_time", "double"),
+    ("elb_status_code", "int"),
+    ("target_status_code", "string"),
+    ("received_bytes", "bigint"),
+    ("sent_bytes", "bigint"),
+    ("request_verb", "string"),
+    ("request_url", "string"),
+    ("request_proto", "string"),
+    ("user_agent", "string"),
+    ("ssl_cipher", "string"),
+    ("ssl_protocol", "string"),
+    ("target_group_arn", "string"),
+    ("trace_id", "string"),
+    ("domain_name", "string"),
+    ("chosen_cert_arn", "string"),
+    ("matched_rule_priority", "string"),
+    ("request_creation_time", "string"),
+    ("actions_executed", "string"),
+    ("redirect_url", "string"),
+    ("lambda_error_reason", "string"),
+    ("target_port_list", "string"),
+    ("target_status_code_list", "string"),
+    ("classification", "string"),
+    ("classification_reason", "string"),
+    ("conn_trace_id", "string"),
+]
+
+# Matches one access log entry, with a group per column.
+LOG_REGEX = (
+    r"([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) "
+    r"([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) "
+    r'"([^ ]*) (.*) (- |[^ ]*)" "([^"]*)" ([A-Z0-9-_]+) ([A-Za-z0-9.-]*) '
+    r'([^ ]*) "([^"]*)" "([^"]*)" "([^"]*)" ([-.0-9]*) ([^ ]*) "([^"]*)" '
+    r'"([^"]*)" "([^ ]*)" "([^\s]+?)" "([^\s]+)" "([^ ]*)" "([^ ]*)" ?([^ ]*)?'
+)
+
+RAW_TABLE = "access_logs"
+PARQUET_TABLE = "access_logs_parquet"
+
+# Saved latency queries, by the columns they group on.
+LATENCY_QUERIES = {
+    "TargetGroup": ["target_group_arn"],
+    "Host": ["domain_name"],
+    "TargetGroupAndHost": ["target_group_arn", "domain_name"],
+}
+
+
+def s3_base(al):
+    bucket = al.bucket or "${LogBucket}"
+    return f"s3://{bucket}/{al.prefix_expr}"
+
+
+def bucket_arn(al):
+    if al.bucket:
+        return Sub("arn:${AWS::Partition}:s3:::" + al.bucket)
+    return GetAtt("LogBucket", "Arn")
+
+
+def database(analytics):
+    # Athena doesn't allow dashes in database names.
+    name = analytics.database or Join("_", Split("-", Ref("AWS::StackName")))
+    return add_resource(
+        Database(
+            "AccessLogsDatabase",
+            CatalogId=Ref("AWS::AccountId"),
+            DatabaseInput=DatabaseInput(Name=name),
+        )
+    )
+
+
+def raw_table(al, db):
+    location = (
+        s3_base(al) + "/AWSLogs/${AWS::AccountId}/elasticloadbalancing/${AWS::Region}/"
+    )
+    return add_resource(
+        Table(
+            "AccessLogsTable",
+            CatalogId=Ref("AWS::AccountId"),
+            DatabaseName=Ref(db),
+            TableInput=TableInput(
+                Name=RAW_TABLE,
+                TableType="EXTERNAL_TABLE",
+                # Days are projected from the S3 path, so queries only list the
+                # days they ask for and new days never need to be loaded.
+                Parameters={
+                    "EXTERNAL": "true",
+                    "projection.enabled": "true",
+                    "projection.day.type": "date",
+                    "projection.day.format": "yyyy/MM/dd",
+                    "projection.day.range": f"{al.analytics.projection_start},NOW",
+                    "projection.day.interval": "1",
+                    "projection.day.interval.unit": "DAYS",
+                    "storage.location.template": Sub(location + "${!day}"),
+                },
+                PartitionKeys=[Column(Name="day", Type="string")],
+                StorageDescriptor=StorageDescriptor(
+                    Columns=[Column(Name=n, Type=t) for n, t in COLUMNS],
+                    Location=Sub(location),
+                    InputFormat="org.apache.hadoop.mapred.TextInputFormat",
+                    OutputFormat="org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
+                    SerdeInfo=SerdeInfo(
+                        SerializationLibrary="org.apache.hadoop.hive.serde2.RegexSerDe",
+                        Parameters={
+                            "serialization.format": "1",
+                            "input.regex": LOG_REGEX,
+                        },
+                    ),
+                ),
+            ),
+        )
+    )
+
+
+def parquet_table(al, db):
+    # Unlike the raw table, the days are catalog partitions which the
+    # compaction query adds as it writes each day.
+    return add_resource(
+        Table(
+            "AccessLogsParquetTable",
+            CatalogId=Ref("AWS::AccountId"),
+            DatabaseName=Ref(db),
+            TableInput=TableInput(
+                Name=PARQUET_TABLE,
+                TableType="EXTERNAL_TABLE",
+                Parameters={
+                    "EXTERNAL": "true",
+                    "classification": "parquet",
+                    "parquet.compression": "SNAPPY",
+                },
+                PartitionKeys=[Column(Name="day", Type="string")],
+                StorageDescriptor=StorageDescriptor(
+                    Columns=[Column(Name=n, Type=t) for n, t in COLUMNS],
+                    Location=Sub(s3_base(al) + "/parquet/"),
+                    InputFormat="org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                    OutputFormat="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+                    SerdeInfo=SerdeInfo(
+                        SerializationLibrary="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+                    ),
+                ),
+            ),
+        )
+    )
+
+
+def work_group(al):
+    return add_resource(
+        WorkGroup(
+            "AccessLogsWorkGroup",
+            Name=Sub("${AWS::StackName}-access-logs"),
+            RecursiveDeleteOption=True,
+            WorkGroupConfiguration=WorkGroupConfiguration(
+                EnforceWorkGroupConfiguration=True,
+                PublishCloudWatchMetricsEnabled=True,
+                ResultConfiguration=ResultConfiguration(
+                    OutputLocation=Sub(s3_base(al) + "/athena-results/")
+                ),
+            ),
+        )
+    )
+
+
+def latency_query(table, day_format, group_by):
+    columns = ", ".join(group_by)
+    return "\n".join(
+        [
+            f"SELECT {columns},",
+            "  count(*) AS requests,",
+            "  approx_percentile(target_processing_time, 0.50) AS p50,",
+            "  approx_percentile(target_processing_time, 0.95) AS p95,",
+            "  approx_percentile(target_processing_time, 0.99) AS p99",
+            f"FROM {table}",
+            f"WHERE day >= date_format(current_date - interval '7' day, '{day_format}')",
+            # Requests which never reached a target are logged with -1.
+            "  AND target_processing_time >= 0",
+            f"GROUP BY {columns}",
+            "ORDER BY p99 DESC",
+        ]
+    )
+
+
+def latency_queries(db, wg, compacted):
+    table, day_format = (
+        (PARQUET_TABLE, "%Y-%m-%d") if compacted else (RAW_TABLE, "%Y/%m/%d")
+    )
+    for title, group_by in LATENCY_QUERIES.items():
+        add_resource(
+            NamedQuery(
+                f"AccessLogsLatencyBy{title}Query",
+                Name=Sub("${AWS::StackName} latency by " + " and ".join(group_by)),
+                Description="p50, p95 and p99 target processing time over the last 7 days",
+                Database=Ref(db),
+                WorkGroup=Ref(wg),
+                QueryString=latency_query(table, day_format, group_by),
+            )
+        )
+
+
+def compaction_query():
+    columns = ", ".join(n for n, _ in COLUMNS)
+    return (
+        f"INSERT INTO {PARQUET_TABLE} "
+        f"SELECT {columns}, replace(day, '/', '-') AS day "
+        f"FROM {RAW_TABLE} WHERE day = ?"
+    )
+
+
+def compaction_role(al):
+    glue_arn = "arn:${AWS::Partition}:glue:${AWS::Region}:${AWS::AccountId}"
+    return add_resource(
+        iam.role(
+            "AccessLogsCompactionRole",
+            allow_assume=[iam.STATES_SERVICE],
+            policies=[
+                iam.policy(
+                    "inline",
+                    statements=[
+                        iam.statement(
+                            [
+                                "athena:GetQueryExecution",
+                                "athena:StartQueryExecution",
+                                "athena:StopQueryExecution",
+                            ],
+                            [
+                                Sub(
+                                    "arn:${AWS::Partition}:athena:${AWS::Region}:"
+                                    "${AWS::AccountId}:workgroup/${AccessLogsWorkGroup}"
+                                )
+                            ],
+                        ),
+                        iam.statement(
+                            [
+                                "glue:BatchCreatePartition",
+                                "glue:CreatePartition",
+                                "glue:GetDatabase",
+                                "glue:GetPartition",
+                                "glue:GetPartitions",
+                                "glue:GetTable",
+                            ],
+                            [
+                                Sub(glue_arn + ":catalog"),
+                                Sub(glue_arn + ":database/${AccessLogsDatabase}"),
+                                Sub(glue_arn + ":table/${AccessLogsDatabase}/*"),
+                            ],
+                        ),
+                        iam.statement(
+                            ["s3:GetBucketLocation", "s3:ListBucket"],
+                            [bucket_arn(al)],
+                        ),
+                        iam.statement(
+                            [
+                                "s3:AbortMultipartUpload",
+                                "s3:GetObject",
+                                "s3:ListMultipartUploadParts",
+                                "s3:PutObject",
+                            ],
+                            [Join("", [bucket_arn(al), "/*"])],
+                        ),
+                    ],
+                )
+            ],
+        )
+    )
+
+
+def compaction(al, db, wg):
+    role = compaction_role(al)
+    state_machine = add_resource(
+        StateMachine(
+            "AccessLogsCompactionStateMachine",
+            Definition=yaml.safe_load(
+                read_resource("CompactAccessLogsStateMachine.yaml")
+            ),
+            DefinitionSubstitutions={
+                "database": Ref(db),
+                "work_group": Ref(wg),
+                "insert_query": compaction_query(),
+            },
+            RoleArn=GetAtt(role, "Arn"),
+        )
+    )
+    events_role = add_resource(
+        iam.role(
+            "AccessLogsCompactionScheduleRole",
+            allow_assume=[iam.EVENTS_SERVICE],
+            allow={"states:StartExecution": Ref(state_machine)},
+        )
+    )
+    add_resource(
+        Rule(
+            "AccessLogsCompactionSchedule",
+            Description=Sub("Compacts ${AWS::StackName} access logs into Parquet"),
+            ScheduleExpression=al.analytics.compaction_schedule,
+            Targets=[
+                Target(
+                    Id="CompactAccessLogs",
+                    Arn=Ref(state_machine),
+                    RoleArn=GetAtt(events_role, "Arn"),
+                )
+            ],
+        )
+    )
+
+
+def add_access_log_analytics(al):
+    db = database(al.analytics)
+    raw_table(al, db)
+    wg = work_group(al)
+    if al.analytics.compact_to_parquet:
+        parquet_table(al, db)
+        compaction(al, db, wg)
+    latency_queries(db, wg, al.analytics.compact_to_parquet)
+
+    add_output("AccessLogsDatabase", Ref(db))
+    add_output("AccessLogsWorkGroup", Ref(wg))
@@ -0,0 +1 @@
+../../lib/iam.py
\ No newline at end of file
@@ -27,6 +27,7 @@ from troposphere.elasticloadbalancingv2 import (
     TargetGroupAttribute,
 )
 
+import access_logs
 import waf
 
 if int(troposphere.__version__.split(".")[0]) > 3:
@@ -61,6 +62,7 @@ from util import (
     sceptre_handle,
 )
 import elb
+from rules import compile_rules, paths_with
 
 
 def hostname_to_fqdn(user_data, hostname):
@@ -388,15 +390,6 @@ def action_with(user_data, title_context, action_data, action_type=ListenerRuleA
     return action_type(TargetGroupArn=Ref(tg), Type="forward")
 
 
-def paths_with(path_data):
-    if isinstance(path_data, str):
-        return [path_data]
-    for path in path_data:
-        yield path
-        if "*" not in path and path[-1] != "/":
-            yield path + "/*"
-
-
 def normalize_condition_data(user_data, rule_data):
     hosts = [hostname_to_fqdn(user_data, h) for h in rule_data.hosts]
     paths = rule_data.paths
@@ -464,8 +457,8 @@ def conditions_with(user_data, cond_data):
     return conditions
 
 
-def listener_rule(user_data, listener_ref, rule_data):
-    rule_title = rule_data.rule_title or "Rule{}".format(
+def listener_rule_title(listener_ref, rule_data):
+    return rule_data.rule_title or "Rule{}".format(
         md5(
             listener_ref.data,
             rule_data.paths,
@@ -474,6 +467,10 @@ def listener_rule(user_data, listener_ref, rule_data):
             rule_data.priority,
         )[:7]
     )
+
+
+def listener_rule(user_data, listener_ref, rule_data):
+    rule_title = listener_rule_title(listener_ref, rule_data)
     cond_data = normalize_condition_data(user_data, rule_data)
     action = action_with(user_data, rule_title, rule_data)
 
@@ -531,7 +528,16 @@ def listener(user_data, listener_data):
         )
     )
 
-    for rule_data in listener_data.rules:
+    rules = listener_data.rules
+    if listener_data.compile_rules:
+        rules = compile_rules(
+            port,
+            rules,
+            partial(listener_rule_title, Ref(ret)),
+            partial(hostname_to_fqdn, user_data),
+        )
+
+    for rule_data in rules:
         listener_rule(user_data, Ref(ret), rule_data)
 
     # For some reason, even though the listener accepts a list of certificate ARNs, you're only allowed to put ONE in
@@ -759,6 +765,9 @@ def main(data):
     for lsn in data.listeners:
         listener(data, lsn)
 
+    if data.access_logs and data.access_logs.analytics:
+        access_logs.add_access_log_analytics(data.access_logs)
+
     elb_cnames(data)
     target_ingress_rules(data)
 
@@ -1,3 +1,4 @@
+from datetime import date
 from typing import Dict, List, Literal, Optional, Union
 
 from pydantic import Field, constr, root_validator, validator
@@ -281,6 +282,30 @@ class ListenerModel(BaseModel):
     rules: List[RuleModel] = Field(
         [], description="Listener rules to direct requests beyond the default action."
     )
+    compile_rules = Field(
+        False,
+        description="""When true, `rules` are merged and ordered before they're
+                       added to the listener. Rules with the same action,
+                       hosts, query strings and source IPs are merged into one
+                       rule matching all of their paths, and rules without a
+                       `priority` are numbered from the most specific path to
+                       the least.""",
+        notes=[
+            """A rule is only merged when no rule with a different action
+               could match the same requests, so merging never changes where
+               a request goes. Merged rules stay within the load balancer's
+               limit of 5 condition values per rule.""",
+            """An error is raised when the compiled rules exceed the load
+               balancer's quotas of 100 rules per listener or 5 condition
+               values per rule.""",
+            """A merged rule and its target group keep the logical IDs of the
+               first rule. The rule counts before and after compiling are
+               printed when the template is generated.""",
+            """Turning this on for an existing stack changes rule priorities,
+               which may conflict with priorities still in use during the
+               update. Updating in two steps avoids that.""",
+        ],
+    )
     ssl_policy: Optional[str] = Field(
         description="""The name of the SSL Policy for the listener. The default
                        is the current predefined security policy.""",
@@ -348,6 +373,40 @@ class NsUpdateModel(BaseModel):
         return values
 
 
+class AccessLogsAnalyticsModel(BaseModel):
+    database: Optional[str] = Field(
+        description="""Name of the Glue database created for the access log
+                       tables. Use lowercase letters, digits and underscores.""",
+        default_description="The stack name with dashes replaced by underscores",
+    )
+    projection_start = Field(
+        "2024/01/01",
+        description="""The first day, as `yyyy/MM/dd`, which the `access_logs`
+                       table has partitions for.""",
+    )
+    compact_to_parquet = Field(
+        False,
+        description="""When true, a scheduled Step Functions state machine
+                       copies each day's logs into the `access_logs_parquet`
+                       table with an Athena query.""",
+        notes=[
+            """Queries of the Parquet table read only the columns they use,
+               which is much less data than the gzipped logs.""",
+            """A day's logs are copied after the day ends, so the Parquet
+               table doesn't include the current day. Earlier days can be
+               copied by starting the state machine with an input like
+               `{"day": "2024/01/31"}`. Copying a day twice duplicates its
+               rows.""",
+            """The Parquet files are kept under the access log prefix, so
+               they're purged with the logs.""",
+        ],
+    )
+    compaction_schedule = Field(
+        "cron(30 1 * * ? *)",
+        description="The EventBridge schedule expression for compacting the previous day's logs.",
+    )
+
+
 class AccessLogsModel(BaseModel):
     enabled = Field(True, description="When `True` requests to the ELB will be logged.")
     retain_days = Field(
@@ -374,6 +433,25 @@ class AccessLogsModel(BaseModel):
         for details."""
         ],
     )
+    analytics: Optional[AccessLogsAnalyticsModel] = Field(
+        description="""Creates a Glue database with an `access_logs` table for
+                       querying the logs with Athena, an Athena workgroup, and
+                       saved queries of the p50, p95 and p99 target processing
+                       time by target group and host.""",
+        notes=[
+            """The table's `day` partitions are projected from the S3 path,
+               so a query filtering on `day` only reads those days' logs.""",
+            """Query results are stored under `athena-results/` in the access
+               log prefix.""",
+            """Requires `enabled`, since there are no logs to query otherwise.""",
+        ],
+    )
+
+    @root_validator
+    def analytics_requires_logging(cls, values):
+        if values.get("analytics") and not values.get("enabled"):
+            raise ValueError("access_logs.analytics requires access_logs.enabled")
+        return values
 
 
 class HasWafVisibility(BaseModel):
@@ -454,7 +532,7 @@ class WafManagedRulesetModel(BaseModel):
 
 class WafAclRuleModel(HasWafVisibility):
     name: str
-    action: Optional[Literal["allow", "deny"]]
+    action: Optional[Literal["allow", "block"]]
     override_action: Optional[Literal["count", "none"]] = Field(
         description="""The override action to apply to the rules in a rule group, instead of the
                        individual rule action settings. This is used only for
@@ -511,6 +589,10 @@ class WafFirehoseS3LoggingModel(BaseModel):
         description="""The type of compression that Kinesis Data Firehose uses
                        to compress the data that it delivers to the Amazon S3
                        bucket.""",
+        notes=[
+            """Ignored when `record_format` is `parquet`, since Parquet files
+               are compressed with Snappy internally."""
+        ],
     )
     buffer_seconds = Field(
         300,
@@ -518,16 +600,63 @@ class WafFirehoseS3LoggingModel(BaseModel):
                        Firehose buffers incoming data before delivering it to
                        the destination.""",
     )
-    buffer_mb = Field(
-        5,
+    buffer_mb: Optional[int] = Field(
         description="""The size of the buffer, in MBs, that Kinesis Data
                        Firehose uses for incoming data before delivering it to
                        the destination.""",
+        default_description="""5, or 128 when `record_format` is `parquet` or
+                               `dynamic_partitioning` is enabled""",
+        notes=[
+            """Larger buffers deliver fewer, larger objects, which are cheaper
+               to store and quicker to query."""
+        ],
+    )
+    record_format: Literal["json", "parquet"] = Field(
+        "json",
+        description="""The format of the delivered logs. With `parquet`, a Glue
+                       table of the WAF log schema is created for Firehose to
+                       convert the records with, and for querying the logs
+                       with Athena.""",
+        notes=[
+            """The table is named after the ACL's logging configuration, like
+               `acl_prod_external_alb_logging_firehose_delivery_stream`, in a
+               database named after the stack with a `_waf` suffix."""
+        ],
+    )
+    dynamic_partitioning = Field(
+        False,
+        description="""When true, logs are delivered under
+                       `day=<yyyy-MM-dd>/action=<action>/` following
+                       `prefix_expr`, so that queries can skip the days and
+                       actions they don't need.""",
+        notes=[
+            """With `parquet`, the Glue table projects these partitions, so
+               they never have to be loaded."""
+        ],
+    )
+    projection_start: date = Field(
+        date(2024, 1, 1),
+        default_description="`2024-01-01`",
+        description="""The first day, as `yyyy-MM-dd`, which the Glue table has
+                       `day` partitions for.""",
+        notes=["Only used with `record_format: parquet` and `dynamic_partitioning`."],
     )
     cloudwatch_enabled = Field(
         True, description="If enabled, delivery errors will be logged to CloudWatch"
     )
 
+    @root_validator
+    def buffer_size_for_conversion(cls, values):
+        buffer_mb = values.get("buffer_mb")
+        converting = values.get("record_format") == "parquet" or values.get(
+            "dynamic_partitioning"
+        )
+        if converting and buffer_mb is not None and buffer_mb < 64:
+            raise ValueError(
+                "buffer_mb must be at least 64 with parquet or dynamic_partitioning"
+            )
+        return values
+
 
 class WafFirehoseLoggingModel(BaseModel):
     s3: WafFirehoseS3LoggingModel
@@ -535,6 +664,15 @@ class WafFirehoseLoggingModel(BaseModel):
 
 class WafLoggingModel(BaseModel):
     firehose: WafFirehoseLoggingModel
+    exclude_allowed_requests = Field(
+        False,
+        description="""When true, requests which the ACL allowed aren't logged.
+                       Blocked and counted requests still are.""",
+        notes=[
+            """This is a logging filter of the ACL's logging configuration,
+               so WAF drops the records before they reach Firehose."""
+        ],
+    )
 
 
 class WafAclModel(HasWafVisibility):
@@ -545,6 +683,31 @@ class WafAclModel(HasWafVisibility):
     )
     rules: List[WafAclRuleModel]
     acl_tags: Dict[str, str] = {}
+    capacity_limit = Field(
+        1500,
+        description="""The web ACL capacity units (WCU) the rules may use. The
+                       rules' WCU is estimated when the template is generated,
+                       and an error is raised when it's over this limit.""",
+        notes=[
+            """The estimate covers IP sets, regex sets with their text
+               transformations and the AWS managed rule groups. Other rule
+               groups are reported and left out.""",
+            """Web ACLs using over 1500 WCU are charged for the extra
+               capacity.""",
+        ],
+    )
+    optimize_rule_order = Field(
+        False,
+        description="""When true, cheaper rules are moved ahead of more
+                       expensive rules where that can't change a request's
+                       outcome, so that fewer requests are inspected by
+                       expensive rules.""",
+        notes=[
+            """Rules are only reordered among consecutive rules with the same
+               action, reusing their priorities. Managed rule groups stay in
+               place. Every move is printed when the template is generated.""",
+        ],
+    )
     logging: Optional[WafLoggingModel] = Field(
         description="Options for WAF traffic logging"
     )
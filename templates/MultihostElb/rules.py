@@ -0,0 +1,187 @@
+import json
+import re
+from fnmatch import fnmatchcase
+
+from model import ActionModel
+from util import debug
+
+# Application Load Balancer quotas.
+RULES_PER_LISTENER = 100
+CONDITION_VALUES_PER_RULE = 5
+
+# Compiled rules are numbered from here, leaving room for explicit priorities.
+FIRST_PRIORITY = 1000
+PRIORITY_STEP = 10
+
+
+def paths_with(path_data):
+    if isinstance(path_data, str):
+        return [path_data]
+    for path in path_data:
+        yield path
+        if "*" not in path and path[-1] != "/":
+            yield path + "/*"
+
+
+def literal_prefix(pattern):
+    return re.split(r"[*?]", pattern, maxsplit=1)[0]
+
+
+def patterns_overlap(a, b):
+    """Returns true when some value might match both wildcard patterns. This
+    errs on the side of reporting an overlap."""
+    if fnmatchcase(a.replace("*", "").replace("?", "x"), b):
+        return True
+    if fnmatchcase(b.replace("*", "").replace("?", "x"), a):
+        return True
+    wild = set("*?")
+    if wild & set(a) and wild & set(b):
+        pa, pb = literal_prefix(a), literal_prefix(b)
+        return pa.startswith(pb) or pb.startswith(pa)
+    return False
+
+
+def any_overlap(xs, ys):
+    # No values means the condition isn't used, which matches everything.
+    if not xs or not ys:
+        return True
+    return any(patterns_overlap(x, y) for x in xs for y in ys)
+
+
+def condition_values(rule):
+    return (
+        len(rule.hosts)
+        + len(list(paths_with(rule.paths)))
+        + len(rule.match_query_string)
+        + len(rule.source_ips)
+    )
+
+
+def merge_key(rule):
+    """Rules with the same key can be merged into one by joining their
+    paths."""
+    return json.dumps(
+        [
+            rule.dict(include=set(ActionModel.__fields__)),
+            sorted(rule.hosts),
+            [q.dict() for q in rule.match_query_string],
+            sorted(rule.source_ips),
+        ],
+        sort_keys=True,
+        default=str,
+    )
+
+
+def mergeable(rule, rules, fqdn):
+    """A rule can be merged when its order among the other rules doesn't
+    matter, which is when no rule with a different action or conditions
+    could match the same requests."""
+    if rule.priority is not None or not rule.paths:
+        return False
+    hosts = [fqdn(h).lower() for h in rule.hosts]
+    paths = list(paths_with(rule.paths))
+    key = merge_key(rule)
+    for other in rules:
+        if other is rule or merge_key(other) == key:
+            continue
+        other_hosts = [fqdn(h).lower() for h in other.hosts]
+        if any_overlap(hosts, other_hosts) and any_overlap(
+            paths, list(paths_with(other.paths))
+        ):
+            return False
+    return True
+
+
+def specificity(rule, fqdn):
+    """Sort key which puts rules matching fewer requests first."""
+    paths = list(paths_with(rule.paths))
+    hosts = [fqdn(h) for h in rule.hosts]
+    return (
+        # Host only rules act as each host's default action.
+        0 if paths else 1,
+        -max([len(literal_prefix(p)) for p in paths], default=0),
+        -(bool(rule.match_query_string) + bool(rule.source_ips)),
+        -max([len(literal_prefix(h)) for h in hosts], default=0),
+    )
+
+
+def merge(rules, title_fn, fqdn):
+    """Merges rules with the same action and conditions, other than their
+    paths, as long as the merged rule stays within the condition value
+    quota. Returns each resulting rule with the number of rules it replaces.
+    A merged rule is named after the first of its rules."""
+    ret = []
+    open_groups = {}
+    for rule in rules:
+        titled = rule.copy(update={"rule_title": title_fn(rule)})
+        if mergeable(rule, rules, fqdn):
+            key = merge_key(rule)
+            i = open_groups.get(key)
+            if i is not None:
+                first, count = ret[i]
+                paths = list(dict.fromkeys(first.paths + rule.paths))
+                candidate = first.copy(update={"paths": paths})
+                if condition_values(candidate) <= CONDITION_VALUES_PER_RULE:
+                    ret[i] = (candidate, count + 1)
+                    continue
+            open_groups[key] = len(ret)
+        ret.append((titled, 1))
+    return ret
+
+
+def prioritize(rules, fqdn):
+    """Numbers the rules without an explicit priority in order of
+    specificity, skipping priorities which are already taken."""
+    taken = {r.priority for r in rules if r.priority is not None}
+    auto = sorted(
+        [r for r in rules if r.priority is None],
+        key=lambda r: specificity(r, fqdn),
+    )
+    priorities = {}
+    priority = FIRST_PRIORITY
+    for rule in auto:
+        while priority in taken:
+            priority += 1
+        priorities[rule.rule_title] = priority
+        priority += PRIORITY_STEP
+    return [
+        r
+        if r.priority is not None
+        else r.copy(update={"priority": priorities[r.rule_title]})
+        for r in rules
+    ]
+
+
+def validate(port, rules):
+    if len(rules) > RULES_PER_LISTENER:
+        raise ValueError(
+            f"listener on port {port} has {len(rules)} rules after merging, "
+            f"the quota is {RULES_PER_LISTENER}"
+        )
+    for rule in rules:
+        n = condition_values(rule)
+        if n > CONDITION_VALUES_PER_RULE:
+            raise ValueError(
+                f"rule {rule.rule_title} on port {port} has {n} condition values, "
+                f"the quota is {CONDITION_VALUES_PER_RULE}"
+            )
+    priorities = [r.priority for r in rules]
+    if len(priorities) != len(set(priorities)):
+        raise ValueError(f"listener on port {port} has duplicate rule priorities")
+
+
+def compile_rules(port, rules, title_fn, fqdn):
+    """Returns the listener's rules with identical rules merged, priorities
+    assigned by specificity and titles set. Raises a ValueError when the
+    result exceeds a load balancer quota."""
+    merged = merge(rules, title_fn, fqdn)
+    compiled = prioritize([r for r, _ in merged], fqdn)
+    validate(port, compiled)
+
+    debug(f"Listener on port {port}: {len(rules)} rules compiled to {len(compiled)}")
+    counts = {rule.rule_title: count for rule, count in merged}
+    for rule in sorted(compiled, key=lambda r: r.priority):
+        count = counts[rule.rule_title]
+        note = f", merged from {count} rules" if count > 1 else ""
+        debug(f"  {rule.priority} {rule.rule_title}{note}")
+    return compiled
@@ -4,19 +4,39 @@ from troposphere.firehose import BufferingHints as FirehoseBufferingHints
 from troposphere.firehose import (
     CloudWatchLoggingOptions as FirehoseCloudWatchLoggingOptions,
 )
+from troposphere.firehose import (
+    DataFormatConversionConfiguration,
+    Deserializer,
+    DynamicPartitioningConfiguration,
+    ExtendedS3DestinationConfiguration,
+    InputFormatConfiguration,
+    OpenXJsonSerDe,
+    OutputFormatConfiguration,
+    ParquetSerDe,
+    Processor,
+    ProcessingConfiguration,
+    ProcessorParameter,
+    RetryOptions,
+    SchemaConfiguration,
+    Serializer,
+)
 from troposphere.firehose import DeliveryStream as FirehoseDeliveryStream
 from troposphere.firehose import S3DestinationConfiguration as FirehoseS3DestinationConf
 from troposphere.iam import Policy as IamPolicy
 from troposphere.iam import Role as IamRole
 from troposphere.logs import LogGroup, LogStream
 from troposphere.wafv2 import (
+    ActionCondition,
+    Condition,
     DefaultAction,
     ExcludedRule,
     FieldToMatch,
+    Filter,
     IPSet,
     IPSetReferenceStatement,
 )
 from troposphere.wafv2 import LoggingConfiguration as WafLoggingConf
+from troposphere.wafv2 import LoggingFilter
 from troposphere.wafv2 import (
     ManagedRuleGroupStatement,
     OverrideAction,
@@ -38,7 +58,19 @@ from troposphere.wafv2 import (
     WebACLRule,
 )
 
-from util import add_resource, add_resource_once, clean_title, md5, opts_with, tags_with
+import waf_capacity
+import waf_log_table
+from util import (
+    add_resource,
+    add_resource_once,
+    clean_title,
+    debug,
+    md5,
+    opts_with,
+    tags_with,
+)
+
+ip_sets_by_addresses = {}
 
 
 def waf_acl_action(constructor, action):
@@ -58,7 +90,14 @@ def waf_visibility_conf(obj):
 
 
 def waf_ip_set(rule):
-    return add_resource(
+    # Identical IP sets are only created once.
+    key = (rule.ip_address_version, tuple(sorted(set(rule.addresses))))
+    if key in ip_sets_by_addresses:
+        ret = ip_sets_by_addresses[key]
+        debug(f"WAF IP set {rule.name} merged into identical IP set {ret.Name}")
+        return ret
+
+    ret = add_resource(
         IPSet(
             clean_title(f"IPSet{rule.name}"),
             Name=rule.name,
@@ -68,6 +107,8 @@ def waf_ip_set(rule):
             **opts_with(Description=rule.description),
         )
     )
+    ip_sets_by_addresses[key] = ret
+    return ret
 
 
 def waf_rule_ip_set_statement(rule):
@@ -144,6 +185,83 @@ def waf_rule(rule):
     )
 
 
+def waf_log_firehose_extended(s3_model):
+    # Format conversion and dynamic partitioning need an extended destination.
+    return s3_model.record_format == "parquet" or s3_model.dynamic_partitioning
+
+
+def waf_log_firehose_role_statements(s3_model):
+    ret = [
+        {
+            "Effect": "Allow",
+            "Action": [
+                "s3:AbortMultipartUpload",
+                "s3:GetBucketLocation",
+                "s3:GetObject",
+                "s3:ListBucket",
+                "s3:ListBucketMultipartUploads",
+                "s3:PutObject",
+            ],
+            "Resource": [s3_model.bucket_arn, f"{s3_model.bucket_arn}/*"],
+        }
+    ]
+    if s3_model.record_format == "parquet":
+        ret.append(
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "glue:GetTable",
+                    "glue:GetTableVersion",
+                    "glue:GetTableVersions",
+                ],
+                "Resource": "*",
+            }
+        )
+    return ret
+
+
+def waf_log_firehose_format_conf(s3_model, title_prefix, role):
+    table = waf_log_table.glue_table(s3_model, title_prefix)
+    return DataFormatConversionConfiguration(
+        Enabled=True,
+        InputFormatConfiguration=InputFormatConfiguration(
+            Deserializer=Deserializer(OpenXJsonSerDe=OpenXJsonSerDe())
+        ),
+        OutputFormatConfiguration=OutputFormatConfiguration(
+            Serializer=Serializer(ParquetSerDe=ParquetSerDe(Compression="SNAPPY"))
+        ),
+        SchemaConfiguration=SchemaConfiguration(
+            CatalogId=Ref("AWS::AccountId"),
+            DatabaseName=Ref(waf_log_table.glue_database()),
+            TableName=table.TableInput.Name,
+            Region=Ref("AWS::Region"),
+            RoleARN=GetAtt(role, "Arn"),
+            VersionId="LATEST",
+        ),
+    )
+
+
+def waf_log_firehose_processing_conf(s3_model):
+    processors = [
+        Processor(
+            Type="MetadataExtraction",
+            Parameters=[
+                ProcessorParameter(
+                    ParameterName="MetadataExtractionQuery",
+                    ParameterValue=waf_log_table.PARTITION_QUERY,
+                ),
+                ProcessorParameter(
+                    ParameterName="JsonParsingEngine", ParameterValue="JQ-1.6"
+                ),
+            ],
+        )
+    ]
+    if s3_model.record_format == "json":
+        # Otherwise the records of an object aren't separated.
+        processors.append(Processor(Type="AppendDelimiterToRecord"))
+    return ProcessingConfiguration(Enabled=True, Processors=processors)
+
+
 def waf_log_firehose_s3_dest_conf(s3_model, title_prefix):
     role = add_resource(
         IamRole(
@@ -163,20 +281,7 @@ def waf_log_firehose_s3_dest_conf(s3_model, title_prefix):
                     PolicyName="AllowToBucket",
                     PolicyDocument={
                         "Version": "2012-10-17",
-                        "Statement": [
-                            {
-                                "Effect": "Allow",
-                                "Action": [
-                                    "s3:AbortMultipartUpload",
-                                    "s3:GetBucketLocation",
-                                    "s3:GetObject",
-                                    "s3:ListBucket",
-                                    "s3:ListBucketMultipartUploads",
-                                    "s3:PutObject",
-                                ],
-                                "Resource": [s3_model.bucket_arn],
-                            }
-                        ],
+                        "Statement": waf_log_firehose_role_statements(s3_model),
                     },
                 )
             ],
@@ -199,15 +304,22 @@ def waf_log_firehose_s3_dest_conf(s3_model, title_prefix):
             ),
         )
 
-    return FirehoseS3DestinationConf(
+    prefix = s3_model.prefix_expr
+    error_prefix = s3_model.error_prefix_expr
+    if s3_model.dynamic_partitioning:
+        prefix += waf_log_table.PARTITION_PREFIX
+        error_prefix += "!{firehose:error-output-type}/"
+
+    args = dict(
         BucketARN=s3_model.bucket_arn,
         CompressionFormat=s3_model.compression_format,
-        Prefix=Sub(s3_model.prefix_expr),
-        ErrorOutputPrefix=Sub(s3_model.error_prefix_expr),
+        Prefix=Sub(prefix),
+        ErrorOutputPrefix=Sub(error_prefix),
         RoleARN=GetAtt(role, "Arn"),
         BufferingHints=FirehoseBufferingHints(
             **opts_with(
-                IntervalInSeconds=s3_model.buffer_seconds, SizeInMBs=s3_model.buffer_mb
+                IntervalInSeconds=s3_model.buffer_seconds,
+                SizeInMBs=waf_log_firehose_buffer_mb(s3_model),
             )
         ),
         CloudWatchLoggingOptions=FirehoseCloudWatchLoggingOptions(
@@ -216,10 +328,44 @@ def waf_log_firehose_s3_dest_conf(s3_model, title_prefix):
             LogStreamName=log_stream_name,
         ),
     )
+    if not waf_log_firehose_extended(s3_model):
+        return FirehoseS3DestinationConf(**args)
+
+    if s3_model.record_format == "parquet":
+        # Parquet files are compressed internally.
+        args = {
+            **args,
+            "CompressionFormat": "UNCOMPRESSED",
+            "DataFormatConversionConfiguration": waf_log_firehose_format_conf(
+                s3_model, title_prefix, role
+            ),
+        }
+    if s3_model.dynamic_partitioning:
+        args = {
+            **args,
+            "DynamicPartitioningConfiguration": DynamicPartitioningConfiguration(
+                Enabled=True, RetryOptions=RetryOptions(DurationInSeconds=300)
+            ),
+            "ProcessingConfiguration": waf_log_firehose_processing_conf(s3_model),
+        }
+    return ExtendedS3DestinationConfiguration(**args)
+
+
+def waf_log_firehose_buffer_mb(s3_model):
+    if s3_model.buffer_mb is not None:
+        return s3_model.buffer_mb
+    # Larger objects are cheaper to store and quicker to query, and Firehose
+    # requires at least 64 MB for format conversion and dynamic partitioning.
+    return 128 if waf_log_firehose_extended(s3_model) else 5
 
 
 def waf_log_firehose_dest_arn(firehose_model, title_prefix):
     title = f"{title_prefix}FirehoseDeliveryStream"
+    dest_conf = waf_log_firehose_s3_dest_conf(firehose_model.s3, title)
+    if waf_log_firehose_extended(firehose_model.s3):
+        dest_args = {"ExtendedS3DestinationConfiguration": dest_conf}
+    else:
+        dest_args = {"S3DestinationConfiguration": dest_conf}
     return GetAtt(
         add_resource(
             FirehoseDeliveryStream(
@@ -230,9 +376,7 @@ def waf_log_firehose_dest_arn(firehose_model, title_prefix):
                     "aws-waf-logs-${AWS::StackName}-" + title_prefix
                 ),
                 DeliveryStreamType="DirectPut",
-                S3DestinationConfiguration=waf_log_firehose_s3_dest_conf(
-                    firehose_model.s3, title
-                ),
+                **dest_args,
             )
         ),
         "Arn",
@@ -245,17 +389,58 @@ def waf_log_dest_arn(log_model, title_prefix):
     raise ValueError("No WAF logging destinations defined")
 
 
+def waf_logging_filter():
+    return LoggingFilter(
+        DefaultBehavior="KEEP",
+        Filters=[
+            Filter(
+                Behavior="DROP",
+                Requirement="MEETS_ANY",
+                Conditions=[Condition(ActionCondition=ActionCondition(Action="ALLOW"))],
+            )
+        ],
+    )
+
+
 def waf_logging_conf(log_model, title_prefix, acl_resource):
     title = f"{title_prefix}Logging"
+    args = {}
+    if log_model.exclude_allowed_requests:
+        args = {**args, "LoggingFilter": waf_logging_filter()}
     return add_resource(
         WafLoggingConf(
             title,
             ResourceArn=GetAtt(acl_resource, "Arn"),
             LogDestinationConfigs=[waf_log_dest_arn(log_model, title)],
+            **args,
         )
     )
 
 
+def waf_acl_rules(acl):
+    """Returns the ACL's rules, reordered when the ACL asks for it, after
+    reporting their estimated capacity. Raises a ValueError when the estimate
+    is over the ACL's capacity limit."""
+    rules = acl.rules
+    if acl.optimize_rule_order:
+        rules, changes = waf_capacity.reorder(rules)
+        for name, old, new in changes:
+            debug(f"WAF ACL {acl.name}: rule {name} moved from priority {old} to {new}")
+
+    wcu, unknown = waf_capacity.estimate(rules)
+    debug(f"WAF ACL {acl.name}: estimated {wcu} WCU of {acl.capacity_limit}")
+    for rule in sorted(rules, key=lambda r: r.priority):
+        debug(f"  {rule.priority} {rule.name}: {waf_capacity.rule_wcu(rule)} WCU")
+    if unknown:
+        debug(f"  WCU of rule groups {', '.join(unknown)} is unknown")
+    if wcu > acl.capacity_limit:
+        raise ValueError(
+            f"WAF ACL {acl.name} needs an estimated {wcu} WCU, "
+            f"over its capacity_limit of {acl.capacity_limit}"
+        )
+    return rules
+
+
 def waf_acl(acl):
     title = clean_title(f"Acl{acl.name}")
     ret = add_resource(
@@ -263,7 +448,7 @@ def waf_acl(acl):
             title,
             DefaultAction=waf_acl_action(DefaultAction, acl.default_action),
             Scope="REGIONAL",
-            Rules=[waf_rule(r) for r in acl.rules],
+            Rules=[waf_rule(r) for r in waf_acl_rules(acl)],
             VisibilityConfig=waf_visibility_conf(acl),
             **tags_with(acl.acl_tags),
             **opts_with(Description=acl.description, Name=acl.name),
@@ -0,0 +1,99 @@
+from itertools import groupby
+
+# Web ACL capacity units (WCU) of the statements used by WafAclRuleModel.
+# https://docs.aws.amazon.com/waf/latest/developerguide/aws-waf-capacity-units.html
+IP_SET_WCU = 1
+REGEX_SET_WCU = 25
+TEXT_TRANSFORMATION_WCU = 10
+
+# Inspecting a JSON body costs twice as much as other fields.
+DOUBLE_COST_FIELDS = ["JsonBody"]
+
+# Capacity of the AWS managed rule groups.
+MANAGED_RULE_GROUP_WCU = {
+    "AWSManagedRulesACFPRuleSet": 50,
+    "AWSManagedRulesATPRuleSet": 50,
+    "AWSManagedRulesAdminProtectionRuleSet": 100,
+    "AWSManagedRulesAmazonIpReputationList": 25,
+    "AWSManagedRulesAnonymousIpList": 50,
+    "AWSManagedRulesBotControlRuleSet": 50,
+    "AWSManagedRulesCommonRuleSet": 700,
+    "AWSManagedRulesKnownBadInputsRuleSet": 200,
+    "AWSManagedRulesLinuxRuleSet": 200,
+    "AWSManagedRulesPHPRuleSet": 100,
+    "AWSManagedRulesSQLiRuleSet": 200,
+    "AWSManagedRulesUnixRuleSet": 100,
+    "AWSManagedRulesWindowsRuleSet": 200,
+    "AWSManagedRulesWordPressRuleSet": 100,
+}
+
+
+def field_name(field_to_match):
+    if type(field_to_match) is str:
+        return field_to_match
+    return next(iter(field_to_match), None)
+
+
+def regex_set_wcu(regex_set):
+    base = REGEX_SET_WCU
+    if field_name(regex_set.field_to_match) in DOUBLE_COST_FIELDS:
+        base *= 2
+    transforms = [
+        t for t in regex_set.text_transformations if t.transform_type != "NONE"
+    ]
+    return base + TEXT_TRANSFORMATION_WCU * len(transforms)
+
+
+def rule_wcu(rule):
+    """Returns the estimated WCU of the rule, or None when it's unknown."""
+    if rule.ip_set:
+        return IP_SET_WCU
+    if rule.regex_set:
+        return regex_set_wcu(rule.regex_set)
+    if rule.managed_rule_set.vendor_name == "AWS":
+        return MANAGED_RULE_GROUP_WCU.get(rule.managed_rule_set.name)
+    return None
+
+
+def reorder(rules):
+    """Moves cheaper rules ahead of more expensive ones where that can't change
+    a request's outcome. That's within each run of consecutive rules with the
+    same action, since whichever of them matches first the request gets that
+    action. Rule groups are never moved, since the actions of their rules
+    aren't known here. The run's priorities are reused, so rules outside the
+    run keep their place.
+
+    Returns the rules in their new order and a list of (rule name, old
+    priority, new priority) for the rules which moved."""
+    by_priority = sorted(rules, key=lambda r: r.priority)
+
+    def run_key(r):
+        # Each rule group is a run of its own.
+        return ("group", r.name) if r.managed_rule_set else ("action", r.action)
+
+    ret = []
+    changes = []
+    for _, run in groupby(by_priority, key=run_key):
+        run = list(run)
+        priorities = [r.priority for r in run]
+        cheapest = sorted(run, key=lambda r: rule_wcu(r) or 0)
+        for rule, priority in zip(cheapest, priorities):
+            if rule.priority != priority:
+                changes.append((rule.name, rule.priority, priority))
+                rule = rule.copy(update={"priority": priority})
+            ret.append(rule)
+    return ret, changes
+
+
+def estimate(rules):
+    """Returns the total estimated WCU of the rules and the names of the rules
+    whose WCU isn't known."""
+    total = 0
+    unknown = []
+    for rule in rules:
+        wcu = rule_wcu(rule)
+        if wcu is None:
+            unknown.append(rule.name)
+        else:
+            total += wcu
+    return total, unknown
@@ -0,0 +1,130 @@
+import re
+
+from troposphere import Join, Ref, Split, Sub
+from troposphere.glue import (
+    Column,
+    Database,
+    DatabaseInput,
+    SerdeInfo,
+    StorageDescriptor,
+    Table,
+    TableInput,
+)
+
+from util import add_resource, add_resource_once
+
+# WAF log fields, lowercased the way Firehose matches them to columns.
+# https://docs.aws.amazon.com/waf/latest/developerguide/logging-fields.html
+MATCH_DETAILS = "array<struct<conditiontype:string,sensitivitylevel:string,location:string,matcheddata:array<string>>>"
+WAF_LOG_COLUMNS = [
+    ("timestamp", "bigint"),
+    ("formatversion", "int"),
+    ("webaclid", "string"),
+    ("terminatingruleid", "string"),
+    ("terminatingruletype", "string"),
+    ("action", "string"),
+    ("terminatingrulematchdetails", MATCH_DETAILS),
+    ("httpsourcename", "string"),
+    ("httpsourceid", "string"),
+    (
+        "rulegrouplist",
+        "array<struct<rulegroupid:string,"
+        f"terminatingrule:struct<ruleid:string,action:string,rulematchdetails:{MATCH_DETAILS}>,"
+        f"nonterminatingmatchingrules:array<struct<ruleid:string,action:string,rulematchdetails:{MATCH_DETAILS}>>,"
+        "excludedrules:string>>",
+    ),
+    (
+        "ratebasedrulelist",
+        "array<struct<ratebasedruleid:string,limitkey:string,maxrateallowed:int>>",
+    ),
+    (
+        "nonterminatingmatchingrules",
+        f"array<struct<ruleid:string,action:string,rulematchdetails:{MATCH_DETAILS}>>",
+    ),
+    ("requestheadersinserted", "array<struct<name:string,value:string>>"),
+    ("responsecodesent", "string"),
+    (
+        "httprequest",
+        "struct<clientip:string,country:string,headers:array<struct<name:string,value:string>>,"
+        "uri:string,args:string,httpversion:string,httpmethod:string,requestid:string>",
+    ),
+    ("labels", "array<struct<name:string>>"),
+    ("ja3fingerprint", "string"),
+]
+
+WAF_ACTIONS = ["ALLOW", "BLOCK", "COUNT", "CAPTCHA", "CHALLENGE"]
+
+# Firehose adds these to the S3 prefix when partitioning dynamically.
+PARTITION_PREFIX = (
+    "day=!{partitionKeyFromQuery:day}/action=!{partitionKeyFromQuery:action}/"
+)
+PARTITION_QUERY = '{day: (.timestamp / 1000 | strftime("%Y-%m-%d")), action: .action}'
+
+
+def table_name(title_prefix):
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", title_prefix).lower()
+
+
+def glue_database():
+    # Athena doesn't allow dashes in database names. The suffix keeps it apart
+    # from the access log analytics database, which is named after the stack.
+    return add_resource_once(
+        "WafLogsDatabase",
+        lambda name: Database(
+            name,
+            CatalogId=Ref("AWS::AccountId"),
+            DatabaseInput=DatabaseInput(
+                Name=Join("_", Split("-", Sub("${AWS::StackName}-waf")))
+            ),
+        ),
+    )
+
+
+def glue_table(s3_model, title_prefix):
+    """Returns a Glue table of the logs delivered in Parquet. Firehose converts
+    records with its schema, and Athena queries it."""
+    location = "s3://" + s3_model.bucket_arn.split(":")[-1] + "/" + s3_model.prefix_expr
+    parameters = {"EXTERNAL": "true", "classification": "parquet"}
+    partition_keys = []
+    if s3_model.dynamic_partitioning:
+        partition_keys = [
+            Column(Name="day", Type="string"),
+            Column(Name="action", Type="string"),
+        ]
+        parameters = {
+            **parameters,
+            "projection.enabled": "true",
+            "projection.day.type": "date",
+            "projection.day.format": "yyyy-MM-dd",
+            "projection.day.range": f"{s3_model.projection_start.isoformat()},NOW",
+            "projection.day.interval": "1",
+            "projection.day.interval.unit": "DAYS",
+            "projection.action.type": "enum",
+            "projection.action.values": ",".join(WAF_ACTIONS),
+            "storage.location.template": Sub(
+                location + "day=${!day}/action=${!action}/"
+            ),
+        }
+
+    return add_resource(
+        Table(
+            f"{title_prefix}Table",
+            CatalogId=Ref("AWS::AccountId"),
+            DatabaseName=Ref(glue_database()),
+            TableInput=TableInput(
+                Name=table_name(title_prefix),
+                TableType="EXTERNAL_TABLE",
+                Parameters=parameters,
+                PartitionKeys=partition_keys,
+                StorageDescriptor=StorageDescriptor(
+                    Columns=[Column(Name=n, Type=t) for n, t in WAF_LOG_COLUMNS],
+                    Location=Sub(location),
+                    InputFormat="org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                    OutputFormat="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+                    SerdeInfo=SerdeInfo(
+                        SerializationLibrary="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+                    ),
+                ),
+            ),
+        )
+    )
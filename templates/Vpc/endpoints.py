@@ -0,0 +1,94 @@
+from troposphere import GetAtt, Ref, Sub, Tags
+from troposphere.ec2 import SecurityGroup, SecurityGroupRule, VPCEndpoint
+
+from util import add_export, add_resource, clean_title, dashed_to_camel_case
+
+
+def service_title(service):
+    return dashed_to_camel_case(service.replace(".", "-"))
+
+
+def endpoint_security_group(cidrs):
+    ret = add_resource(
+        SecurityGroup(
+            "VpcEndpointSecurityGroup",
+            GroupDescription=Sub("${AWS::StackName} VPC interface endpoints"),
+            VpcId=Ref("Vpc"),
+            SecurityGroupIngress=[
+                SecurityGroupRule(
+                    IpProtocol="tcp", FromPort=443, ToPort=443, CidrIp=cidr
+                )
+                for cidr in cidrs
+            ],
+            Tags=Tags(Name=Sub("${AWS::StackName}-vpc-endpoints")),
+        )
+    )
+    add_export(
+        "VpcEndpointSecurityGroupId",
+        Sub("${AWS::StackName}-vpcEndpointSg"),
+        GetAtt(ret, "GroupId"),
+    )
+    return ret
+
+
+def vpc_endpoint(service, **kwargs):
+    title = service_title(service)
+    ret = add_resource(
+        VPCEndpoint(
+            clean_title(f"VpcEndpoint{title}"),
+            ServiceName=Sub("com.amazonaws.${AWS::Region}." + service),
+            VpcId=Ref("Vpc"),
+            **kwargs,
+        )
+    )
+    add_export(
+        f"{title}VpcEndpointId",
+        Sub("${AWS::StackName}-" + service.replace(".", "-") + "-vpcEndpointId"),
+        Ref(ret),
+    )
+    return ret
+
+
+def default_interface_subnets(subnet_models):
+    # Interface endpoints accept a single subnet per availability zone.
+    by_az = {}
+    for s in subnet_models:
+        if s.kind == "private":
+            by_az.setdefault(s.availability_zone, s.name)
+    return list(by_az.values())
+
+
+def add_vpc_endpoints(user_data, subnets_and_route_tables, subnets_by_name):
+    endpoints = user_data.vpc_endpoints
+
+    rt_subnets = endpoints.route_table_subnets or [
+        s.name for s in user_data.subnets if s.kind == "private"
+    ]
+    # Subnets may share a route table, which should only be listed once.
+    route_tables = {
+        rt.title: Ref(rt) for s, rt in subnets_and_route_tables if s.name in rt_subnets
+    }
+    for service in endpoints.gateway_services:
+        vpc_endpoint(
+            service,
+            VpcEndpointType="Gateway",
+            RouteTableIds=list(route_tables.values()),
+        )
+
+    if len(endpoints.interface_services) < 1:
+        return
+
+    sg = endpoint_security_group(endpoints.ingress_cidrs or [user_data.vpc_cidr])
+    subnet_ids = [
+        Ref(subnets_by_name[n])
+        for n in endpoints.interface_subnets
+        or default_interface_subnets(user_data.subnets)
+    ]
+    for service in endpoints.interface_services:
+        vpc_endpoint(
+            service,
+            VpcEndpointType="Interface",
+            SubnetIds=subnet_ids,
+            SecurityGroupIds=[GetAtt(sg, "GroupId")],
+            PrivateDnsEnabled=endpoints.private_dns_enabled,
+        )
@@ -0,0 +1,218 @@
+from troposphere import GetAtt, Join, Ref, Split, Sub
+from troposphere.ec2 import DestinationOptions, FlowLog
+from troposphere.glue import (
+    Column,
+    Database,
+    DatabaseInput,
+    SerdeInfo,
+    StorageDescriptor,
+    Table,
+    TableInput,
+)
+from troposphere.s3 import (
+    Bucket,
+    BucketPolicy,
+    LifecycleConfiguration,
+    LifecycleRule,
+    LifecycleRuleTransition,
+    PublicAccessBlockConfiguration,
+)
+
+from model import FLOW_LOG_FIELDS
+from util import add_export, add_resource, opts_with
+
+# Where flow logs with Hive compatible partitions are written in the bucket.
+# The partitions below it are year=/month=/day=/hour=.
+LOG_PREFIX = (
+    "AWSLogs/aws-account-id=${AWS::AccountId}/aws-service=vpcflowlogs/"
+    "aws-region=${AWS::Region}"
+)
+
+
+def column_name(field):
+    return field.replace("-", "_")
+
+
+def log_format(fields):
+    return " ".join("${%s}" % f for f in fields)
+
+
+def flow_log_bucket(flow_logs):
+    transitions = opts_with(
+        Transitions=(
+            flow_logs.infrequent_access_days,
+            lambda days: [
+                LifecycleRuleTransition(
+                    StorageClass="STANDARD_IA", TransitionInDays=days
+                )
+            ],
+        )
+    )
+    return add_resource(
+        Bucket(
+            "FlowLogBucket",
+            LifecycleConfiguration=LifecycleConfiguration(
+                Rules=[
+                    LifecycleRule(
+                        ExpirationInDays=flow_logs.retain_days,
+                        Status="Enabled",
+                        **transitions,
+                    )
+                ]
+            ),
+            PublicAccessBlockConfiguration=PublicAccessBlockConfiguration(
+                BlockPublicAcls=True,
+                BlockPublicPolicy=True,
+                IgnorePublicAcls=True,
+                RestrictPublicBuckets=True,
+            ),
+        )
+    )
+
+
+def flow_log_bucket_policy(bucket):
+    source_arn = {
+        "aws:SourceArn": Sub(
+            "arn:${AWS::Partition}:logs:${AWS::Region}:${AWS::AccountId}:*"
+        )
+    }
+    return add_resource(
+        BucketPolicy(
+            "FlowLogBucketPolicy",
+            Bucket=Ref(bucket),
+            PolicyDocument={
+                "Statement": [
+                    {
+                        "Effect": "Allow",
+                        "Principal": {"Service": "delivery.logs.amazonaws.com"},
+                        "Action": "s3:PutObject",
+                        "Resource": Sub("${FlowLogBucket.Arn}/AWSLogs/*"),
+                        "Condition": {
+                            "StringEquals": {
+                                "aws:SourceAccount": Ref("AWS::AccountId"),
+                                "s3:x-amz-acl": "bucket-owner-full-control",
+                            },
+                            "ArnLike": source_arn,
+                        },
+                    },
+                    {
+                        "Effect": "Allow",
+                        "Principal": {"Service": "delivery.logs.amazonaws.com"},
+                        "Action": ["s3:GetBucketAcl", "s3:ListBucket"],
+                        "Resource": GetAtt(bucket, "Arn"),
+                        "Condition": {
+                            "StringEquals": {
+                                "aws:SourceAccount": Ref("AWS::AccountId")
+                            },
+                            "ArnLike": source_arn,
+                        },
+                    },
+                ]
+            },
+        )
+    )
+
+
+def flow_log(flow_logs, bucket, policy):
+    return add_resource(
+        FlowLog(
+            "FlowLog",
+            DependsOn=[policy.title],
+            ResourceType="VPC",
+            ResourceId=Ref("Vpc"),
+            TrafficType=flow_logs.traffic_type,
+            LogDestinationType="s3",
+            LogDestination=GetAtt(bucket, "Arn"),
+            LogFormat=log_format(flow_logs.fields),
+            MaxAggregationInterval=flow_logs.max_aggregation_interval,
+            DestinationOptions=DestinationOptions(
+                FileFormat="parquet",
+                HiveCompatiblePartitions=True,
+                PerHourPartition=True,
+            ),
+        )
+    )
+
+
+def glue_database(flow_logs):
+    # Athena doesn't allow dashes in database names.
+    name = flow_logs.glue_database or Join("_", Split("-", Ref("AWS::StackName")))
+    return add_resource(
+        Database(
+            "FlowLogDatabase",
+            CatalogId=Ref("AWS::AccountId"),
+            DatabaseInput=DatabaseInput(Name=name),
+        )
+    )
+
+
+def projection(name, values, digits=None):
+    ret = {
+        f"projection.{name}.type": "integer",
+        f"projection.{name}.range": values,
+    }
+    if digits:
+        ret[f"projection.{name}.digits"] = str(digits)
+    return ret
+
+
+def glue_table(flow_logs, database):
+    location = Sub("s3://${FlowLogBucket}/" + LOG_PREFIX + "/")
+    # The partitions are projected from the S3 path, so none are ever added to
+    # the catalog and Athena only lists the hours a query asks for.
+    parameters = {
+        "EXTERNAL": "true",
+        "classification": "parquet",
+        "projection.enabled": "true",
+        **projection("year", "2020,2099"),
+        **projection("month", "1,12", 2),
+        **projection("day", "1,31", 2),
+        **projection("hour", "0,23", 2),
+        "storage.location.template": Sub(
+            "s3://${FlowLogBucket}/"
+            + LOG_PREFIX
+            + "/year=${!year}/month=${!month}/day=${!day}/hour=${!hour}/"
+        ),
+    }
+    return add_resource(
+        Table(
+            "FlowLogTable",
+            CatalogId=Ref("AWS::AccountId"),
+            DatabaseName=Ref(database),
+            TableInput=TableInput(
+                Name="flow_logs",
+                TableType="EXTERNAL_TABLE",
+                Parameters=parameters,
+                PartitionKeys=[
+                    Column(Name=p, Type="string")
+                    for p in ["year", "month", "day", "hour"]
+                ],
+                StorageDescriptor=StorageDescriptor(
+                    Columns=[
+                        Column(Name=column_name(f), Type=FLOW_LOG_FIELDS[f])
+                        for f in flow_logs.fields
+                    ],
+                    Location=location,
+                    InputFormat="org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+                    OutputFormat="org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+                    SerdeInfo=SerdeInfo(
+                        SerializationLibrary="org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+                    ),
+                ),
+            ),
+        )
+    )
+
+
+def add_flow_logs(user_data):
+    flow_logs = user_data.flow_logs
+    bucket = flow_log_bucket(flow_logs)
+    policy = flow_log_bucket_policy(bucket)
+    flow_log(flow_logs, bucket, policy)
+    database = glue_database(flow_logs)
+    glue_table(flow_logs, database)
+
+    add_export("FlowLogBucket", Sub("${AWS::StackName}-flowLogBucket"), Ref(bucket))
+    add_export(
+        "FlowLogDatabase", Sub("${AWS::StackName}-flowLogDatabase"), Ref(database)
+    )
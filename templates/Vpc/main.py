@@ -19,14 +19,18 @@ from troposphere.ec2 import (
     TransitGatewayAttachment,
 )
 
+import endpoints
+import flow_logs
 import model
 from util import (
     TEMPLATE,
     add_export,
+    add_output,
     add_resource,
     add_resource_once,
     clean_title,
     dashed_to_camel_case,
+    debug,
     snake_to_camel_case,
     opts_with,
 )
@@ -41,13 +45,18 @@ def transit_gateway_attachment_name(tg_id: str) -> str:
 
 def r_vpc(user_data):
     name = user_data.vpc_name if user_data.vpc_name else Ref("AWS::StackName")
+    opts = user_data.vpc_extra_opts
+    vpce = user_data.vpc_endpoints
+    if vpce and vpce.interface_services and vpce.private_dns_enabled:
+        # Private DNS for interface endpoints requires DNS hostnames.
+        opts = {"EnableDnsHostnames": True, **opts}
     ret = add_resource(
         VPC(
             "Vpc",
             CidrBlock=user_data.vpc_cidr,
             EnableDnsSupport=True,
             Tags=[Tag("Name", name)],
-            **user_data.vpc_extra_opts,
+            **opts,
         )
     )
     add_export("VpcId", Sub("${AWS::StackName}-vpcId"), Ref(ret))
@@ -112,6 +121,16 @@ def subnet(subnet_model):
     return ret
 
 
+def route_table_association(subnet, name, rt):
+    return add_resource(
+        SubnetRouteTableAssociation(
+            f"RouteTableAssoc{clean_title(name)}",
+            RouteTableId=Ref(rt),
+            SubnetId=Ref(subnet),
+        )
+    )
+
+
 # Returns a route table with a default route. The kwargs is passed to the
 # default route's constructor.
 def add_route_table(subnet, name, **kwargs):
@@ -124,13 +143,7 @@ def add_route_table(subnet, name, **kwargs):
         )
     )
 
-    add_resource(
-        SubnetRouteTableAssociation(
-            f"RouteTableAssoc{title}",
-            RouteTableId=Ref(rt),
-            SubnetId=Ref(subnet),
-        )
-    )
+    route_table_association(subnet, name, rt)
 
     add_resource(
         Route(
@@ -163,7 +176,17 @@ def add_route(route_table: RouteTable, route: model.RouteModel) -> Route:
     )
 
 
-def connected_subnet(subnet_model):
+def routing_key(subnet_model):
+    """Subnets with the same key route identically, so they can share a route
+    table. Private subnets route through the NAT gateway in their own AZ."""
+    return (
+        subnet_model.kind,
+        subnet_model.availability_zone if subnet_model.kind == "private" else None,
+        tuple(sorted(r.json(exclude_none=True) for r in subnet_model.routes)),
+    )
+
+
+def connected_subnet(subnet_model, shared_route_tables=None):
     sn = subnet(subnet_model)
 
     if subnet_model.kind == "public":
@@ -171,6 +194,15 @@ def connected_subnet(subnet_model):
             sn,
             subnet_model,
         )
+
+    key = routing_key(subnet_model)
+    if shared_route_tables is not None and key in shared_route_tables:
+        rt = shared_route_tables[key]
+        route_table_association(sn, subnet_model.name, rt)
+        export_subnet(subnet_model, sn)
+        return (subnet_model, rt)
+
+    if subnet_model.kind == "public":
         igw()
         rt = add_route_table(sn, subnet_model.name, GatewayId=Ref("Igw"))
     elif subnet_model.kind == "private":
@@ -185,6 +217,14 @@ def connected_subnet(subnet_model):
     for r in subnet_model.routes:
         add_route(rt, r)
 
+    if shared_route_tables is not None:
+        shared_route_tables[key] = rt
+    export_subnet(subnet_model, sn)
+
+    return (subnet_model, rt)
+
+
+def export_subnet(subnet_model, sn):
     add_export(
         dashed_to_camel_case(subnet_model.name) + "SubnetId",
         Sub("${AWS::StackName}-" + subnet_model.name + "-subnetId"),
@@ -196,17 +236,46 @@ def connected_subnet(subnet_model):
         subnet_model.cidr,
     )
 
-    return (subnet_model, rt)
-
 
-def subnets(models):
+def subnets(models, share_route_tables=False):
     # Public subnets need to be defined first so that NATs can be built in them
     # which are then used by the private subnets.
-    publics = [connected_subnet(s) for s in models if s.kind == "public"]
-    privates = [connected_subnet(s) for s in models if s.kind != "public"]
+    #
+    # When route tables are shared, the first subnet of each group keeps its
+    # route table's logical ID, so existing stacks only lose the other tables.
+    shared = {} if share_route_tables else None
+    publics = [connected_subnet(s, shared) for s in models if s.kind == "public"]
+    privates = [connected_subnet(s, shared) for s in models if s.kind != "public"]
     return publics + privates
 
 
+def route_table_savings(user_data, subnets_and_route_tables):
+    """Returns the number of route tables and routes which sharing avoided."""
+    seen = set()
+    saved = 0
+    for sn_model, rt in subnets_and_route_tables:
+        if rt.title in seen:
+            static_routes = 0
+            if user_data.customer_gateway:
+                static_routes = len(user_data.customer_gateway.static_route_cidrs)
+            # The route table, its default route and its other routes.
+            saved += 2 + len(sn_model.routes) + static_routes
+        seen.add(rt.title)
+    return saved
+
+
+def report_route_table_savings(user_data, subnets_and_route_tables):
+    saved = route_table_savings(user_data, subnets_and_route_tables)
+    tables = len({rt.title for _, rt in subnets_and_route_tables})
+    msg = "%d subnets share %d route tables, saving %d resources" % (
+        len(subnets_and_route_tables),
+        tables,
+        saved,
+    )
+    debug(msg)
+    add_output("RouteTableSharing", msg)
+
+
 def customer_gateway(gw_model):
     return add_resource(
         CustomerGateway(
@@ -266,7 +335,12 @@ def customer_gateway_routes(gw_model, subnets_and_route_tables):
             )
         )
 
+        # Shared route tables only need the route once.
+        seen = set()
         for sn_model, rt in subnets_and_route_tables:
+            if rt.title in seen:
+                continue
+            seen.add(rt.title)
             add_resource(
                 Route(
                     clean_title(f"RouteFrom{sn_model.cidr}to{cidr}"),
@@ -278,11 +352,13 @@ def customer_gateway_routes(gw_model, subnets_and_route_tables):
 
 
 def transit_gateway_attachments(user_data):
-    tg_subnets = defaultdict(lambda: set())
+    # Subnet names are dict keys rather than a set so they keep the order
+    # they're defined in, and the template is stable.
+    tg_subnets = defaultdict(dict)
     for subnet_model in user_data.subnets:
         for route_model in subnet_model.routes:
             if route_model.transit_gateway_id:
-                tg_subnets[route_model.transit_gateway_id].add(subnet_model.name)
+                tg_subnets[route_model.transit_gateway_id][subnet_model.name] = None
 
     for tg_id, subnets in tg_subnets.items():
         name = f"{'/'.join(subnets)} : {tg_id}"
@@ -305,7 +381,7 @@ def sceptre_handler(sceptre_user_data):
     user_data = model.UserDataModel(**sceptre_user_data)
 
     r_vpc(user_data)
-    subnets_and_route_tables = subnets(user_data.subnets)
+    subnets_and_route_tables = subnets(user_data.subnets, user_data.share_route_tables)
 
     if user_data.customer_gateway:
         attach_customer_gateway(user_data.customer_gateway)
@@ -313,4 +389,15 @@ def sceptre_handler(sceptre_user_data):
 
     transit_gateway_attachments(user_data)
 
+    if user_data.share_route_tables:
+        report_route_table_savings(user_data, subnets_and_route_tables)
+
+    if user_data.vpc_endpoints:
+        endpoints.add_vpc_endpoints(
+            user_data, subnets_and_route_tables, subnets_by_name
+        )
+
+    if user_data.flow_logs:
+        flow_logs.add_flow_logs(user_data)
+
     return TEMPLATE.to_json()
@@ -1,6 +1,6 @@
-from typing import List, Optional
+from typing import List, Literal, Optional
 
-from pydantic import validator, Field
+from pydantic import root_validator, validator, Field
 
 from util import BaseModel
 
@@ -71,9 +71,220 @@ class CustomerGatewayModel(BaseModel):
     static_route_cidrs: List[str] = []
 
 
+class VpcEndpointsModel(BaseModel):
+    gateway_services: List[Literal["s3", "dynamodb"]] = Field(
+        ["s3"],
+        description="""Services reached through gateway endpoints. Gateway
+                       endpoints have no hourly or data processing charge.""",
+    )
+    route_table_subnets: Optional[List[str]] = Field(
+        description="""Names of the subnets whose route tables get routes to the
+                       gateway endpoints.""",
+        default_description="All private subnets",
+    )
+    interface_services: List[str] = Field(
+        ["ecr.api", "ecr.dkr", "logs", "ecs", "ecs-agent", "ssm", "sts"],
+        description="""Services reached through interface endpoints, named as in
+                       `com.amazonaws.<region>.<service>`.""",
+        notes=[
+            """The defaults cover pulling images from ECR, shipping logs to
+               CloudWatch Logs and the ECS agent, so that container instances
+               in private subnets don't send that traffic through a NAT
+               gateway. ECR image layers are served from S3, which is why `s3`
+               is a default gateway service.""",
+            "Interface endpoints are charged per hour, per availability zone.",
+        ],
+    )
+    interface_subnets: Optional[List[str]] = Field(
+        description="""Names of the subnets where the interface endpoints'
+                       network interfaces are created. Only one subnet per
+                       availability zone is allowed.""",
+        default_description="The first private subnet in each availability zone",
+    )
+    ingress_cidrs: Optional[List[str]] = Field(
+        description="""CIDRs allowed to reach the interface endpoints on port
+                       443 through their shared security group.""",
+        default_description="The VPC's CIDR",
+    )
+    private_dns_enabled = Field(
+        True,
+        description="""When true, the services' default DNS names resolve to
+                       the interface endpoints within the VPC.""",
+        notes=[
+            "This turns on the VPC's `EnableDnsHostnames`, which private DNS requires."
+        ],
+    )
+
+
+# Flow log fields and their types in the Parquet files and the Glue table.
+FLOW_LOG_FIELDS = {
+    "version": "int",
+    "account-id": "string",
+    "interface-id": "string",
+    "srcaddr": "string",
+    "dstaddr": "string",
+    "srcport": "int",
+    "dstport": "int",
+    "protocol": "int",
+    "packets": "bigint",
+    "bytes": "bigint",
+    "start": "bigint",
+    "end": "bigint",
+    "action": "string",
+    "log-status": "string",
+    "vpc-id": "string",
+    "subnet-id": "string",
+    "instance-id": "string",
+    "tcp-flags": "int",
+    "type": "string",
+    "pkt-srcaddr": "string",
+    "pkt-dstaddr": "string",
+    "region": "string",
+    "az-id": "string",
+    "sublocation-type": "string",
+    "sublocation-id": "string",
+    "pkt-src-aws-service": "string",
+    "pkt-dst-aws-service": "string",
+    "flow-direction": "string",
+    "traffic-path": "int",
+    "reject-reason": "string",
+}
+
+
+class FlowLogsModel(BaseModel):
+    traffic_type: Literal["ACCEPT", "REJECT", "ALL"] = Field(
+        "ALL", description="The type of traffic to log."
+    )
+    fields: List[str] = Field(
+        [
+            "interface-id",
+            "srcaddr",
+            "dstaddr",
+            "srcport",
+            "dstport",
+            "protocol",
+            "packets",
+            "bytes",
+            "start",
+            "end",
+            "action",
+            "log-status",
+            "subnet-id",
+            "instance-id",
+            "tcp-flags",
+            "pkt-srcaddr",
+            "pkt-dstaddr",
+            "flow-direction",
+            "traffic-path",
+        ],
+        description="""The flow log fields to record, in order, named as in the
+                       flow log record format without the `${}`.""",
+        notes=[
+            """Each field is a column of the Glue table, with dashes replaced
+               by underscores.""",
+            """The account, region and VPC are left out by default since every
+               record of the stack's flow log has the same values. The account
+               and region are in the S3 path.""",
+        ],
+    )
+    max_aggregation_interval: Literal[60, 600] = Field(
+        600,
+        description="""The maximum number of seconds a flow is captured for
+                       before it's aggregated into a record.""",
+    )
+    retain_days = Field(90, description="Days after which flow logs are deleted.")
+    infrequent_access_days: Optional[int] = Field(
+        description="""Days after which flow logs move to the Standard-IA
+                       storage class.""",
+        default_description="Flow logs stay in the Standard storage class",
+    )
+    glue_database: Optional[str] = Field(
+        description="""Name of the Glue database created for the `flow_logs`
+                       table. Use lowercase letters, digits and underscores.""",
+        default_description="The stack name with dashes replaced by underscores",
+    )
+
+    @validator("fields")
+    def known_fields(cls, v):
+        unknown = [f for f in v if f not in FLOW_LOG_FIELDS]
+        if unknown:
+            raise ValueError(f"unknown flow log fields {', '.join(unknown)}")
+        if len(v) != len(set(v)):
+            raise ValueError("flow log fields must be unique")
+        return v
+
+    @root_validator
+    def infrequent_access_before_expiry(cls, values):
+        ia_days = values.get("infrequent_access_days")
+        if ia_days is not None:
+            # Standard-IA requires objects to be at least 30 days old.
+            if ia_days < 30:
+                raise ValueError("infrequent_access_days must be at least 30")
+            if ia_days >= values.get("retain_days", 0):
+                raise ValueError("infrequent_access_days must be below retain_days")
+        return values
+
+
 class UserDataModel(BaseModel):
     vpc_cidr: str = Field(description="CIDR for the VPC")
     vpc_name: Optional[str]
     vpc_extra_opts: dict = {}
     subnets: List[SubnetModel] = []
     customer_gateway: Optional[CustomerGatewayModel]
+    share_route_tables = Field(
+        False,
+        description="""When true, subnets which route identically share a route
+                       table instead of each having their own. Subnets route
+                       identically when they're the same `kind`, have the same
+                       `routes` and, for private subnets, are in the same
+                       availability zone.""",
+        notes=[
+            """Each shared route table keeps the logical ID of the first
+               subnet in its group, so turning this on for an existing stack
+               only removes the other subnets' route tables and routes.""",
+            """The number of resources saved is reported in the
+               `RouteTableSharing` output.""",
+        ],
+    )
+    vpc_endpoints: Optional[VpcEndpointsModel] = Field(
+        description="""Creates VPC endpoints so that traffic to AWS services
+                       doesn't go through the NAT gateways.""",
+        notes=[
+            """Each endpoint's ID is exported as
+               `<stack-name>-<service>-vpcEndpointId`, with dots in the service
+               name replaced by dashes, and the interface endpoints' security
+               group as `<stack-name>-vpcEndpointSg`."""
+        ],
+    )
+
+    flow_logs: Optional[FlowLogsModel] = Field(
+        description="""Records the VPC's traffic as flow logs in S3, in Parquet
+                       with Hive compatible hourly partitions, along with a
+                       Glue table for querying them with Athena.""",
+        notes=[
+            """The Glue table uses partition projection, so new partitions
+               don't have to be added and queries which filter on `year`,
+               `month`, `day` and `hour` only read those hours.""",
+            """The bucket name is exported as `<stack-name>-flowLogBucket`, and
+               the Glue database name as `<stack-name>-flowLogDatabase`.""",
+        ],
+    )
+
+    @root_validator
+    def endpoint_subnets_exist(cls, values):
+        endpoints = values.get("vpc_endpoints")
+        if not endpoints:
+            return values
+        subnets = {s.name: s for s in values.get("subnets", [])}
+        names = (endpoints.route_table_subnets or []) + (
+            endpoints.interface_subnets or []
+        )
+        for name in names:
+            if name not in subnets:
+                raise ValueError(f"vpc_endpoints refers to unknown subnet {name}")
+        azs = [subnets[n].availability_zone for n in endpoints.interface_subnets or []]
+        if len(azs) != len(set(azs)):
+            raise ValueError(
+                "vpc_endpoints.interface_subnets allows one subnet per availability zone"
+            )
+        return values
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Counts the API calls CodeBuildResourceLambda makes to resolve a built image.
+
+The AWS clients are replaced with in-memory stubs so this runs without
+credentials. For each repository size it reports the ECR calls made by the
+targeted lookup (exported tag or `ImageTag` template) and by the legacy
+repository scan.
+
+    python test/bench/image_lookup_bench.py
+"""
+import importlib.util
+import os
+import sys
+import types
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+LAMBDA_PATH = os.path.join(
+    os.path.dirname(__file__),
+    "../../templates/EcsWebService/resources/CodeBuildResourceLambda.py",
+)
+PAGE_SIZE = 1000
+BUILD_NUM = 4242
+TAG = f"StudentSelfService-9.18-{BUILD_NUM}"
+
+
+class StubPaginator:
+    def __init__(self, client, op):
+        self.client = client
+        self.op = op
+
+    def paginate(self, **kwargs):
+        return getattr(self.client, "paginate_" + self.op)(**kwargs)
+
+
+class StubEcr:
+    def __init__(self, repo_size):
+        self.calls = Counter()
+        now = datetime.now(timezone.utc)
+        self.images = {
+            f"other-{i}": {"imageTags": [f"other-{i}"], "imagePushedAt": now}
+            for i in range(repo_size - 1)
+        }
+        self.images[TAG] = {
+            "imageTags": [TAG],
+            "imagePushedAt": now + timedelta(minutes=1),
+        }
+
+    def get_paginator(self, op):
+        return StubPaginator(self, op)
+
+    def _detail(self, tag):
+        return {
+            "registryId": "123456789012",
+            "repositoryName": "banner-app",
+            **self.images[tag],
+        }
+
+    def paginate_list_images(self, repositoryName, filter):
+        tags = list(self.images)
+        for i in range(0, len(tags), PAGE_SIZE):
+            self.calls["ecr:ListImages"] += 1
+            yield {"imageIds": [{"imageTag": t} for t in tags[i : i + PAGE_SIZE]]}
+
+    def paginate_describe_images(self, repositoryName, imageIds):
+        for i in range(0, len(imageIds), 100):
+            self.calls["ecr:DescribeImages"] += 1
+            chunk = imageIds[i : i + 100]
+            yield {"imageDetails": [self._detail(d["imageTag"]) for d in chunk]}
+
+    def describe_images(self, repositoryName, imageIds):
+        self.calls["ecr:DescribeImages"] += 1
+        return {
+            "imageDetails": [
+                self._detail(d["imageTag"])
+                for d in imageIds
+                if d["imageTag"] in self.images
+            ]
+        }
+
+    def describe_repositories(self, repositoryNames):
+        self.calls["ecr:DescribeRepositories"] += 1
+        return {
+            "repositories": [
+                {"repositoryUri": "123456789012.dkr.ecr.us-east-1.amazonaws.com/x"}
+            ]
+        }
+
+
+def load_lambda():
+    sys.modules.setdefault(
+        "cfnresponse",
+        types.SimpleNamespace(SUCCESS="SUCCESS", FAILED="FAILED", send=None),
+    )
+    spec = importlib.util.spec_from_file_location("cb_lambda", LAMBDA_PATH)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def fail(*args, **kwargs):
+    raise AssertionError(f"lookup failed: {args} {kwargs}")
+
+
+def run(mod, repo_size, props, build):
+    mod.ECR = StubEcr(repo_size)
+    build_time = datetime.utcnow()
+    image = mod.find_image(props, build, build_time, fail)
+    assert image["imageUri"].endswith(TAG), image
+    return sum(mod.ECR.calls.values())
+
+
+def main():
+    mod = load_lambda()
+    base_props = {"RepositoryName": "banner-app"}
+    build = {"id": "b", "buildNumber": BUILD_NUM}
+    exported = {
+        **build,
+        "exportedEnvironmentVariables": [{"name": "IMAGE_TAG", "value": TAG}],
+    }
+    templated = {**base_props, "ImageTag": "StudentSelfService-9.18-{build_number}"}
+
+    print(f"{'tags':>8} {'exported':>9} {'template':>9} {'scan':>6}")
+    for size in [10, 1000, 10000, 50000]:
+        print(
+            f"{size:>8} {run(mod, size, base_props, exported):>9}"
+            f" {run(mod, size, templated, build):>9}"
+            f" {run(mod, size, base_props, build):>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""Simulates ECS task placement to help choose EcsCluster node types.
+
+The workload is read either from Sceptre stack configs which use the
+EcsWebService template or from the services running in a live cluster. Each
+service's tasks are placed one at a time onto nodes of every candidate instance
+type, following the service's placement strategies and constraints. A new node
+is launched whenever a task fits nowhere, which is how capacity provider
+managed scaling behaves. Daemon services, such as EcsMonitorService, reserve
+their resources on every node.
+
+For each candidate the number of nodes, the idle and stranded CPU and memory,
+and the cost are reported. Resources are "stranded" when they sit on a node
+which can't fit any of the workload's tasks.
+
+    python tools/ecs_binpack_sim.py --configs sceptre/config/prod \\
+        --types m5.large,m5.xlarge,r5.large
+
+    python tools/ecs_binpack_sim.py --live banner --region us-east-1
+
+Requires NumPy (`pip install numpy`) in addition to the repo's dependencies.
+"""
+import argparse
+import json
+import math
+import os
+import re
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+import yaml
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+WEB_SERVICE_DIR = os.path.join(REPO, "templates", "EcsWebService")
+MONITOR_TEMPLATE = os.path.join(
+    REPO, "templates", "EcsMonitorService", "EcsMonitorService.yaml"
+)
+
+HOURS_PER_MONTH = 730
+
+# Approximate us-east-1 Linux On-Demand prices. Use --catalog to supply current
+# prices or other instance types.
+CATALOG = {
+    "t3.medium": (2, 4, 0.0416),
+    "t3.large": (2, 8, 0.0832),
+    "t3.xlarge": (4, 16, 0.1664),
+    "t3.2xlarge": (8, 32, 0.3328),
+    "t2.2xlarge": (8, 32, 0.3712),
+    "m5.large": (2, 8, 0.096),
+    "m5.xlarge": (4, 16, 0.192),
+    "m5.2xlarge": (8, 32, 0.384),
+    "m5.4xlarge": (16, 64, 0.768),
+    "m6i.large": (2, 8, 0.096),
+    "m6i.xlarge": (4, 16, 0.192),
+    "m6i.2xlarge": (8, 32, 0.384),
+    "m6i.4xlarge": (16, 64, 0.768),
+    "c5.large": (2, 4, 0.085),
+    "c5.xlarge": (4, 8, 0.17),
+    "c5.2xlarge": (8, 16, 0.34),
+    "r5.large": (2, 16, 0.126),
+    "r5.xlarge": (4, 32, 0.252),
+    "r5.2xlarge": (8, 64, 0.504),
+    "r6i.large": (2, 16, 0.126),
+    "r6i.xlarge": (4, 32, 0.252),
+    "r6i.2xlarge": (8, 64, 0.504),
+}
+
+
+@dataclass
+class InstanceType:
+    name: str
+    vcpu: int
+    memory_gib: float
+    price: float
+
+
+@dataclass
+class Service:
+    name: str
+    count: int
+    cpu: int
+    memory: int
+    strategies: List[tuple] = field(default_factory=list)
+    distinct_instance: bool = False
+    instance_type_filter: Optional[str] = None
+    daemon: bool = False
+
+
+class IgnoreTagsLoader(yaml.SafeLoader):
+    """Loads Sceptre and CloudFormation YAML, turning resolvers like
+    !stack_output and intrinsics like !Ref into None."""
+
+
+IgnoreTagsLoader.add_multi_constructor("!", lambda loader, suffix, node: None)
+
+
+def warn(*args):
+    print("WARNING:", *args, file=sys.stderr)
+
+
+#
+# Workload from Sceptre configs
+#
+
+
+def group_vars(config_root, stack_path, cli_vars):
+    """Merges the config.yaml files from config_root down to the stack's
+    directory, as Sceptre does for stack group config."""
+    merged = {}
+    rel = os.path.relpath(os.path.dirname(stack_path), config_root)
+    dirs = [config_root]
+    if rel != ".":
+        for part in rel.split(os.sep):
+            dirs.append(os.path.join(dirs[-1], part))
+    for d in dirs:
+        path = os.path.join(d, "config.yaml")
+        if os.path.exists(path):
+            with open(path) as fp:
+                merged.update(yaml.load(fp, Loader=IgnoreTagsLoader) or {})
+    return {**merged, "var": cli_vars, "environment_variable": os.environ}
+
+
+def render_config(path, context):
+    with open(path) as fp:
+        text = fp.read()
+    if "{{" in text or "{%" in text:
+        import jinja2
+
+        env = jinja2.Environment(undefined=jinja2.ChainableUndefined)
+        text = env.from_string(text).render(**context)
+    return yaml.load(text, Loader=IgnoreTagsLoader) or {}
+
+
+def template_path(config):
+    template = config.get("template") or {}
+    return template.get("path") or config.get("template_path") or ""
+
+
+def container_memory(c):
+    if c.container_memory_reservation is not None:
+        return c.container_memory_reservation
+    return c.container_memory
+
+
+def container_cpu(c):
+    return int(c.container_extra_props.get("Cpu", 0))
+
+
+def web_service(name, config, model, use_max):
+    user_data = model.UserDataModel(**(config.get("sceptre_user_data") or {}))
+    if user_data.launch_type == "FARGATE":
+        return None
+    params = config.get("parameters") or {}
+    count = params.get("DesiredCount")
+    count = 1 if count is None else int(count)
+    if use_max and user_data.auto_scaling:
+        count = user_data.auto_scaling.max_capacity
+
+    svc = Service(
+        name=name,
+        count=count,
+        cpu=(
+            int(user_data.cpu)
+            if user_data.cpu
+            else sum(container_cpu(c) for c in user_data.containers)
+        ),
+        memory=(
+            int(user_data.memory)
+            if user_data.memory
+            else sum(container_memory(c) for c in user_data.containers)
+        ),
+        strategies=[(s.type, s.field) for s in user_data.placement_strategies or []],
+    )
+    for pc in user_data.placement_constraints or []:
+        apply_constraint(svc, pc.type, pc.expression)
+    return svc
+
+
+def monitor_service(name):
+    """Reads the reservation of the EcsMonitorService daemon from its
+    template."""
+    with open(MONITOR_TEMPLATE) as fp:
+        template = yaml.load(fp, Loader=IgnoreTagsLoader)
+    containers = template["Resources"]["TaskDef"]["Properties"]["ContainerDefinitions"]
+    return Service(
+        name=name,
+        count=0,
+        cpu=sum(int(c.get("Cpu") or 0) for c in containers),
+        memory=sum(int(c.get("MemoryReservation") or c["Memory"]) for c in containers),
+        daemon=True,
+    )
+
+
+def services_from_configs(paths, cli_vars, use_max, cluster):
+    sys.path.insert(0, WEB_SERVICE_DIR)
+    import model
+    from pydantic import ValidationError
+
+    services = []
+    for root in paths:
+        if os.path.isfile(root):
+            files, root = [root], os.path.dirname(root)
+        else:
+            files = [
+                os.path.join(d, f)
+                for d, _, fs in sorted(os.walk(root))
+                for f in sorted(fs)
+                if f.endswith((".yaml", ".yml")) and f != "config.yaml"
+            ]
+        for path in files:
+            name = os.path.relpath(path, root)
+            config = render_config(path, group_vars(root, path, cli_vars))
+            tpath = template_path(config)
+            cluster_arn = (config.get("parameters") or {}).get("ClusterArn")
+            if cluster and cluster_arn and cluster not in str(cluster_arn):
+                continue
+            if "EcsMonitorService" in tpath:
+                services.append(monitor_service(name))
+            elif "EcsWebService" in tpath:
+                try:
+                    svc = web_service(name, config, model, use_max)
+                except ValidationError as err:
+                    # Usually values which come from a group config.yaml
+                    # above the root which was given.
+                    errors = "; ".join(
+                        f"{'.'.join(str(p) for p in e['loc'])}: {e['msg']}"
+                        for e in err.errors()
+                    )
+                    warn(f"{path}: skipping invalid config ({errors})")
+                    continue
+                if svc:
+                    services.append(svc)
+    return services
+
+
+#
+# Workload from a live cluster
+#
+
+
+def services_from_cluster(cluster, region, use_max):
+    import boto3
+
+    ecs = boto3.client("ecs", region_name=region)
+    scaling = boto3.client("application-autoscaling", region_name=region)
+    arns = [
+        a
+        for page in ecs.get_paginator("list_services").paginate(cluster=cluster)
+        for a in page["serviceArns"]
+    ]
+
+    max_counts = {}
+    if use_max:
+        for page in scaling.get_paginator("describe_scalable_targets").paginate(
+            ServiceNamespace="ecs"
+        ):
+            for t in page["ScalableTargets"]:
+                max_counts[t["ResourceId"].split("/")[-1]] = t["MaxCapacity"]
+
+    services = []
+    for i in range(0, len(arns), 10):
+        res = ecs.describe_services(cluster=cluster, services=arns[i : i + 10])
+        for s in res["services"]:
+            if s.get("launchType") == "FARGATE":
+                continue
+            td = ecs.describe_task_definition(taskDefinition=s["taskDefinition"])[
+                "taskDefinition"
+            ]
+            cds = td["containerDefinitions"]
+            svc = Service(
+                name=s["serviceName"],
+                count=max_counts.get(s["serviceName"], s["desiredCount"]),
+                cpu=int(td.get("cpu") or sum(c.get("cpu", 0) for c in cds)),
+                memory=int(
+                    td.get("memory")
+                    or sum(c.get("memoryReservation") or c["memory"] for c in cds)
+                ),
+                strategies=[
+                    (p["type"], p.get("field", "")) for p in s["placementStrategy"]
+                ],
+                daemon=s["schedulingStrategy"] == "DAEMON",
+            )
+            for pc in s["placementConstraints"] + td.get("placementConstraints", []):
+                apply_constraint(svc, pc["type"], pc.get("expression", ""))
+            services.append(svc)
+    return services
+
+
+#
+# Placement
+#
+
+INSTANCE_TYPE_EXPR = re.compile(
+    r"^\s*attribute:ecs\.instance-type\s*(==|=~|in)\s*(.+?)\s*$"
+)
+
+
+def apply_constraint(svc, ctype, expression):
+    if ctype == "distinctInstance":
+        svc.distinct_instance = True
+        return
+    match = INSTANCE_TYPE_EXPR.match(expression or "")
+    if not match:
+        warn(f"{svc.name}: ignoring unsupported constraint '{expression}'")
+        return
+    op, value = match.groups()
+    if op == "==":
+        svc.instance_type_filter = "^%s$" % re.escape(value)
+    elif op == "in":
+        values = [v.strip() for v in value.strip("[]").split(",")]
+        svc.instance_type_filter = "^(%s)$" % "|".join(map(re.escape, values))
+    else:
+        svc.instance_type_filter = "^%s$" % value.replace(".", r"\.").replace("*", ".*")
+
+
+def strategy_keys(strategies, idx, free_cpu, free_mem, svc_count, az, rng, n_azs):
+    """Returns one sort key per strategy, most significant first. ECS applies a
+    service's strategies in order, each one breaking ties in the last."""
+    keys = []
+    for stype, sfield in strategies:
+        sfield = sfield.lower()
+        if stype == "binpack":
+            keys.append(free_cpu[idx] if sfield == "cpu" else free_mem[idx])
+        elif stype == "spread" and "availability-zone" in sfield:
+            az_counts = np.bincount(az[: len(svc_count)], svc_count, n_azs)
+            keys.append(az_counts[az[idx]])
+        elif stype == "spread":
+            keys.append(svc_count[idx])
+        elif stype == "random":
+            keys.append(rng.random(len(idx)))
+    return keys
+
+
+def simulate(services, itype, n_azs, os_overhead_pct, seed):
+    daemons = [s for s in services if s.daemon]
+    cap_cpu = itype.vcpu * 1024 - sum(d.cpu for d in daemons)
+    cap_mem = int(itype.memory_gib * 1024 * (1 - os_overhead_pct / 100.0))
+    cap_mem -= sum(d.memory for d in daemons)
+
+    replicas = [s for s in services if not s.daemon]
+    n_tasks = sum(s.count for s in replicas)
+    free_cpu = np.zeros(n_tasks + 1, dtype=np.int64)
+    free_mem = np.zeros(n_tasks + 1, dtype=np.int64)
+    az = np.arange(n_tasks + 1) % n_azs
+    rng = np.random.default_rng(seed)
+    n = 0
+    unplaced = {}
+
+    for svc in replicas:
+        if svc.instance_type_filter and not re.match(
+            svc.instance_type_filter, itype.name
+        ):
+            unplaced[svc.name] = svc.count
+            continue
+        if svc.cpu > cap_cpu or svc.memory > cap_mem:
+            unplaced[svc.name] = svc.count
+            continue
+
+        svc_count = np.zeros(n_tasks + 1, dtype=np.int64)
+        for _ in range(svc.count):
+            fits = (free_cpu[:n] >= svc.cpu) & (free_mem[:n] >= svc.memory)
+            if svc.distinct_instance:
+                fits &= svc_count[:n] == 0
+            idx = np.flatnonzero(fits)
+            if len(idx) < 1:
+                free_cpu[n], free_mem[n] = cap_cpu, cap_mem
+                idx = np.array([n])
+                n += 1
+            keys = strategy_keys(
+                svc.strategies, idx, free_cpu, free_mem, svc_count[:n], az, rng, n_azs
+            )
+            # np.lexsort treats its last key as the primary one. The node index
+            # is the final tie-breaker so that older nodes are preferred.
+            best = idx[np.lexsort([idx] + keys[::-1])[0]]
+            free_cpu[best] -= svc.cpu
+            free_mem[best] -= svc.memory
+            svc_count[best] += 1
+
+    free_cpu, free_mem = free_cpu[:n], free_mem[:n]
+    shapes = np.array(sorted({(s.cpu, s.memory) for s in replicas}), dtype=np.int64)
+    if n > 0 and len(shapes) > 0:
+        fits_any = (
+            (free_cpu[:, None] >= shapes[None, :, 0])
+            & (free_mem[:, None] >= shapes[None, :, 1])
+        ).any(axis=1)
+    else:
+        fits_any = np.zeros(n, dtype=bool)
+    stranded = ~fits_any
+
+    total_cpu = n * itype.vcpu * 1024
+    total_mem = n * itype.memory_gib * 1024
+    return {
+        "instance_type": itype.name,
+        "nodes": n,
+        "cpu_used_pct": round(100 * (1 - free_cpu.sum() / total_cpu), 1) if n else 0,
+        "memory_used_pct": (
+            round(100 * (1 - free_mem.sum() / total_mem), 1) if n else 0
+        ),
+        "idle_vcpu": round(free_cpu.sum() / 1024, 2),
+        "idle_memory_gib": round(free_mem.sum() / 1024, 2),
+        "stranded_vcpu": round(free_cpu[stranded].sum() / 1024, 2),
+        "stranded_memory_gib": round(free_mem[stranded].sum() / 1024, 2),
+        "cost_per_hour": round(n * itype.price, 4),
+        "cost_per_month": round(n * itype.price * HOURS_PER_MONTH, 2),
+        "unplaced_tasks": sum(unplaced.values()),
+        "unplaced_services": sorted(unplaced),
+    }
+
+
+#
+# CLI
+#
+
+
+def load_catalog(path):
+    catalog = {k: InstanceType(k, *v) for k, v in CATALOG.items()}
+    if path:
+        with open(path) as fp:
+            for k, v in (yaml.safe_load(fp) or {}).items():
+                catalog[k] = InstanceType(k, v["vcpu"], v["memory_gib"], v["price"])
+    return catalog
+
+
+def print_table(results):
+    cols = [
+        ("instance_type", "type", 12),
+        ("nodes", "nodes", 6),
+        ("cpu_used_pct", "cpu%", 6),
+        ("memory_used_pct", "mem%", 6),
+        ("stranded_vcpu", "strand vcpu", 12),
+        ("stranded_memory_gib", "strand GiB", 11),
+        ("cost_per_month", "$/month", 10),
+        ("unplaced_tasks", "unplaced", 9),
+    ]
+    print(" ".join(f"{h:>{w}}" for _, h, w in cols))
+    for r in results:
+        print(" ".join(f"{r[k]:>{w}}" for k, _, w in cols))
+
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument(
+        "--configs",
+        nargs="+",
+        metavar="PATH",
+        help="Sceptre config directories or stack config files",
+    )
+    src.add_argument("--live", metavar="CLUSTER", help="Read a running cluster")
+    p.add_argument("--region", help="AWS region for --live")
+    p.add_argument(
+        "--cluster",
+        help="Only include configs whose ClusterArn parameter contains this",
+    )
+    p.add_argument(
+        "--var",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Value available to configs as {{ var.KEY }}",
+    )
+    p.add_argument(
+        "--types",
+        help="Comma separated candidate instance types (default: all known)",
+    )
+    p.add_argument(
+        "--catalog",
+        help="YAML file of instance types: {type: {vcpu, memory_gib, price}}",
+    )
+    p.add_argument(
+        "--peak",
+        action="store_true",
+        help="Use auto_scaling max_capacity instead of DesiredCount",
+    )
+    p.add_argument("--azs", type=int, default=2, help="Availability zones")
+    p.add_argument(
+        "--os-overhead-pct",
+        type=float,
+        default=5,
+        help="Share of instance memory not registered with ECS",
+    )
+    p.add_argument("--seed", type=int, default=0, help="Seed for random strategies")
+    p.add_argument("--json", action="store_true", help="Print results as JSON")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    catalog = load_catalog(args.catalog)
+    names = args.types.split(",") if args.types else sorted(catalog)
+    unknown = [n for n in names if n not in catalog]
+    if unknown:
+        sys.exit(f"Unknown instance types (add them with --catalog): {unknown}")
+
+    if args.live:
+        services = services_from_cluster(args.live, args.region, args.peak)
+    else:
+        cli_vars = dict(v.split("=", 1) for v in args.var)
+        services = services_from_configs(
+            args.configs, cli_vars, args.peak, args.cluster
+        )
+
+    results = sorted(
+        (
+            simulate(services, catalog[n], args.azs, args.os_overhead_pct, args.seed)
+            for n in names
+        ),
+        key=lambda r: (r["unplaced_tasks"], r["cost_per_month"]),
+    )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    replicas = [s for s in services if not s.daemon]
+    print(
+        f"{len(replicas)} services, {sum(s.count for s in replicas)} tasks,",
+        f"{len(services) - len(replicas)} daemons",
+    )
+    print_table(results)
+
+
+if __name__ == "__main__":
+    main()